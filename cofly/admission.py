@@ -0,0 +1,111 @@
+"""Admission control for WS handshakes, and the ClientConfig that paces reconnects.
+
+Every handshake (ws_endpoint discovery, then /ws) costs DB lookups and, for
+new accounts, bcrypt. After a restart every client reconnects at once, so
+handshakes take a token from a bucket refilled at WS_HANDSHAKE_RATE per second
+and hold one of WS_HANDSHAKE_CONCURRENCY slots while they run. A handshake
+that can't get both is rejected with a retry hint instead of queueing behind
+the others.
+
+The reconnect pacing itself happens on the client: the SDK waits a random
+0..ReconnectNonce seconds before its first reconnect and ReconnectInterval
+between retries, using the ClientConfig from its last pong or ws_endpoint
+call. The nonce is sized so that every currently connected client reconnecting
+at once arrives no faster than the admission rate, and both values stretch
+further while admission is under load.
+"""
+
+import math
+import random
+import time
+from typing import Optional
+
+from config import (
+    WS_HANDSHAKE_BURST, WS_HANDSHAKE_CONCURRENCY, WS_HANDSHAKE_RATE, WS_PING_INTERVAL, WS_RECONNECT_COUNT,
+    WS_RECONNECT_INTERVAL, WS_RECONNECT_MAX_INTERVAL, WS_RECONNECT_MAX_NONCE, WS_RECONNECT_NONCE,
+)
+from metrics import WS_HANDSHAKES
+
+_ADMITTED = WS_HANDSHAKES.labels("admitted")
+_REJECTED = WS_HANDSHAKES.labels("rejected")
+
+# Seconds a computed ClientConfig is reused (it is served on every pong)
+_CONFIG_TTL = 1.0
+
+
+class HandshakeAdmission:
+    def __init__(self, rate: float, burst: int, concurrency: int, ping_interval: int,
+                 reconnect_count: int, interval: int, max_interval: int, nonce: int, max_nonce: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.concurrency = max(1, concurrency)
+        self.ping_interval = ping_interval
+        self.reconnect_count = reconnect_count
+        self.interval = interval
+        self.max_interval = max_interval
+        self.nonce = nonce
+        self.max_nonce = max_nonce
+        self.tokens = float(self.burst)
+        self.in_flight = 0
+        self._refilled = time.monotonic()
+        self._config: Optional[dict] = None
+        self._config_expires = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(float(self.burst), self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def try_acquire(self) -> bool:
+        """Admit one handshake; the caller must release() it when done."""
+        if self.rate <= 0:
+            self.in_flight += 1
+            return True
+        self._refill(time.monotonic())
+        if self.tokens < 1 or self.in_flight >= self.concurrency:
+            _REJECTED.inc()
+            return False
+        self.tokens -= 1
+        self.in_flight += 1
+        _ADMITTED.inc()
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    def load(self) -> float:
+        """0 when idle, 1 when handshakes are being rejected."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        if self.burst <= 0 or self.concurrency <= 0:
+            return 1.0
+        return min(1.0, max(1 - self.tokens / self.burst, self.in_flight / self.concurrency))
+
+    def client_config(self, connections: int) -> dict:
+        """ClientConfig for the SDK, given the current number of connections."""
+        now = time.monotonic()
+        if self._config is not None and now < self._config_expires:
+            return self._config
+        load = self.load()
+        nonce = self.nonce
+        if self.rate > 0:
+            # Long enough for all current connections to come back at the admission rate
+            nonce = max(nonce, connections / self.rate)
+        self._config = {
+            "ReconnectCount": self.reconnect_count,
+            "ReconnectInterval": round(self.interval + (self.max_interval - self.interval) * load),
+            "ReconnectNonce": min(self.max_nonce, math.ceil(nonce * (1 + load))),
+            "PingInterval": self.ping_interval,
+        }
+        self._config_expires = now + _CONFIG_TTL
+        return self._config
+
+    def retry_after(self, connections: int) -> int:
+        """Jittered seconds a rejected client should wait before retrying."""
+        return random.randint(1, max(1, self.client_config(connections)["ReconnectNonce"]))
+
+
+admission = HandshakeAdmission(
+    WS_HANDSHAKE_RATE, WS_HANDSHAKE_BURST, WS_HANDSHAKE_CONCURRENCY, WS_PING_INTERVAL, WS_RECONNECT_COUNT,
+    WS_RECONNECT_INTERVAL, WS_RECONNECT_MAX_INTERVAL, WS_RECONNECT_NONCE, WS_RECONNECT_MAX_NONCE,
+)
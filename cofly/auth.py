@@ -8,6 +8,7 @@ from sqlalchemy.orm import Session
 
 from config import SECRET_KEY, TOKEN_EXPIRE_SECONDS, REGISTRATION_TOKEN
 from database import get_db
+from metrics import BCRYPT_SECONDS
 from models import User, make_user_id
 
 
@@ -17,12 +18,18 @@ def verify_registration_token(token: str | None) -> bool:
     return token == REGISTRATION_TOKEN
 
 
+_BCRYPT_HASH = BCRYPT_SECONDS.labels("hash")
+_BCRYPT_VERIFY = BCRYPT_SECONDS.labels("verify")
+
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    with _BCRYPT_HASH.time():
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return bcrypt.checkpw(plain.encode(), hashed.encode())
+    with _BCRYPT_VERIFY.time():
+        return bcrypt.checkpw(plain.encode(), hashed.encode())
 
 
 def create_token(user_id: str, username: str) -> str:
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+流式回复增量更新基准：比较 im.message.update_v1（全量）与
+cofly.message.delta_v1（增量）在线路上的字节数。
+
+使用方式：
+    python benchmarks/bench_delta.py [--reply-bytes 20000] [--patches 200]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from deltas import apply_ops, compute_ops  # noqa: E402
+from proto import make_event_frame  # noqa: E402
+from ws_manager import build_message_delta_event, build_message_update_event  # noqa: E402
+
+_EVENT_ARGS = dict(
+    sender_id="3f1c2a9e-0000-4000-8000-000000000001",
+    receiver_username="cli_a1b2c3d4e5f6",
+    message_id="9d8e7f6a-0000-4000-8000-000000000002",
+    chat_id="5b4c3d2e-0000-4000-8000-000000000003",
+    chat_type="p2p",
+    message_type="text",
+)
+
+
+def run(reply_bytes: int, patches: int) -> dict:
+    # A markdown-ish answer, streamed in equal-sized chunks
+    text = ("Streaming answer line with some **markdown** and `code`.\n" * (reply_bytes // 58 + 1))[:reply_bytes]
+    step = max(1, len(text) // patches)
+    full_bytes = delta_bytes = 0
+    client_content = prev = json.dumps({"text": ""})
+    for version, end in enumerate(range(step, len(text) + step, step), start=1):
+        content = json.dumps({"text": text[:end]})
+        full = build_message_update_event(**_EVENT_ARGS, content=content, version=version)
+        ops = compute_ops(prev, content)
+        delta = build_message_delta_event(**_EVENT_ARGS, base_version=version - 1, version=version, ops=ops)
+        full_bytes += len(make_event_frame(full, seq_id=version))
+        delta_bytes += len(make_event_frame(delta, seq_id=version))
+        client_content = apply_ops(client_content, ops)
+        prev = content
+    assert client_content == prev
+    return {
+        "benchmark": "delta_updates",
+        "reply_bytes": reply_bytes,
+        "patches": version,
+        "full_update_bytes": full_bytes,
+        "delta_update_bytes": delta_bytes,
+        "reduction": round(full_bytes / delta_bytes, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 增量更新线路字节基准")
+    parser.add_argument("--reply-bytes", type=int, default=20_000)
+    parser.add_argument("--patches", type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(run(args.reply_bytes, args.patches), indent=2))
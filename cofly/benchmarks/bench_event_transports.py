@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+事件投递通道基准：比较 WebSocket（pbbp2 帧）、SSE 与长轮询每个事件的服务端开销与线路字节数。
+
+每种通道投递 --events 个 im.message.receive_v1 事件，按批大小（--batches）分组：
+  ws    每个事件一次 push_event，写一帧；
+  sse   每批事件 push 到 SSE 连接后由响应生成器合并为一次写入；
+  poll  用户离线，事件进入离线队列，每批一次 GET /cofly/events/poll（含 HTTP、鉴权与 JSON 编码）。
+线路字节为响应体 / 帧本身，poll 另计 HTTP 响应头；不含 TCP / TLS 与 WebSocket 帧头。
+
+使用方式：
+    python benchmarks/bench_event_transports.py [--events 2000] [--batches 1,10,100]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix="cofly-bench-")
+os.environ.setdefault("COFLY_DB_PATH", os.path.join(_DB_DIR, "bench.db"))
+os.environ.setdefault("COFLY_REGISTRATION_TOKEN", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+
+from auth import create_token  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from main import app  # noqa: E402
+from models import User  # noqa: E402
+from routers.events_router import StreamSocket, sse_chunk  # noqa: E402
+from ws_manager import build_message_event, ws_manager  # noqa: E402
+
+
+class FakeWS:
+    def __init__(self):
+        self.bytes = 0
+
+    async def accept(self):
+        pass
+
+    async def send_bytes(self, data):
+        self.bytes += len(data)
+
+
+def _event(user: User, i: int) -> dict:
+    return build_message_event(
+        sender_id="3f1c2a9e-0000-4000-8000-000000000001", receiver_username=user.username,
+        message_id=f"9d8e7f6a-0000-4000-8000-{i:012d}", chat_id="5b4c3d2e-0000-4000-8000-000000000003",
+        chat_type="p2p", message_type="text", content=json.dumps({"text": f"reply number {i}"}),
+    )
+
+
+def _result(transport: str, batch: int, events: int, seconds: float, wire_bytes: int) -> dict:
+    return {
+        "transport": transport,
+        "batch": batch,
+        "us_per_event": round(seconds / events * 1e6, 2),
+        "bytes_per_event": round(wire_bytes / events, 1),
+    }
+
+
+async def bench_ws(user: User, events: int) -> dict:
+    ws_manager.reset()
+    ws = FakeWS()
+    await ws_manager.connect(user.id, ws)
+    payloads = [_event(user, i) for i in range(events)]
+    t0 = time.perf_counter()
+    for event in payloads:
+        await ws_manager.push_event(user.id, event)
+    return _result("ws", 1, events, time.perf_counter() - t0, ws.bytes)
+
+
+async def bench_sse(user: User, events: int, batch: int) -> dict:
+    ws_manager.reset()
+    sock = StreamSocket()
+    await ws_manager.connect(user.id, sock)
+    payloads = [_event(user, i) for i in range(events)]
+    wire = 0
+    t0 = time.perf_counter()
+    for start in range(0, events, batch):
+        for event in payloads[start:start + batch]:
+            await ws_manager.push_event(user.id, event)
+        frames = [sock.frames.get_nowait() for _ in range(sock.frames.qsize())]
+        wire += len(sse_chunk(frames))
+    return _result("sse", batch, events, time.perf_counter() - t0, wire)
+
+
+async def bench_poll(client, user: User, events: int, batch: int) -> dict:
+    ws_manager.reset()
+    headers = {"Authorization": f"Bearer {create_token(user.id, user.username)}"}
+    payloads = [_event(user, i) for i in range(events)]
+    cursor, wire = 0, 0
+    t0 = time.perf_counter()
+    for start in range(0, events, batch):
+        for event in payloads[start:start + batch]:
+            await ws_manager.push_event(user.id, event)
+        r = await client.get("/cofly/events/poll", params={"cursor": cursor, "limit": batch, "timeout": 0},
+                             headers=headers)
+        data = r.json()["data"]
+        assert len(data["items"]) == min(batch, events - start)
+        cursor = data["cursor"]
+        wire += len(r.content) + sum(len(k) + len(v) + 4 for k, v in r.headers.raw) + len("HTTP/1.1 200 OK\r\n\r\n")
+    return _result("poll", batch, events, time.perf_counter() - t0, wire)
+
+
+async def main(events: int, batches) -> list:
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    user = User(username="bench_events", password_hash="")
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    db.close()
+
+    results = [await bench_ws(user, events)]
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://bench") as client:
+        for batch in batches:
+            results.append(await bench_sse(user, events, batch))
+            results.append(await bench_poll(client, user, events, batch))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 事件投递通道基准")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--batches", default="1,10,100", help="逗号分隔的每批事件数（SSE 每次写入 / 每次轮询）")
+    args = parser.parse_args()
+
+    batches = [int(b) for b in args.batches.split(",")]
+    print(json.dumps({
+        "benchmark": "event_transports",
+        "events": args.events,
+        "results": asyncio.run(main(args.events, batches)),
+    }, ensure_ascii=False, indent=2))
+    engine.dispose()
+    shutil.rmtree(_DB_DIR, ignore_errors=True)
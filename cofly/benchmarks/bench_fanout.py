@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+消息扇出基准：测量不同群规模下发送接口的 HTTP 响应延迟与扇出完成（ack）延迟，
+对比串行推送（--concurrency 1）与并发推送。
+
+每个成员挂一个模拟 WebSocket，send_bytes 固定耗时 --write-ms 毫秒（模拟慢客户端）。
+
+使用方式：
+    python benchmarks/bench_fanout.py [--sizes 2,50,500] [--messages 20] [--write-ms 1]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix="cofly-bench-")
+os.environ.setdefault("COFLY_DB_PATH", os.path.join(_DB_DIR, "bench.db"))
+os.environ.setdefault("COFLY_REGISTRATION_TOKEN", "")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+
+from auth import create_token  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from fanout import fanout  # noqa: E402
+from main import app  # noqa: E402
+from models import Chat, ChatMember, User  # noqa: E402
+from ws_manager import ws_manager  # noqa: E402
+
+
+class FakeWS:
+    def __init__(self, write_s: float):
+        self.write_s = write_s
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(self.write_s)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build_chat(tag: str, size: int) -> tuple:
+    """Create a group of `size` members directly in the DB; returns (chat_id, member_ids)."""
+    db = SessionLocal()
+    try:
+        chat = Chat(chat_type="group" if size > 2 else "p2p", name=f"{tag}-{size}")
+        db.add(chat)
+        db.flush()
+        ids = []
+        for i in range(size):
+            user = User(username=f"{tag}{size}_{i}", password_hash="")
+            db.add(user)
+            db.flush()
+            db.add(ChatMember(chat_id=chat.id, user_id=user.id))
+            ids.append((user.id, user.username))
+        db.commit()
+        return chat.id, ids
+    finally:
+        db.close()
+
+
+async def run_size(client, tag: str, size: int, messages: int, write_s: float) -> dict:
+    chat_id, members = build_chat(tag, size)
+    ws_manager.reset()
+    for uid, _ in members:
+        ws_manager.register(uid, FakeWS(write_s))
+    sender_id, sender_name = members[0]
+    headers = {"Authorization": f"Bearer {create_token(sender_id, sender_name)}"}
+
+    response_ms, complete_ms = [], []
+    for i in range(messages):
+        t0 = time.perf_counter()
+        r = await client.post(
+            "/open-apis/im/v1/messages?receive_id_type=chat_id",
+            json={"receive_id": chat_id, "msg_type": "text", "content": json.dumps({"text": f"m{i}"})},
+            headers=headers,
+        )
+        response_ms.append((time.perf_counter() - t0) * 1000)
+        assert r.json()["code"] == 0
+        await fanout.drain()
+        complete_ms.append((time.perf_counter() - t0) * 1000)
+    return {
+        "members": size,
+        "response_p50_ms": round(_percentile(response_ms, 0.50), 2),
+        "response_p95_ms": round(_percentile(response_ms, 0.95), 2),
+        "ack_p50_ms": round(_percentile(complete_ms, 0.50), 2),
+        "ack_p95_ms": round(_percentile(complete_ms, 0.95), 2),
+    }
+
+
+async def main(sizes, messages, write_s, concurrency):
+    Base.metadata.create_all(bind=engine)
+    results = {}
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://bench") as client:
+        for mode, limit in (("sequential", 1), ("concurrent", concurrency)):
+            fanout.concurrency = limit
+            results[mode] = [await run_size(client, mode, s, messages, write_s) for s in sizes]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 消息扇出基准")
+    parser.add_argument("--sizes", default="2,50,500", help="逗号分隔的群成员数")
+    parser.add_argument("--messages", type=int, default=20, help="每个群发送的消息数")
+    parser.add_argument("--write-ms", type=float, default=1.0, help="模拟每次 WebSocket 写入耗时")
+    parser.add_argument("--concurrency", type=int, default=fanout.concurrency)
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    report = {
+        "benchmark": "fanout",
+        "write_ms": args.write_ms,
+        "concurrency": args.concurrency,
+        **asyncio.run(main(sizes, args.messages, args.write_ms / 1000, args.concurrency)),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    engine.dispose()
+    shutil.rmtree(_DB_DIR, ignore_errors=True)
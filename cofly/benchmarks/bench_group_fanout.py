@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+大群扇出基准：1000 人群中一条消息的扇出耗时。
+
+对比旧路径（逐成员查询 User、逐成员构造并编码事件、逐个 await push_event）
+与新路径（成员列表缓存、事件体只编码一次、按在线状态过滤、离线批量入队、并发推送）。
+
+使用方式：
+    python benchmarks/bench_group_fanout.py [--members 1000] [--online 0.5] [--messages 50]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix="cofly-bench-")
+os.environ.setdefault("COFLY_DB_PATH", os.path.join(_DB_DIR, "bench.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import Base, SessionLocal, engine  # noqa: E402
+from fanout import fanout  # noqa: E402
+from models import Chat, ChatMember, User  # noqa: E402
+from recipients import recipient_cache  # noqa: E402
+from ws_manager import SharedEvent, build_message_event, ws_manager  # noqa: E402
+
+
+class FakeWS:
+    def __init__(self, write_s: float):
+        self.write_s = write_s
+        self.bytes = 0
+
+    async def send_bytes(self, data):
+        self.bytes += len(data)
+        if self.write_s:
+            await asyncio.sleep(self.write_s)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build(members: int) -> tuple:
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        chat = Chat(chat_type="group", name="bench")
+        db.add(chat)
+        db.flush()
+        ids = []
+        for i in range(members):
+            user = User(username=f"agent{i}", password_hash="")
+            db.add(user)
+            db.flush()
+            db.add(ChatMember(chat_id=chat.id, user_id=user.id))
+            ids.append(user.id)
+        db.commit()
+        return chat.id, ids
+    finally:
+        db.close()
+
+
+def _event_args(chat_id: str, i: int, content: str) -> dict:
+    return dict(sender_id="bench-sender", message_id=f"m{i}", chat_id=chat_id,
+                chat_type="group", message_type="text", content=content)
+
+
+async def legacy_fanout(db, chat_id: str, i: int, content: str):
+    members = db.query(ChatMember).filter(ChatMember.chat_id == chat_id).all()
+    for m in members:
+        target = db.query(User).filter(User.id == m.user_id).first()
+        event = build_message_event(receiver_username=target.username, **_event_args(chat_id, i, content))
+        await ws_manager.push_event(m.user_id, event)
+
+
+async def engine_fanout(db, chat_id: str, i: int, content: str):
+    recipients = recipient_cache.get(db, chat_id)
+    shared = SharedEvent(build_message_event, **_event_args(chat_id, i, content))
+    await fanout.push_shared(shared, recipients)
+
+
+async def measure(fn, chat_id: str, messages: int, content: str) -> dict:
+    ws_manager.clear_pending()
+    db = SessionLocal()
+    samples = []
+    try:
+        for i in range(messages):
+            t0 = time.perf_counter()
+            await fn(db, chat_id, i, content)
+            samples.append((time.perf_counter() - t0) * 1000)
+    finally:
+        db.close()
+    return {
+        "p50_ms": round(_percentile(samples, 0.50), 2),
+        "p95_ms": round(_percentile(samples, 0.95), 2),
+        "queued_events": sum(len(v) for v in ws_manager.pending_queues()),
+    }
+
+
+async def main(args):
+    chat_id, ids = build(args.members)
+    rnd = random.Random(7)
+    for uid in rnd.sample(ids, int(len(ids) * args.online)):
+        ws_manager.register(uid, FakeWS(args.write_ms / 1000))
+    content = json.dumps({"text": "x" * args.content_bytes})
+    # Silence per-push INFO logging of the legacy path so it doesn't dominate
+    logging.getLogger("cofly.ws").setLevel(logging.WARNING)
+    return {
+        "legacy": await measure(legacy_fanout, chat_id, args.messages, content),
+        "engine": await measure(engine_fanout, chat_id, args.messages, content),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 大群扇出基准")
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--online", type=float, default=0.5, help="在线成员比例")
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--content-bytes", type=int, default=2000)
+    parser.add_argument("--write-ms", type=float, default=0.0, help="模拟每次 WebSocket 写入耗时")
+    args = parser.parse_args()
+
+    report = {
+        "benchmark": "group_fanout",
+        "members": args.members,
+        "online": args.online,
+        "content_bytes": args.content_bytes,
+        "write_ms": args.write_ms,
+        **asyncio.run(main(args)),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    engine.dispose()
+    shutil.rmtree(_DB_DIR, ignore_errors=True)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+热点路径微基准：每条消息都会经过的 proto 编解码、事件构造与序列化。
+
+用例覆盖典型负载：短文本、20 KB post、1000 行历史消息页（list_chat_messages 的逐行 dict 构造）。
+每个用例取多轮 timeit 中的最好成绩（单次调用微秒数）。
+
+使用方式：
+    python benchmarks/bench_hotpaths.py                                  # 运行并输出 JSON
+    python benchmarks/bench_hotpaths.py --save benchmarks/baselines/hotpaths.json
+    python benchmarks/bench_hotpaths.py --compare benchmarks/baselines/hotpaths.json [--threshold 0.2]
+
+--compare 时，任一用例比基线慢超过 threshold（默认 20%）则以退出码 1 结束。
+基线与机器相关：换机器后先在旧版本上 --save，再对新版本 --compare。
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from models import Message  # noqa: E402
+from proto import _encode_varint, get_header, make_event_frame, make_frame, parse_frame  # noqa: E402
+from routers.message_router import message_to_item  # noqa: E402
+from ws_manager import build_message_event  # noqa: E402
+
+SHORT_TEXT = json.dumps({"text": "deploy finished, 3 services restarted"})
+POST_20KB = json.dumps({"zh_cn": {"title": "report", "content": [
+    [{"tag": "md", "text": "Streaming answer line with some **markdown** and `code`.\n" * 8}]
+    for _ in range(44)
+]}}, ensure_ascii=False)
+
+_EVENT_ARGS = dict(
+    sender_id=str(uuid.uuid4()),
+    receiver_username="cli_a1b2c3d4e5f6",
+    message_id=str(uuid.uuid4()),
+    chat_id=str(uuid.uuid4()),
+    chat_type="p2p",
+)
+
+
+def _history_page(rows=1000):
+    start = datetime(2025, 1, 1)
+    chat_id, sender_id = str(uuid.uuid4()), str(uuid.uuid4())
+    return [
+        Message(id=str(uuid.uuid4()), chat_id=chat_id, sender_id=sender_id, message_type="text",
+                content=json.dumps({"text": f"history message {i}"}), root_id="", parent_id="",
+                created_at=start + timedelta(seconds=i), version=0)
+        for i in range(rows)
+    ]
+
+
+def cases():
+    short_event = build_message_event(**_EVENT_ARGS, message_type="text", content=SHORT_TEXT)
+    post_event = build_message_event(**_EVENT_ARGS, message_type="post", content=POST_20KB)
+    short_frame = make_event_frame(short_event, seq_id=42)
+    post_frame = make_event_frame(post_event, seq_id=42)
+    page = _history_page()
+    return {
+        "encode_varint_small": lambda: _encode_varint(42),
+        "encode_varint_large": lambda: _encode_varint(1_700_000_000_000),
+        "make_frame_ping": lambda: make_frame(seq_id=1, method=0, headers={"type": "ping"}),
+        "build_event_short_text": lambda: build_message_event(
+            **_EVENT_ARGS, message_type="text", content=SHORT_TEXT),
+        "make_event_frame_short_text": lambda: make_event_frame(short_event, seq_id=42),
+        "make_event_frame_post_20kb": lambda: make_event_frame(post_event, seq_id=42),
+        "parse_frame_short_text": lambda: get_header(parse_frame(short_frame), "type"),
+        "parse_frame_post_20kb": lambda: get_header(parse_frame(post_frame), "type"),
+        "history_page_1000_rows": lambda: [message_to_item(m) for m in page],
+    }
+
+
+def measure(fn, repeat):
+    number, _ = timeit.Timer(fn).autorange()
+    best = min(timeit.repeat(fn, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def run(repeat, only=None):
+    return {
+        name: round(measure(fn, repeat), 3)
+        for name, fn in cases().items()
+        if not only or name in only
+    }
+
+
+def compare(results, baseline, threshold):
+    report, regressions = {}, []
+    for name, us in results.items():
+        base = baseline.get(name)
+        if base is None:
+            report[name] = {"us": us, "baseline_us": None}
+            continue
+        change = us / base - 1
+        report[name] = {"us": us, "baseline_us": base, "change": round(change, 3)}
+        if change > threshold:
+            regressions.append(name)
+    return report, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 热点路径微基准")
+    parser.add_argument("--repeat", type=int, default=5, help="timeit 轮数，取最好成绩")
+    parser.add_argument("--only", default="", help="逗号分隔，只运行这些用例")
+    parser.add_argument("--save", default="", help="把结果写为基线文件")
+    parser.add_argument("--compare", default="", help="与基线文件比较")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定退化的相对阈值")
+    args = parser.parse_args()
+
+    results = run(args.repeat, set(filter(None, args.only.split(","))))
+    output = {
+        "benchmark": "hotpaths",
+        "unit": "us_per_call",
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        output["comparison"], output["regressions"] = compare(results, baseline, args.threshold)
+        output["threshold"] = args.threshold
+        exit_code = 1 if output["regressions"] else 0
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({k: output[k] for k in ("benchmark", "unit", "python", "machine", "results")},
+                      f, indent=2)
+            f.write("\n")
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+    sys.exit(exit_code)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+消息全文搜索基准测试（SQLite FTS5）
+
+在临时数据库中生成 N 条消息并建立 messages_fts 索引，然后测量
+search_messages 的查询延迟（p50/p95/p99）：第一页，以及用 page_token
+（上一页最后一条的 (score, rowid)）翻到的第 --deep-page 页。结果以 JSON 输出。
+
+使用方式：
+    python benchmarks/bench_search.py [--messages 10000000] [--chats 5000] [--queries 200]
+
+10M 条消息的建库约需数分钟、占用数 GB 磁盘；默认 1M 便于快速运行。
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix="cofly-bench-")
+os.environ.setdefault("COFLY_DB_PATH", os.path.join(_DB_DIR, "bench.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine, Base, SessionLocal  # noqa: E402
+from search import CONTENT_TABLE, search_messages  # noqa: E402
+
+WORDS = (
+    "deploy staging cluster release rollback metrics latency budget review agent "
+    "answer question weather report meeting schedule invoice database index query "
+    "部署 生产 集群 周报 会议 天气 发布 回滚 数据库 索引 查询 预算 审核 问题 答案"
+).split()
+QUERIES = ["deploy", "cluster latency", "数据库", "生产 集群", "rollback", "weather report", "周报"]
+VOCAB_SIZE = 50_000
+
+
+def _vocabulary():
+    """Zipf-distributed vocabulary; the query words sit at moderately common ranks."""
+    vocab = [f"w{i}" for i in range(VOCAB_SIZE)]
+    vocab[100:100 + len(WORDS)] = WORDS
+    cum, total = [], 0.0
+    for rank in range(VOCAB_SIZE):
+        total += 1.0 / (rank + 1)
+        cum.append(total)
+    return vocab, cum
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def build(n_messages: int, n_chats: int, user_chats: int, batch: int = 50_000):
+    Base.metadata.create_all(bind=engine)
+    raw = engine.raw_connection()
+    cur = raw.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.execute("INSERT INTO users(id, username, password_hash) VALUES ('u0', 'bench', '')")
+    cur.executemany("INSERT INTO chats(id, chat_type) VALUES (?, 'p2p')",
+                    [(f"c{i}",) for i in range(n_chats)])
+    cur.executemany("INSERT INTO chat_members(chat_id, user_id) VALUES (?, 'u0')",
+                    [(f"c{i}",) for i in range(user_chats)])
+    rnd = random.Random(42)
+    vocab, cum = _vocabulary()
+    t0 = time.perf_counter()
+    for start in range(0, n_messages, batch):
+        msgs, fts = [], []
+        for i in range(start, min(start + batch, n_messages)):
+            text = " ".join(rnd.choices(vocab, cum_weights=cum, k=rnd.randint(4, 24)))
+            chat_id = f"c{rnd.randrange(n_chats)}"
+            msgs.append((i + 1, f"m{i}", chat_id, json.dumps({"text": text}, ensure_ascii=False)))
+            fts.append((f"m{i}", chat_id, text))
+        cur.executemany(
+            "INSERT INTO messages(rowid, id, chat_id, sender_id, message_type, content, created_at) "
+            "VALUES (?, ?, ?, 'u0', 'text', ?, CURRENT_TIMESTAMP)", msgs)
+        cur.executemany(f"INSERT INTO {CONTENT_TABLE}(message_id, chat_id, body) VALUES (?, ?, ?)", fts)
+        raw.commit()
+    build_s = time.perf_counter() - t0
+    raw.close()
+    return build_s
+
+
+def _latency(db, q: str, n_queries: int, page_size: int, after=None):
+    search_messages(db, "u0", q, limit=page_size, after=after)  # warm up
+    samples = []
+    for _ in range(n_queries):
+        t0 = time.perf_counter()
+        search_messages(db, "u0", q, limit=page_size, after=after)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return {
+        "p50_ms": round(_percentile(samples, 0.50), 3),
+        "p95_ms": round(_percentile(samples, 0.95), 3),
+        "p99_ms": round(_percentile(samples, 0.99), 3),
+    }
+
+
+def run(n_queries: int, page_size: int, deep_page: int):
+    db = SessionLocal()
+    results = {}
+    try:
+        for q in QUERIES:
+            results[q] = {"first_page": _latency(db, q, n_queries, page_size)}
+            # Follow page tokens the way a client does
+            after = None
+            for _ in range(deep_page - 1):
+                hits = search_messages(db, "u0", q, limit=page_size, after=after)
+                if len(hits) < page_size:
+                    break
+                after = (hits[-1].score, hits[-1].rowid)
+            else:
+                results[q][f"page_{deep_page}"] = _latency(db, q, n_queries, page_size, after)
+    finally:
+        db.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly 全文搜索基准测试")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=5000)
+    parser.add_argument("--user-chats", type=int, default=300,
+                        help="查询用户所在的会话数")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--deep-page", type=int, default=10, help="另测第几页的延迟")
+    args = parser.parse_args()
+
+    build_s = build(args.messages, args.chats, args.user_chats)
+    report = {
+        "benchmark": "search",
+        "messages": args.messages,
+        "chats": args.chats,
+        "user_chats": args.user_chats,
+        "page_size": args.page_size,
+        "build_seconds": round(build_s, 2),
+        "queries": run(args.queries, args.page_size, args.deep_page),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    engine.dispose()
+    shutil.rmtree(_DB_DIR, ignore_errors=True)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+WS 连接注册表基准：在 5 万模拟连接下测量注册 / 注销耗时是否随连接数保持平稳，以及每连接内存。
+
+对每个分片数（--shards），逐步注册到 --connections 个连接（每用户一个设备），
+在每个检查点（--checkpoints）再注册并注销 --probe 个连接，记录单次操作的平均微秒数（取 --repeat 次最优，
+计时期间关闭 GC）；内存在单独一轮中用 tracemalloc 统计注册表本身（Connection、分片字典、空闲堆）的增量，
+不含模拟 socket，避免 tracemalloc 拖慢计时。
+
+使用方式：
+    python benchmarks/bench_ws_shards.py [--connections 50000] [--shards 1,16] [--probe 2000] [--repeat 5]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ws_manager import WSManager  # noqa: E402
+
+
+class FakeWS:
+    __slots__ = ()
+
+    async def send_bytes(self, data):
+        pass
+
+
+def probe(manager: WSManager, n: int, tag: str, repeat: int) -> dict:
+    """Best-of-repeat µs per register and per disconnect for n extra connections."""
+    sockets = [FakeWS() for _ in range(n)]
+    users = [f"{tag}_{i}" for i in range(n)]
+    best_reg = best_disc = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conns = [manager.register(uid, ws, device_id="d") for uid, ws in zip(users, sockets)]
+            registered = time.perf_counter()
+            for conn in conns:
+                manager.disconnect(conn)
+            done = time.perf_counter()
+            best_reg = min(best_reg, registered - start)
+            best_disc = min(best_disc, done - registered)
+    finally:
+        gc.enable()
+    return {
+        "register_us": round(best_reg / n * 1e6, 3),
+        "disconnect_us": round(best_disc / n * 1e6, 3),
+    }
+
+
+def bytes_per_connection(shards: int, connections: int) -> float:
+    sockets = [FakeWS() for _ in range(connections)]
+    users = [f"user_{i}" for i in range(connections)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        manager = WSManager(shards)
+        for uid, ws in zip(users, sockets):
+            manager.register(uid, ws, device_id="d")
+        gc.collect()
+        return (tracemalloc.get_traced_memory()[0] - base) / connections
+    finally:
+        tracemalloc.stop()
+
+
+def run(shards: int, connections: int, checkpoints, n_probe: int, repeat: int) -> dict:
+    manager = WSManager(shards)
+    sockets = [FakeWS() for _ in range(connections)]
+    curve = []
+    registered = 0
+    for checkpoint in sorted(set(checkpoints) | {connections}):
+        while registered < min(checkpoint, connections):
+            manager.register(f"user_{registered}", sockets[registered], device_id="d")
+            registered += 1
+        curve.append({"connections": registered, **probe(manager, n_probe, f"probe{registered}", repeat)})
+    assert manager.connection_count() == connections
+    return {
+        "shards": shards,
+        "bytes_per_connection": round(bytes_per_connection(shards, connections)),
+        "largest_shard": max(s.connections.total for s in manager.shards),
+        "curve": curve,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cofly WS 连接注册表基准")
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--shards", default="1,16", help="逗号分隔的分片数")
+    parser.add_argument("--checkpoints", default="1000,10000,25000", help="逗号分隔的测量点（连接数）")
+    parser.add_argument("--probe", type=int, default=2000, help="每个测量点额外注册 / 注销的连接数")
+    parser.add_argument("--repeat", type=int, default=5, help="每个测量点重复次数，取最优")
+    args = parser.parse_args()
+
+    checkpoints = [int(c) for c in args.checkpoints.split(",") if c]
+    results = [run(int(n), args.connections, checkpoints, args.probe, args.repeat) for n in args.shards.split(",")]
+    print(json.dumps({
+        "benchmark": "ws_shards",
+        "connections": args.connections,
+        "probe": args.probe,
+        "results": results,
+    }, indent=2))
@@ -5,3 +5,79 @@ DB_PATH = os.getenv("COFLY_DB_PATH", "cofly.db")
 DATABASE_URL = f"sqlite:///{DB_PATH}"
 TOKEN_EXPIRE_SECONDS = 7200
 REGISTRATION_TOKEN = os.getenv("COFLY_REGISTRATION_TOKEN", "cofly-registration-token-17754")
+# FTS5 tokenizer for message search. "trigram" matches substrings (works for CJK);
+# only takes effect when the index is first created.
+FTS_TOKENIZER = os.getenv("COFLY_FTS_TOKENIZER", "trigram")
+# PATCHes to the same message within this window are coalesced into one write
+# and one update event per window (0 disables coalescing).
+PATCH_COALESCE_MS = int(os.getenv("COFLY_PATCH_COALESCE_MS", "500"))
+# Max messages in one POST /open-apis/im/v1/messages/batch_send
+MESSAGE_BATCH_MAX = int(os.getenv("COFLY_MESSAGE_BATCH_MAX", "50"))
+# Hot in-memory entries of (sender_id, uuid) -> sent message, in front of the DB index
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("COFLY_IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Max concurrent member pushes within one message fan-out
+FANOUT_CONCURRENCY = int(os.getenv("COFLY_FANOUT_CONCURRENCY", "64"))
+# Chats whose member list (user_id -> username) is cached for fan-out
+RECIPIENT_CACHE_CHATS = int(os.getenv("COFLY_RECIPIENT_CACHE_CHATS", "4096"))
+# Chats whose newest HISTORY_CACHE_DEPTH messages are cached for the context-window endpoint
+HISTORY_CACHE_CHATS = int(os.getenv("COFLY_HISTORY_CACHE_CHATS", "1024"))
+HISTORY_CACHE_DEPTH = int(os.getenv("COFLY_HISTORY_CACHE_DEPTH", "100"))
+# Statements (and requests' total SQL time) at or above this are logged (0 disables)
+SLOW_QUERY_MS = float(os.getenv("COFLY_SLOW_QUERY_MS", "200"))
+# Fraction of sends traced from HTTP request to WS delivery (see tracing.py)
+TRACE_SAMPLE_RATE = float(os.getenv("COFLY_TRACE_SAMPLE_RATE", "0.01"))
+TRACE_CAPACITY = int(os.getenv("COFLY_TRACE_CAPACITY", "1000"))
+# Append finished traces as JSON lines to this file (empty disables)
+TRACE_EXPORT_PATH = os.getenv("COFLY_TRACE_EXPORT_PATH", "")
+# Event-loop lag sampling period (see loop_monitor.py)
+LOOP_LAG_INTERVAL_MS = float(os.getenv("COFLY_LOOP_LAG_INTERVAL_MS", "100"))
+# Log the loop thread's stack when the loop is blocked this long (0 disables)
+LOOP_STALL_MS = float(os.getenv("COFLY_LOOP_STALL_MS", "500"))
+# Shed load while loop lag is at or above this, and for LOOP_SHED_HOLD_S after (0 disables)
+LOOP_SHED_LAG_MS = float(os.getenv("COFLY_LOOP_SHED_LAG_MS", "1000"))
+LOOP_SHED_HOLD_S = float(os.getenv("COFLY_LOOP_SHED_HOLD_S", "5"))
+# What to shed: "ws" (new /ws handshakes), "endpoint" (ws_endpoint registrations), "gc"
+LOOP_SHED = os.getenv("COFLY_LOOP_SHED", "ws,endpoint,gc")
+# WS handshake admission (/ws and ws_endpoint): sustained rate per second (0 disables),
+# burst allowance, and handshakes in progress at once (see admission.py); burst and
+# concurrency are at least 1, or no handshake could ever be admitted
+WS_HANDSHAKE_RATE = float(os.getenv("COFLY_WS_HANDSHAKE_RATE", "50"))
+WS_HANDSHAKE_BURST = max(1, int(os.getenv("COFLY_WS_HANDSHAKE_BURST", "100")))
+WS_HANDSHAKE_CONCURRENCY = max(1, int(os.getenv("COFLY_WS_HANDSHAKE_CONCURRENCY", "32")))
+# ClientConfig served to SDK clients; interval and jitter grow with admission load
+# from the base values up to the max values
+WS_PING_INTERVAL = int(os.getenv("COFLY_WS_PING_INTERVAL", "120"))
+WS_RECONNECT_COUNT = int(os.getenv("COFLY_WS_RECONNECT_COUNT", "10"))
+WS_RECONNECT_INTERVAL = int(os.getenv("COFLY_WS_RECONNECT_INTERVAL", "3"))
+WS_RECONNECT_MAX_INTERVAL = int(os.getenv("COFLY_WS_RECONNECT_MAX_INTERVAL", "60"))
+WS_RECONNECT_NONCE = int(os.getenv("COFLY_WS_RECONNECT_NONCE", "5"))
+WS_RECONNECT_MAX_NONCE = int(os.getenv("COFLY_WS_RECONNECT_MAX_NONCE", "120"))
+# Reap connections that send nothing (not even a ping) for this many ping intervals (0 disables)
+WS_IDLE_PINGS = float(os.getenv("COFLY_WS_IDLE_PINGS", "3"))
+# How often the reaper checks for idle connections
+WS_REAP_INTERVAL_S = float(os.getenv("COFLY_WS_REAP_INTERVAL_S", "10"))
+# WS connection registry / offline queue partitions, by user_id hash
+WS_SHARDS = int(os.getenv("COFLY_WS_SHARDS", "16"))
+# Per connection, queued update / sync frames kept while it is busy writing;
+# past this the oldest are dropped and their messages named in a
+# cofly.message.resync_v1 event (0 keeps all)
+WS_UPDATE_LANE_MAX = int(os.getenv("COFLY_WS_UPDATE_LANE_MAX", "256"))
+# HTTP event delivery (routers/events_router.py): longest long-poll wait, SSE
+# keepalive comment period, and most events per poll response / SSE write
+EVENTS_POLL_TIMEOUT_S = float(os.getenv("COFLY_EVENTS_POLL_TIMEOUT_S", "25"))
+EVENTS_KEEPALIVE_S = float(os.getenv("COFLY_EVENTS_KEEPALIVE_S", "15"))
+EVENTS_BATCH_MAX = int(os.getenv("COFLY_EVENTS_BATCH_MAX", "500"))
+# Webhook delivery (see webhooks.py): POSTs in flight at once over all users, most
+# events per POST, per-POST timeout, retries before falling back to the offline
+# queue, and the first / longest retry backoff
+WEBHOOK_CONCURRENCY = int(os.getenv("COFLY_WEBHOOK_CONCURRENCY", "16"))
+WEBHOOK_BATCH_MAX = int(os.getenv("COFLY_WEBHOOK_BATCH_MAX", "50"))
+WEBHOOK_TIMEOUT_S = float(os.getenv("COFLY_WEBHOOK_TIMEOUT_S", "10"))
+WEBHOOK_RETRIES = int(os.getenv("COFLY_WEBHOOK_RETRIES", "5"))
+WEBHOOK_BACKOFF_S = float(os.getenv("COFLY_WEBHOOK_BACKOFF_S", "0.5"))
+WEBHOOK_BACKOFF_MAX_S = float(os.getenv("COFLY_WEBHOOK_BACKOFF_MAX_S", "30"))
+# Seconds shutdown waits for webhook deliveries before the rest falls back
+WEBHOOK_DRAIN_S = float(os.getenv("COFLY_WEBHOOK_DRAIN_S", "10"))
+# Webhook hosts must resolve to public addresses (no loopback, private or link-local
+# targets); hosts listed here, comma-separated, are allowed regardless
+WEBHOOK_ALLOWED_HOSTS = os.getenv("COFLY_WEBHOOK_ALLOWED_HOSTS", "")
@@ -0,0 +1,50 @@
+import json
+
+PREVIEW_MAX_CHARS = 80
+
+
+def extract_text(message_type: str, content: str) -> str:
+    """Extract the human-readable text from a Feishu message content string.
+    Supports text ({"text": ...}) and post ({"zh_cn": {"title", "content": [[node]]}});
+    other types yield an empty string."""
+    try:
+        data = json.loads(content) if content else {}
+    except (ValueError, TypeError):
+        return content or ""
+    if not isinstance(data, dict):
+        return ""
+    if message_type == "text" or "text" in data:
+        text = data.get("text", "")
+        return text if isinstance(text, str) else ""
+    if message_type != "post":
+        return ""
+    # post may be wrapped as {"post": {"zh_cn": ...}} or given without a language key
+    if isinstance(data.get("post"), dict):
+        data = data["post"]
+    langs = [data] if "content" in data else [v for v in data.values() if isinstance(v, dict)]
+    parts = []
+    for lang in langs:
+        title = lang.get("title")
+        if isinstance(title, str) and title:
+            parts.append(title)
+        for line in lang.get("content") or []:
+            if not isinstance(line, list):
+                continue
+            words = [n["text"] for n in line
+                     if isinstance(n, dict) and isinstance(n.get("text"), str)]
+            if words:
+                parts.append("".join(words))
+        if parts:
+            break
+    return "\n".join(parts)
+
+
+def make_preview(message_type: str, content: str) -> str:
+    """One-line preview for chat lists: text for text/post, "[type]" otherwise."""
+    text = extract_text(message_type, content)
+    if not text:
+        return f"[{message_type}]"
+    text = " ".join(text.split())
+    if len(text) > PREVIEW_MAX_CHARS:
+        text = text[:PREVIEW_MAX_CHARS - 1] + "…"
+    return text
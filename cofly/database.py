@@ -1,9 +1,13 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 from config import DATABASE_URL
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Async endpoints query on the event loop and keep their session's connection
+# across awaits (a patch waiting on its message's lock, a push to a slow
+# socket). A checkout that waited for one of those to come back would block the
+# loop they need to finish, so the pool opens extra connections instead of waiting.
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, max_overflow=-1)
 SessionLocal = sessionmaker(bind=engine)
 
 
@@ -11,9 +15,45 @@ class Base(DeclarativeBase):
     pass
 
 
+_BACKFILL_SEQ = """
+UPDATE messages SET seq = numbered.n
+FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY created_at, id) AS n FROM messages) AS numbered
+WHERE messages.id = numbered.id
+"""
+_BACKFILL_LAST_SEQ = """
+UPDATE chats SET last_seq = (SELECT COALESCE(MAX(seq), 0) FROM messages WHERE messages.chat_id = chats.id)
+"""
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+def init_db():
+    """Create missing tables, then add columns and indexes introduced after
+    an existing cofly.db was created (create_all never alters existing tables)."""
+    Base.metadata.create_all(bind=engine)
+    insp = inspect(engine)
+    added = set()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(engine.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                conn.execute(text(ddl))
+                added.add((table.name, col.name))
+        if ("messages", "seq") in added:
+            # Number existing messages in history order; new sends continue from chats.last_seq
+            conn.execute(text(_BACKFILL_SEQ))
+            conn.execute(text(_BACKFILL_LAST_SEQ))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -0,0 +1,40 @@
+"""Delta encoding for streamed message edits.
+
+Ops are applied in order to the content string of the base version; offsets
+count Unicode code points:
+    {"op": "append", "text": "..."}
+    {"op": "replace", "start": i, "end": j, "text": "..."}
+"""
+
+from typing import List
+
+
+def compute_ops(old: str, new: str) -> List[dict]:
+    """Smallest single-range edit turning old into new (streams are mostly appends)."""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    if prefix == len(old):
+        return [{"op": "append", "text": new[prefix:]}] if len(new) > prefix else []
+    suffix = 0
+    while (suffix < limit - prefix
+           and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]):
+        suffix += 1
+    return [{
+        "op": "replace",
+        "start": prefix,
+        "end": len(old) - suffix,
+        "text": new[prefix:len(new) - suffix],
+    }]
+
+
+def apply_ops(content: str, ops: List[dict]) -> str:
+    for op in ops:
+        if op["op"] == "append":
+            content += op["text"]
+        elif op["op"] == "replace":
+            content = content[:op["start"]] + op["text"] + content[op["end"]:]
+        else:
+            raise ValueError(f"unknown delta op: {op['op']}")
+    return content
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from config import FANOUT_CONCURRENCY
+from ws_manager import SharedEvent, WSShard, ws_manager
+
+logger = logging.getLogger("cofly.fanout")
+
+
+class FanoutDispatcher:
+    """Delivers message events off the HTTP response path.
+
+    Each fan-out runs as a background task with member pushes running
+    concurrently (bounded). Fan-outs of the same chat are chained so every
+    recipient still sees that chat's events in send order, while different
+    chats proceed in parallel. Edits wait for their message's fan-out so an
+    update never overtakes the receive event it modifies.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._chat_tail: Dict[str, asyncio.Task] = {}
+        self._by_message: Dict[str, asyncio.Task] = {}
+
+    def dispatch(self, chat_id: str, message_id: str, job: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        return self.dispatch_batch([chat_id], [message_id], job)
+
+    def dispatch_batch(self, chat_ids: List[str], message_ids: List[str],
+                       job: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        """One fan-out for messages in several chats: it waits for the pending
+        fan-outs of all of them, and later ones in any of them wait for it."""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        prev = [t for t in map(self._chat_tail.get, chat_ids) if t is not None]
+        task = asyncio.create_task(self._run(prev, job))
+        for chat_id in chat_ids:
+            self._chat_tail[chat_id] = task
+        for message_id in message_ids:
+            self._by_message[message_id] = task
+
+        def _done(t: asyncio.Task):
+            for chat_id in chat_ids:
+                if self._chat_tail.get(chat_id) is t:
+                    del self._chat_tail[chat_id]
+            for message_id in message_ids:
+                if self._by_message.get(message_id) is t:
+                    del self._by_message[message_id]
+        task.add_done_callback(_done)
+        return task
+
+    async def _run(self, prev: List[asyncio.Task], job: Callable[[], Awaitable[None]]):
+        prev = [t for t in prev if not t.done()]
+        if prev:
+            await asyncio.wait(prev)
+        try:
+            await job()
+        except Exception as e:
+            logger.error("fan-out failed: %s", e)
+
+    async def wait_for(self, message_id: str):
+        """Wait until the fan-out of message_id (if still running) has finished."""
+        task = self._by_message.get(message_id)
+        if task is not None and not task.done():
+            await asyncio.wait([task])
+
+    async def push_shared(self, shared: SharedEvent, recipients: Dict[str, str], trace=None) -> int:
+        """Deliver one SharedEvent to {user_id: username} recipients; returns how
+        many were reached online. Recipients are grouped by registry shard; each
+        shard splits off its offline members and queues them in one batch, so
+        only online members cost a push (bounded, concurrent)."""
+        online = []
+        for shard, user_ids in ws_manager.group_by_shard(recipients).items():
+            offline = []
+            for user_id in user_ids:
+                (online if shard.is_online(user_id) else offline).append((shard, user_id))
+            shard.enqueue([(user_id, shared.event_for(recipients[user_id])) for _, user_id in offline])
+            if trace is not None:
+                for _, user_id in offline:
+                    trace.mark("enqueued", user_id=user_id)
+        if len(online) <= 1:
+            results = [await shard.push_shared(uid, recipients[uid], shared, trace) for shard, uid in online]
+        else:
+            sem = asyncio.Semaphore(self.concurrency)
+
+            async def _push(shard: WSShard, uid: str) -> bool:
+                async with sem:
+                    return await shard.push_shared(uid, recipients[uid], shared, trace)
+            results = await asyncio.gather(*(_push(shard, uid) for shard, uid in online))
+        return sum(results)
+
+    async def push_shared_batch(self, batch: List[Tuple[SharedEvent, Dict[str, str]]]) -> List[int]:
+        """push_shared for several (event, recipients) at once, as for a batch
+        send: offline recipients get all their events in one enqueue per shard
+        and each online recipient gets its events in order from a single push
+        task. Returns how many were reached online for each event."""
+        users: Dict[str, str] = {}
+        for _, recipients in batch:
+            users.update(recipients)
+        reached = [0] * len(batch)
+        online = []
+        for shard, user_ids in ws_manager.group_by_shard(users).items():
+            offline = set()
+            for user_id in user_ids:
+                if shard.is_online(user_id):
+                    online.append((shard, user_id))
+                else:
+                    offline.add(user_id)
+            if offline:
+                shard.enqueue([
+                    (user_id, shared.event_for(username))
+                    for shared, recipients in batch
+                    for user_id, username in recipients.items() if user_id in offline
+                ])
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _push(shard: WSShard, uid: str):
+            async with sem:
+                for i, (shared, recipients) in enumerate(batch):
+                    if uid in recipients and await shard.push_shared(uid, recipients[uid], shared):
+                        reached[i] += 1
+        await asyncio.gather(*(_push(shard, uid) for shard, uid in online))
+        return reached
+
+    async def drain(self):
+        """Wait for all outstanding fan-outs (shutdown, tests)."""
+        while self._chat_tail:
+            await asyncio.wait(list(self._chat_tail.values()))
+
+
+fanout = FanoutDispatcher(FANOUT_CONCURRENCY)
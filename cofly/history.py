@@ -0,0 +1,88 @@
+from bisect import insort
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from config import HISTORY_CACHE_CHATS, HISTORY_CACHE_DEPTH
+
+# (created_at, message_id): history order, ties broken by id as in the range queries
+Key = Tuple[datetime, str]
+
+
+def key_of(msg) -> Key:
+    # Stored datetimes come back naive; fresh ones carry UTC
+    return msg.created_at.replace(tzinfo=None), msg.id
+
+
+class RecentWindow:
+    """A chat's newest messages as message list items, oldest first."""
+
+    __slots__ = ("keys", "items", "complete")
+
+    def __init__(self, keys: List[Key], items: List[dict], complete: bool):
+        self.keys = keys
+        self.items = items
+        # True when the chat has no messages older than these
+        self.complete = complete
+
+    def index(self, message_id: str) -> Optional[int]:
+        for i in range(len(self.keys) - 1, -1, -1):
+            if self.keys[i][1] == message_id:
+                return i
+        return None
+
+
+class RecentMessages:
+    """LRU of chat_id -> RecentWindow for the context-window endpoint.
+
+    A window only comes from load() with the chat's newest `depth` messages;
+    from then on the write path keeps it current: add() after a send commits,
+    update() after an edit. Items are shared by every reader and must not be
+    mutated. The GC deletes old messages behind the cache's back, so it clears it.
+    """
+
+    def __init__(self, chats: int, depth: int):
+        self.chats = chats
+        self.depth = depth
+        self._windows: "OrderedDict[str, RecentWindow]" = OrderedDict()
+
+    def get(self, chat_id: str) -> Optional[RecentWindow]:
+        window = self._windows.get(chat_id)
+        if window is not None:
+            self._windows.move_to_end(chat_id)
+        return window
+
+    def load(self, chat_id: str, keyed_items: List[Tuple[Key, dict]], complete: bool) -> RecentWindow:
+        window = RecentWindow([k for k, _ in keyed_items], [item for _, item in keyed_items], complete)
+        self._windows[chat_id] = window
+        if len(self._windows) > self.chats:
+            self._windows.popitem(last=False)
+        return window
+
+    def add(self, chat_id: str, key: Key, item: dict):
+        window = self._windows.get(chat_id)
+        if window is None:
+            return
+        if not window.keys or key > window.keys[-1]:
+            window.keys.append(key)
+            window.items.append(item)
+        else:
+            # A concurrent send committed out of created_at order
+            insort(window.keys, key)
+            window.items.insert(window.keys.index(key), item)
+        if len(window.keys) > self.depth:
+            del window.keys[0], window.items[0]
+            window.complete = False
+
+    def update(self, chat_id: str, item: dict):
+        window = self._windows.get(chat_id)
+        if window is not None:
+            i = window.index(item["message_id"])
+            if i is not None:
+                window.items[i] = item
+
+    def clear(self):
+        self._windows.clear()
+
+
+recent_messages = RecentMessages(HISTORY_CACHE_CHATS, HISTORY_CACHE_DEPTH)
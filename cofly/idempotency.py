@@ -0,0 +1,36 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from config import IDEMPOTENCY_CACHE_SIZE
+
+
+class IdempotencyCache:
+    """LRU of (sender_id, uuid) -> response data of the message that key created.
+
+    The unique (sender_id, client_uuid) index on messages is the source of truth;
+    this only lets SDK retry storms skip the database entirely.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: "OrderedDict[Tuple[str, str], dict]" = OrderedDict()
+        self.hits = 0
+
+    def get(self, sender_id: str, key: str) -> Optional[dict]:
+        data = self._entries.get((sender_id, key))
+        if data is not None:
+            self._entries.move_to_end((sender_id, key))
+            self.hits += 1
+        return data
+
+    def put(self, sender_id: str, key: str, data: dict):
+        self._entries[(sender_id, key)] = data
+        self._entries.move_to_end((sender_id, key))
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE)
@@ -0,0 +1,137 @@
+"""Event-loop lag sampling, stall stacks, and load shedding.
+
+Everything in Cofly shares one asyncio loop, so one blocking call (a sync DB
+query in an async handler, a big JSON encode) delays every WS connection at
+once. The sampler schedules a timer every LOOP_LAG_INTERVAL_MS and records how
+late it fires. A watchdog thread notices when the sampler stops firing
+altogether and logs the loop thread's stack, which points at the blocking
+call while it is still blocking.
+
+Lag at or above LOOP_SHED_LAG_MS turns on shedding for LOOP_SHED_HOLD_S:
+callers check `sheds(kind)` for the kinds listed in COFLY_LOOP_SHED and
+reject or defer that work with a retry hint from `retry_after()`.
+"""
+
+import asyncio
+import logging
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import LOOP_LAG_INTERVAL_MS, LOOP_SHED, LOOP_SHED_HOLD_S, LOOP_SHED_LAG_MS, LOOP_STALL_MS
+from metrics import LOAD_SHED, LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger("cofly.loop")
+
+QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+class LoopMonitor:
+    def __init__(self, interval_ms: float, stall_ms: float, shed_lag_ms: float,
+                 shed_hold_s: float, shed: str, window: int = 600):
+        self.interval = interval_ms / 1000
+        self.stall = stall_ms / 1000
+        self.shed_lag = shed_lag_ms / 1000
+        self.shed_hold = shed_hold_s
+        self.shed_kinds = {k.strip() for k in shed.split(",") if k.strip()}
+        # Recent lag samples (seconds), for the quantile gauge
+        self.samples = deque(maxlen=window)
+        self._beat = time.perf_counter()
+        self._shed_until = 0.0
+        self._stall_logged = False
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        self._loop_thread = 0
+
+    def start(self):
+        """Start sampling the running loop (call from the loop thread)."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        if self.stall > 0:
+            self._stop.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="cofly-loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    async def _sample(self):
+        while True:
+            scheduled = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self.record(max(0.0, now - scheduled), now)
+
+    def record(self, lag: float, now: Optional[float] = None):
+        now = time.perf_counter() if now is None else now
+        self._beat = now
+        self._stall_logged = False
+        self.samples.append(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+        if self.shed_lag > 0 and lag >= self.shed_lag:
+            self._start_shedding(now, lag)
+
+    def _start_shedding(self, now: float, lag: float):
+        if not self.shedding():
+            logger.warning("loop lag %.0f ms: shedding %s for %.0fs",
+                           lag * 1000, ",".join(sorted(self.shed_kinds)) or "nothing", self.shed_hold)
+        self._shed_until = max(self._shed_until, now + self.shed_hold)
+
+    def _watch(self):
+        # Runs in its own thread: while the loop is blocked the sampler can't
+        # run, so only this thread can see the stall as it happens.
+        while not self._stop.wait(min(self.interval, self.stall / 2)):
+            now = time.perf_counter()
+            behind = now - self._beat - self.interval
+            if behind < self.stall or self._stall_logged:
+                continue
+            self._stall_logged = True
+            LOOP_STALLS.inc()
+            if self.shed_lag > 0 and behind >= self.shed_lag:
+                self._start_shedding(now, behind)
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            logger.warning("event loop blocked for %.0f ms, loop thread stack:\n%s", behind * 1000, stack)
+
+    def shedding(self) -> bool:
+        return time.perf_counter() < self._shed_until
+
+    def sheds(self, kind: str) -> bool:
+        """Whether `kind` of work should be rejected or deferred right now;
+        counts the shed when it should."""
+        if kind not in self.shed_kinds or not self.shedding():
+            return False
+        LOAD_SHED.labels(kind).inc()
+        return True
+
+    def retry_after(self) -> int:
+        """Whole seconds until shedding ends (at least 1)."""
+        return max(1, math.ceil(self._shed_until - time.perf_counter()))
+
+    def quantiles(self) -> Dict[Tuple[str, ...], float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {
+            (str(q),): ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            for q in QUANTILES
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL_MS, LOOP_STALL_MS, LOOP_SHED_LAG_MS, LOOP_SHED_HOLD_S, LOOP_SHED)
@@ -1,45 +1,90 @@
 import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 
 from fastapi import FastAPI
 
-from database import engine, Base, SessionLocal
+import query_stats
+from config import WEBHOOK_DRAIN_S
+from database import SessionLocal, engine, init_db
+from fanout import fanout
+from history import recent_messages
+from loop_monitor import loop_monitor
+from metrics import GC_DELETED, GC_LAST_RUN, GC_RUNS, GC_SECONDS
+from middleware import RequestMetricsMiddleware
 from models import Message
-from routers import auth_router, message_router, contact_router, chat_router, ws_router, media_router, reaction_router
+from routers import (
+    auth_router, message_router, contact_router, chat_router, ws_router, media_router, reaction_router,
+    search_router, metrics_router, trace_router, events_router, webhook_router,
+)
+from search import init_index, unindex_older_than
+from webhooks import webhooks
+from ws_manager import ws_manager
 
 logger = logging.getLogger("cofly.gc")
 
 GC_INTERVAL_HOURS = 1
 GC_MAX_AGE_DAYS = 2
+# While the loop is shedding load, a due GC run is retried after this long
+GC_DEFER_SECONDS = 60
 
 
 async def _message_gc_loop():
     """Periodically delete messages older than GC_MAX_AGE_DAYS."""
     while True:
         await asyncio.sleep(GC_INTERVAL_HOURS * 3600)
+        while loop_monitor.sheds("gc"):
+            GC_RUNS.labels("deferred").inc()
+            logger.info("GC: deferred, event loop is lagging")
+            await asyncio.sleep(GC_DEFER_SECONDS)
+        start = time.perf_counter()
         try:
             db = SessionLocal()
             cutoff = datetime.now(timezone.utc) - timedelta(days=GC_MAX_AGE_DAYS)
+            unindex_older_than(db, cutoff)
             count = db.query(Message).filter(Message.created_at < cutoff).delete()
             db.commit()
             db.close()
+            if count:
+                recent_messages.clear()
+            GC_RUNS.labels("ok").inc()
+            GC_DELETED.inc(count)
             if count:
                 logger.info("GC: deleted %d messages older than %s", count, cutoff.isoformat())
         except Exception as e:
+            GC_RUNS.labels("error").inc()
             logger.error("GC: error: %s", e)
+        GC_SECONDS.observe(time.perf_counter() - start)
+        GC_LAST_RUN.set(time.time())
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    Base.metadata.create_all(bind=engine)
+    init_db()
+    init_index(engine)
+    db = SessionLocal()
+    try:
+        webhooks.load(db)
+    finally:
+        db.close()
+    loop_monitor.start()
     gc_task = asyncio.create_task(_message_gc_loop())
+    reaper_task = asyncio.create_task(ws_manager.run_reaper())
     yield
     gc_task.cancel()
+    reaper_task.cancel()
+    await loop_monitor.stop()
+    await message_router.patch_coalescer.flush_all()
+    await fanout.drain()
+    await webhooks.drain(WEBHOOK_DRAIN_S)
+    await webhooks.close()
 
 
 app = FastAPI(title="Cofly", lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
+query_stats.install(engine)
 
 app.include_router(auth_router.router)
 app.include_router(message_router.router)
@@ -48,6 +93,11 @@ app.include_router(chat_router.router)
 app.include_router(ws_router.router)
 app.include_router(media_router.router)
 app.include_router(reaction_router.router)
+app.include_router(search_router.router)
+app.include_router(metrics_router.router)
+app.include_router(trace_router.router)
+app.include_router(events_router.router)
+app.include_router(webhook_router.router)
 
 
 @app.get("/")
@@ -0,0 +1,299 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Updates are plain attribute increments with no locks, so instrumentation is
+cheap enough to stay on in production. Threadpool handlers may race an
+increment now and then; an occasionally lost sample is an accepted trade-off
+for never blocking the event loop. Gauges that describe current state
+(connections, queue depth) are computed when /metrics is scraped instead of
+being maintained on the hot path.
+"""
+
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Seconds; spans sub-millisecond pushes up to multi-second requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [("", _format_labels(self.labelnames, k), c.value) for k, c in self._children.items()]
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    """A gauge; with `collect`, its samples are computed at scrape time from a
+    function returning {label_values_tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help, labelnames)
+        self._collect = collect
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self._collect is not None:
+            values = self._collect().items()
+        else:
+            values = ((k, c.value) for k, c in self._children.items())
+        return [("", _format_labels(self.labelnames, k), v) for k, v in values]
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.bounds = tuple(sorted(buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        samples = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, n in zip(self.bounds, child.counts):
+                cumulative += n
+                le = 'le="' + _format_value(float(bound)) + '"'
+                samples.append(("_bucket", _format_labels(self.labelnames, key, le), cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append(("_sum", labels, child.sum))
+            samples.append(("_count", labels, child.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, collect))
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Event loop ---
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "cofly_event_loop_lag_seconds", "How late the loop ran a timer scheduled by the lag sampler.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+LOOP_STALLS = REGISTRY.counter("cofly_event_loop_stalls_total", "Loop stalls whose stack was logged.")
+LOAD_SHED = REGISTRY.counter(
+    "cofly_load_shed_total", "Work rejected or deferred because of loop lag.", ("kind",),
+)
+
+# --- HTTP / DB ---
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "cofly_http_request_duration_seconds", "HTTP request latency by route.",
+    ("method", "route", "status"),
+)
+DB_QUERIES = REGISTRY.counter("cofly_db_queries_total", "SQL statements executed.")
+HISTORY_CACHE = REGISTRY.counter(
+    "cofly_history_cache_total", "Context-window requests served from the recent-messages cache (hit / miss).",
+    ("outcome",),
+)
+DB_QUERY_SECONDS = REGISTRY.histogram("cofly_db_query_duration_seconds", "SQL statement latency.")
+DB_QUERIES_PER_REQUEST = REGISTRY.histogram(
+    "cofly_db_queries_per_request", "SQL statements issued per HTTP request.", ("route",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+DB_SECONDS_PER_REQUEST = REGISTRY.histogram(
+    "cofly_db_request_duration_seconds", "Total SQL time per HTTP request.", ("route",),
+)
+
+# --- WebSocket ---
+WS_HANDSHAKES = REGISTRY.counter(
+    "cofly_ws_handshakes_total", "ws_endpoint and /ws handshakes by admission outcome.", ("outcome",),
+)
+WS_REAPED = REGISTRY.counter("cofly_ws_reaped_total", "Connections closed for missing heartbeats.")
+WEBHOOK_POSTS = REGISTRY.counter("cofly_webhook_posts_total", "Webhook POSTs by outcome (ok / failed).",
+                                 ("outcome",))
+WEBHOOK_POST_SECONDS = REGISTRY.histogram("cofly_webhook_post_duration_seconds", "Webhook POST latency.")
+WEBHOOK_EVENTS = REGISTRY.counter(
+    "cofly_webhook_events_total", "Events delivered by webhook, or moved to the offline queue (fallback).",
+    ("outcome",),
+)
+HTTP_EVENTS = REGISTRY.counter(
+    "cofly_http_events_delivered_total", "Events delivered over SSE / long-poll.", ("transport",),
+)
+
+PUSH_SECONDS = REGISTRY.histogram("cofly_push_duration_seconds", "push_event latency per recipient.")
+PUSH_OUTCOMES = REGISTRY.counter(
+    "cofly_push_total", "push_event outcomes (delivered / queued / failed).", ("outcome",),
+)
+PENDING_COMPACTED = REGISTRY.counter(
+    "cofly_pending_compacted_total",
+    "Offline update events folded into a queued update (replaced) or receive event (merged).", ("how",),
+)
+LANE_FRAMES = REGISTRY.counter(
+    "cofly_ws_lane_frames_total", "Frames that waited in an outbound lane (queued / coalesced / dropped).",
+    ("lane", "outcome"),
+)
+LANE_DEPTH = REGISTRY.gauge("cofly_ws_lane_queued_frames", "Frames waiting in outbound lanes.", ("lane",))
+LANE_WAIT_SECONDS = REGISTRY.histogram(
+    "cofly_ws_lane_wait_seconds", "Time a queued frame waited in its lane before being written.", ("lane",),
+)
+FRAME_ENCODE_SECONDS = REGISTRY.histogram(
+    "cofly_frame_encode_duration_seconds", "Event frame encoding time.", ("kind",),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01),
+)
+
+# --- Auth ---
+BCRYPT_SECONDS = REGISTRY.histogram(
+    "cofly_bcrypt_duration_seconds", "bcrypt hash/verify time.", ("op",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5),
+)
+
+# --- Message GC ---
+GC_RUNS = REGISTRY.counter("cofly_gc_runs_total", "Message GC runs.", ("outcome",))
+GC_DELETED = REGISTRY.counter("cofly_gc_deleted_messages_total", "Messages deleted by GC.")
+GC_SECONDS = REGISTRY.histogram("cofly_gc_duration_seconds", "Message GC run time.")
+GC_LAST_RUN = REGISTRY.gauge("cofly_gc_last_run_timestamp_seconds", "Unix time of the last GC run.")
@@ -0,0 +1,37 @@
+import time
+
+import query_stats
+from metrics import DB_QUERIES_PER_REQUEST, DB_SECONDS_PER_REQUEST, HTTP_REQUEST_SECONDS
+
+
+class RequestMetricsMiddleware:
+    """Records latency and SQL usage per HTTP request, labelled by the matched
+    route template (not the raw path) to keep label cardinality bounded."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        # request.state.received_at: start of the request on the monotonic clock
+        scope.setdefault("state", {})["received_at"] = start
+        stats = query_stats.begin(scope["path"])
+        status = 500
+
+        async def _send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, status).observe(time.perf_counter() - start)
+            DB_QUERIES_PER_REQUEST.labels(route).observe(stats.count)
+            DB_SECONDS_PER_REQUEST.labels(route).observe(stats.seconds)
+            query_stats.log_if_slow(stats, route)
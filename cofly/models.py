@@ -1,7 +1,7 @@
 import uuid
 from datetime import datetime, timezone
 
-from sqlalchemy import Column, Text, DateTime, ForeignKey, LargeBinary, PrimaryKeyConstraint
+from sqlalchemy import Column, Text, Integer, DateTime, ForeignKey, LargeBinary, PrimaryKeyConstraint, Index
 
 from database import Base
 
@@ -41,6 +41,15 @@ class Chat(Base):
     name = Column(Text, default="")
     owner_id = Column(Text, nullable=True)
     created_at = Column(DateTime, default=_now)
+    # Denormalized summary of the newest message, maintained by the write path
+    # so the chat list can be served without touching the messages table.
+    last_message_id = Column(Text, nullable=True)
+    last_message_type = Column(Text, nullable=True)
+    last_message_preview = Column(Text, nullable=True)
+    last_sender_id = Column(Text, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    # seq of the chat's newest message; sends claim the next ones from it
+    last_seq = Column(Integer, default=0, server_default="0")
 
 
 class ChatMember(Base):
@@ -48,7 +57,12 @@ class ChatMember(Base):
     chat_id = Column(Text, ForeignKey("chats.id"), nullable=False)
     user_id = Column(Text, ForeignKey("users.id"), nullable=False)
     joined_at = Column(DateTime, default=_now)
-    __table_args__ = (PrimaryKeyConstraint("chat_id", "user_id"),)
+    # Read cursor: messages created after this are unread for the member
+    last_read_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        PrimaryKeyConstraint("chat_id", "user_id"),
+        Index("ix_chat_members_user_id", "user_id"),
+    )
 
 
 class Message(Base):
@@ -61,6 +75,29 @@ class Message(Base):
     root_id = Column(Text, default="")
     parent_id = Column(Text, default="")
     created_at = Column(DateTime, default=_now)
+    # Bumped on every persisted edit; delta update events are relative to it
+    version = Column(Integer, default=0, server_default="0")
+    # Client-supplied idempotency key (SendMessageRequest.uuid / ReplyMessageRequest.uuid)
+    client_uuid = Column(Text, nullable=True)
+    # 1, 2, 3, ... within the chat in commit order, for gap detection and since_seq sync
+    seq = Column(Integer, nullable=True)
+    __table_args__ = (
+        Index("ix_messages_chat_created", "chat_id", "created_at"),
+        Index("ix_messages_chat_seq", "chat_id", "seq", unique=True),
+        Index("ix_messages_sender_uuid", "sender_id", "client_uuid", unique=True),
+        # Thread retrieval: every reply carries its thread's root_id
+        Index("ix_messages_root_created", "root_id", "created_at"),
+    )
+
+
+class Webhook(Base):
+    """Where events for the user are POSTed while it has no open connection."""
+    __tablename__ = "webhooks"
+    user_id = Column(Text, ForeignKey("users.id"), primary_key=True)
+    url = Column(Text, nullable=False)
+    # Signs each POST body (X-Cofly-Signature) when set
+    secret = Column(Text, default="")
+    created_at = Column(DateTime, default=_now)
 
 
 class Media(Base):
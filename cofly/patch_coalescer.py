@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("cofly.patch")
+
+# (sender_id, msg_type, content)
+PatchState = Tuple[str, str, str]
+
+
+class PatchCoalescer:
+    """Coalesces bursts of PATCHes to the same message (streamed bot replies).
+
+    The first patch after an idle period is applied immediately by the caller and
+    opens a window. Patches arriving inside the window only replace the buffered
+    state; when the window closes the latest state is flushed (one DB write and one
+    update event per member) and a new window opens. A window with nothing
+    buffered closes, so the last patch of a stream is always flushed.
+
+    Applying a state (window flush, flush_now from a read, or the caller's
+    immediate apply) holds the message's lock through the DB write and the
+    pushes, so every member sees the versions in order.
+    """
+
+    def __init__(self, window_ms: int, flush: Callable[[str, PatchState], Awaitable[None]]):
+        self.window = window_ms / 1000
+        self._flush = flush
+        self._windows: Dict[str, asyncio.Task] = {}
+        self._latest: Dict[str, PatchState] = {}
+        # message_id -> [lock, holders and waiters]
+        self._locks: Dict[str, List] = {}
+        self.submitted = 0
+        self.flushed = 0
+
+    def pending(self, message_id: str) -> Optional[PatchState]:
+        """Buffered state not yet persisted."""
+        return self._latest.get(message_id)
+
+    @asynccontextmanager
+    async def serialized(self, message_id: str):
+        """Hold while applying and pushing a state of message_id."""
+        entry = self._locks.get(message_id)
+        if entry is None:
+            entry = self._locks[message_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[message_id]
+
+    async def flush_now(self, message_id: str) -> bool:
+        """Persist buffered state immediately (read-your-writes); the window stays open."""
+        if message_id not in self._latest:
+            return False
+        return await self._flush_latest(message_id)
+
+    async def _flush_latest(self, message_id: str) -> bool:
+        # Pop under the lock: whoever flushes later applies the later state
+        async with self.serialized(message_id):
+            state = self._latest.pop(message_id, None)
+            if state is None:
+                return False
+            await self._do_flush(message_id, state)
+            return True
+
+    def submit(self, message_id: str, sender_id: str, msg_type: str, content: str) -> bool:
+        """Returns True if the patch was buffered; False means the caller must apply it now."""
+        self.submitted += 1
+        if self.window <= 0:
+            self.flushed += 1
+            return False
+        timer = self._windows.get(message_id)
+        if timer is None or timer.done():
+            self._windows[message_id] = asyncio.create_task(self._run_window(message_id))
+            self.flushed += 1
+            return False
+        self._latest[message_id] = (sender_id, msg_type, content)
+        return True
+
+    async def _run_window(self, message_id: str):
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                if not await self._flush_latest(message_id):
+                    break
+        finally:
+            if self._windows.get(message_id) is asyncio.current_task():
+                del self._windows[message_id]
+
+    async def _do_flush(self, message_id: str, state: PatchState):
+        self.flushed += 1
+        try:
+            await self._flush(message_id, state)
+        except Exception as e:
+            logger.error("patch flush failed for message_id=%s: %s", message_id, e)
+
+    async def flush_all(self):
+        """Cancel open windows and flush whatever they still buffer (shutdown)."""
+        for task in list(self._windows.values()):
+            task.cancel()
+        self._windows.clear()
+        while self._latest:
+            await self._flush_latest(next(iter(self._latest)))
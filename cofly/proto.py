@@ -4,6 +4,10 @@ import time
 import uuid
 
 import pbbp2_pb2
+from metrics import FRAME_ENCODE_SECONDS
+
+_ENCODE_EVENT = FRAME_ENCODE_SECONDS.labels("event")
+_ENCODE_PAYLOAD = FRAME_ENCODE_SECONDS.labels("payload")
 
 
 def _encode_varint(value):
@@ -71,14 +75,9 @@ def get_header(frame: pbbp2_pb2.Frame, key: str) -> str:
     return ""
 
 
-def make_pong_frame(ping_frame: pbbp2_pb2.Frame) -> bytes:
+def make_pong_frame(ping_frame: pbbp2_pb2.Frame, client_config: dict) -> bytes:
     # SDK parses pong payload as JSON to update ClientConfig
-    pong_payload = json.dumps({
-        "PingInterval": 120,
-        "ReconnectCount": 10,
-        "ReconnectInterval": 3,
-        "ReconnectNonce": 5,
-    })
+    pong_payload = json.dumps(client_config)
     return make_frame(
         seq_id=ping_frame.SeqID,
         method=0,
@@ -89,8 +88,22 @@ def make_pong_frame(ping_frame: pbbp2_pb2.Frame) -> bytes:
 
 
 def make_event_frame(event_json: dict, seq_id: int = 0) -> bytes:
+    start = time.perf_counter()
     message_id = event_json.get("event", {}).get("message", {}).get("message_id", "")
-    payload = json.dumps(event_json).encode()
+    frame = _payload_frame(json.dumps(event_json).encode(), message_id, seq_id)
+    _ENCODE_EVENT.observe(time.perf_counter() - start)
+    return frame
+
+
+def make_payload_frame(payload: bytes, message_id: str = "", seq_id: int = 0) -> bytes:
+    """Event frame around an already-encoded JSON payload."""
+    start = time.perf_counter()
+    frame = _payload_frame(payload, message_id, seq_id)
+    _ENCODE_PAYLOAD.observe(time.perf_counter() - start)
+    return frame
+
+
+def _payload_frame(payload: bytes, message_id: str, seq_id: int) -> bytes:
     return make_frame(
         seq_id=seq_id,
         method=1,
@@ -0,0 +1,116 @@
+"""Per-request SQL accounting via SQLAlchemy engine events.
+
+The HTTP middleware opens a QueryStats for each request in a context variable;
+threadpool handlers run in a copy of that context, so statements issued from
+sync endpoints are attributed to the right request as well.
+"""
+
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from sqlalchemy import event
+
+from config import SLOW_QUERY_MS
+from metrics import DB_QUERIES, DB_QUERY_SECONDS
+
+logger = logging.getLogger("cofly.sql")
+
+# Statements are truncated in logs and assertion messages
+_STATEMENT_MAX_CHARS = 500
+
+
+class QueryStats:
+    __slots__ = ("path", "count", "seconds", "slowest", "slowest_statement")
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = ""
+
+
+_current: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar("cofly_query_stats", default=None)
+
+
+def begin(path: str = "") -> QueryStats:
+    stats = QueryStats(path)
+    _current.set(stats)
+    return stats
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+def _short(statement: str) -> str:
+    statement = " ".join(statement.split())
+    if len(statement) > _STATEMENT_MAX_CHARS:
+        statement = statement[:_STATEMENT_MAX_CHARS] + "…"
+    return statement
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("cofly_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["cofly_query_start"].pop()
+    DB_QUERIES.inc()
+    DB_QUERY_SECONDS.observe(elapsed)
+    stats = _current.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+        if elapsed > stats.slowest:
+            stats.slowest = elapsed
+            stats.slowest_statement = statement
+    # Parameters are never logged: they carry message bodies and password hashes
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow query: %.1f ms [%s] %s", elapsed * 1000,
+                       stats.path if stats else "-", _short(statement))
+
+
+def log_if_slow(stats: QueryStats, route: str):
+    """Summarize a request whose SQL time crossed the slow-query threshold."""
+    if SLOW_QUERY_MS and stats.seconds * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow request: %s: %d queries, %.1f ms in DB, slowest %.1f ms: %s",
+                       route, stats.count, stats.seconds * 1000, stats.slowest * 1000,
+                       _short(stats.slowest_statement))
+
+
+def install(engine):
+    """Attach the statement timers to an engine (idempotent)."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def assert_max_queries(engine, limit: int):
+    """Fail if the block issues more than `limit` statements on `engine`, from
+    any thread. Yields the list of statements issued so far.
+
+        with assert_max_queries(engine, 3):
+            client.get("/open-apis/im/v1/chats")
+    """
+    statements: List[str] = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    if len(statements) > limit:
+        listing = "\n".join(f"  {i + 1}. {_short(s)}" for i, s in enumerate(statements))
+        raise QueryBudgetExceeded(f"{len(statements)} queries, budget {limit}:\n{listing}")
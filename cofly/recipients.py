@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from sqlalchemy.orm import Session
+
+from config import RECIPIENT_CACHE_CHATS
+from models import ChatMember, User
+
+
+class RecipientCache:
+    """LRU of chat_id -> {user_id: username} used by message fan-out.
+
+    Every membership change must call invalidate(chat_id). Group endpoints run
+    in the threadpool while fan-out reads on the event loop, so every touch of
+    the LRU is under a lock, and a member list loaded across an invalidation
+    is returned but not cached. The lock is never held over the query.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._members: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db: Session, chat_id: str) -> Dict[str, str]:
+        with self._lock:
+            members = self._members.get(chat_id)
+            if members is not None:
+                self._members.move_to_end(chat_id)
+                self.hits += 1
+                return members
+            self.misses += 1
+            generation = self._generation
+        members = dict(
+            db.query(ChatMember.user_id, User.username)
+            .join(User, User.id == ChatMember.user_id)
+            .filter(ChatMember.chat_id == chat_id)
+            .order_by(ChatMember.joined_at)
+            .all()
+        )
+        with self._lock:
+            if generation == self._generation:
+                self._members[chat_id] = members
+                if len(self._members) > self.capacity:
+                    self._members.popitem(last=False)
+        return members
+
+    def invalidate(self, chat_id: str):
+        with self._lock:
+            self._generation += 1
+            self._members.pop(chat_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._members.clear()
+
+
+recipient_cache = RecipientCache(RECIPIENT_CACHE_CHATS)
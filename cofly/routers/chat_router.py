@@ -1,31 +1,263 @@
-from fastapi import APIRouter, Depends
+import base64
+import calendar
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import APIRouter, Body, Depends, Query
+from sqlalchemy import DateTime, and_, func, or_, select
 from sqlalchemy.orm import Session
 
 from auth import get_current_user
 from database import get_db
-from models import User, Chat, ChatMember
+from models import User, Chat, ChatMember, Message
+from recipients import recipient_cache
+from schemas import CreateChatRequest, ChatMembersRequest
 
 router = APIRouter()
 
 
+def _ms(dt: datetime) -> str:
+    return str(int(calendar.timegm(dt.timetuple()) * 1000))
+
+
+def _encode_page_token(sort_key: datetime, chat_id: str) -> str:
+    raw = f"{sort_key.isoformat()}|{chat_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_page_token(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token.encode()).decode()
+        key, chat_id = raw.split("|", 1)
+        return datetime.fromisoformat(key), chat_id
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
 @router.get("/open-apis/im/v1/chats")
 def list_chats(
+    page_size: int = Query(100, ge=1, le=500),
+    page_token: str = Query(""),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    memberships = db.query(ChatMember).filter(ChatMember.user_id == user.id).all()
+    """List the caller's chats, most recently active first, with the last message
+    preview and unread count. Served by a single query over chat_members/chats;
+    unread counts come from a correlated count against the member's read cursor."""
+    unread = (
+        select(func.count(Message.id))
+        .where(
+            Message.chat_id == Chat.id,
+            Message.sender_id != user.id,
+            or_(ChatMember.last_read_at.is_(None), Message.created_at > ChatMember.last_read_at),
+        )
+        .correlate(Chat, ChatMember)
+        .scalar_subquery()
+    )
+    sort_key = func.coalesce(Chat.last_message_at, Chat.created_at, type_=DateTime)
+
+    query = (
+        db.query(Chat, sort_key, unread)
+        .join(ChatMember, ChatMember.chat_id == Chat.id)
+        .filter(ChatMember.user_id == user.id)
+    )
+    if page_token:
+        cursor = _decode_page_token(page_token)
+        if cursor is None:
+            return {"code": 1, "msg": "invalid page_token", "data": {}}
+        key, chat_id = cursor
+        query = query.filter(or_(sort_key < key, and_(sort_key == key, Chat.id < chat_id)))
+    rows = query.order_by(sort_key.desc(), Chat.id.desc()).limit(page_size + 1).all()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
     items = []
-    for m in memberships:
-        chat = db.query(Chat).filter(Chat.id == m.chat_id).first()
-        if chat:
-            items.append({
-                "chat_id": chat.id,
-                "chat_type": chat.chat_type,
-                "name": chat.name,
-                "owner_id": chat.owner_id or "",
-            })
+    for chat, _, unread_count in rows:
+        last_message = None
+        if chat.last_message_id:
+            last_message = {
+                "message_id": chat.last_message_id,
+                "msg_type": chat.last_message_type,
+                "preview": chat.last_message_preview or "",
+                "sender_id": chat.last_sender_id or "",
+                "create_time": _ms(chat.last_message_at),
+            }
+        items.append({
+            "chat_id": chat.id,
+            "chat_type": chat.chat_type,
+            "name": chat.name,
+            "owner_id": chat.owner_id or "",
+            "last_message": last_message,
+            "unread_count": unread_count,
+        })
     return {"code": 0, "msg": "ok", "data": {
         "items": items,
-        "has_more": False,
-        "page_token": "",
+        "has_more": has_more,
+        "page_token": _encode_page_token(rows[-1][1], rows[-1][0].id) if has_more else "",
+    }}
+
+
+@router.post("/cofly/chats/{chat_id}/read")
+def mark_chat_read(
+    chat_id: str,
+    message_id: Optional[str] = Query(None),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Advance the caller's read cursor to message_id (or to now)."""
+    member = (
+        db.query(ChatMember)
+        .filter(ChatMember.chat_id == chat_id, ChatMember.user_id == user.id)
+        .first()
+    )
+    if not member:
+        return {"code": 1, "msg": "not a member of this chat", "data": {}}
+    if message_id:
+        msg = (
+            db.query(Message)
+            .filter(Message.id == message_id, Message.chat_id == chat_id)
+            .first()
+        )
+        if not msg:
+            return {"code": 1, "msg": "message not found", "data": {}}
+        read_at = msg.created_at
+    else:
+        # SQLite stores naive UTC; compare like with like
+        read_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    # Cursors only move forward
+    if member.last_read_at is None or read_at > member.last_read_at:
+        member.last_read_at = read_at
+        db.commit()
+    return {"code": 0, "msg": "ok", "data": {}}
+
+
+def _utcnow() -> datetime:
+    # SQLite stores naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _add_members(db: Session, chat: Chat, ids: List[str]):
+    """Add users to a chat; returns (added_ids, not_existed_ids). Existing members are skipped."""
+    ids = list(dict.fromkeys(ids))
+    existing = {u for (u,) in db.query(User.id).filter(User.id.in_(ids))}
+    members = {
+        u for (u,) in db.query(ChatMember.user_id)
+        .filter(ChatMember.chat_id == chat.id, ChatMember.user_id.in_(ids))
+    }
+    # New members start with everything before their join marked read
+    now = _utcnow()
+    added = [u for u in ids if u in existing and u not in members]
+    db.add_all([ChatMember(chat_id=chat.id, user_id=u, joined_at=now, last_read_at=now) for u in added])
+    return added, [u for u in ids if u not in existing]
+
+
+def _group_for_member(db: Session, chat_id: str, user_id: str):
+    """(chat, error_response) for a group chat the user belongs to."""
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    if not chat:
+        return None, {"code": 1, "msg": "chat not found", "data": {}}
+    if chat.chat_type != "group":
+        return None, {"code": 1, "msg": "chat is not a group", "data": {}}
+    if user_id not in recipient_cache.get(db, chat_id):
+        return None, {"code": 1, "msg": "not a member of this chat", "data": {}}
+    return chat, None
+
+
+@router.post("/open-apis/im/v1/chats")
+def create_chat(
+    req: CreateChatRequest,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Create a group chat owned by the caller. Bots are users in Cofly, so
+    user_id_list and bot_id_list are treated alike."""
+    chat = Chat(chat_type="group", name=req.name, owner_id=user.id)
+    db.add(chat)
+    db.flush()
+    _, not_existed = _add_members(db, chat, [user.id] + req.user_id_list + req.bot_id_list)
+    db.commit()
+    return {"code": 0, "msg": "ok", "data": {
+        "chat_id": chat.id,
+        "name": chat.name,
+        "owner_id": chat.owner_id,
+        "owner_id_type": "open_id",
+        "chat_mode": "group",
+        "invalid_id_list": not_existed,
+    }}
+
+
+@router.post("/open-apis/im/v1/chats/{chat_id}/members")
+def add_chat_members(
+    chat_id: str,
+    req: ChatMembersRequest,
+    member_id_type: str = Query("open_id"),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    if member_id_type not in ("open_id", "user_id"):
+        return {"code": 1, "msg": "unsupported member_id_type", "data": {}}
+    chat, error = _group_for_member(db, chat_id, user.id)
+    if error:
+        return error
+    _, not_existed = _add_members(db, chat, req.id_list)
+    db.commit()
+    recipient_cache.invalidate(chat_id)
+    return {"code": 0, "msg": "ok", "data": {
+        "invalid_id_list": [],
+        "not_existed_id_list": not_existed,
+        "pending_approval_id_list": [],
     }}
+
+
+@router.delete("/open-apis/im/v1/chats/{chat_id}/members")
+def remove_chat_members(
+    chat_id: str,
+    req: ChatMembersRequest = Body(...),
+    member_id_type: str = Query("open_id"),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Remove members. Anyone may remove themselves (leave); only the owner may
+    remove others. When the owner leaves, the longest-standing member takes over."""
+    if member_id_type not in ("open_id", "user_id"):
+        return {"code": 1, "msg": "unsupported member_id_type", "data": {}}
+    chat, error = _group_for_member(db, chat_id, user.id)
+    if error:
+        return error
+    ids = set(req.id_list)
+    if chat.owner_id != user.id and ids - {user.id}:
+        return {"code": 1, "msg": "only the owner can remove other members", "data": {}}
+    members = recipient_cache.get(db, chat_id)
+    db.query(ChatMember).filter(
+        ChatMember.chat_id == chat_id, ChatMember.user_id.in_(ids),
+    ).delete(synchronize_session=False)
+    if chat.owner_id in ids:
+        successor = (
+            db.query(ChatMember.user_id)
+            .filter(ChatMember.chat_id == chat_id)
+            .order_by(ChatMember.joined_at)
+            .first()
+        )
+        chat.owner_id = successor[0] if successor else None
+    db.commit()
+    recipient_cache.invalidate(chat_id)
+    return {"code": 0, "msg": "ok", "data": {
+        "invalid_id_list": [u for u in req.id_list if u not in members],
+    }}
+
+
+@router.patch("/open-apis/im/v1/chats/{chat_id}/members/me_join")
+def join_chat(
+    chat_id: str,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    if not chat:
+        return {"code": 1, "msg": "chat not found", "data": {}}
+    if chat.chat_type != "group":
+        return {"code": 1, "msg": "chat is not a group", "data": {}}
+    _add_members(db, chat, [user.id])
+    db.commit()
+    recipient_cache.invalidate(chat_id)
+    return {"code": 0, "msg": "ok", "data": {}}
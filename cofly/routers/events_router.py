@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from auth import decode_token, get_current_user
+from config import EVENTS_BATCH_MAX, EVENTS_KEEPALIVE_S, EVENTS_POLL_TIMEOUT_S
+from database import get_db
+from metrics import HTTP_EVENTS
+from models import User
+from proto import parse_frame
+from ws_manager import next_cursor, ws_manager
+
+router = APIRouter()
+
+_SSE_EVENTS = HTTP_EVENTS.labels("sse")
+_POLL_EVENTS = HTTP_EVENTS.labels("poll")
+
+
+def _event_user(request: Request, token: str = Query(""), db: Session = Depends(get_db)) -> User:
+    # EventSource can't set headers, so the token may come as ?token= (as for /ws)
+    if request.headers.get("Authorization") or not token:
+        return get_current_user(request, db)
+    user = db.query(User).filter(User.id == decode_token(token)["sub"]).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+
+class StreamSocket:
+    """Stands in for the WebSocket of an SSE connection: events pushed to it
+    are buffered as (cursor, payload) for the response to write, each taking
+    its cursor when pushed. close() (replaced, reaped) ends the stream."""
+
+    def __init__(self):
+        self.frames: asyncio.Queue = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def send_bytes(self, data: bytes):
+        self.frames.put_nowait((next_cursor(), parse_frame(data).payload))
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.frames.put_nowait(None)
+
+
+def sse_chunk(records) -> bytes:
+    """SSE records for (cursor, event JSON) pairs, the cursor as the record's id."""
+    return b"".join(b"id: %d\ndata: %s\n\n" % record for record in records)
+
+
+async def _stream(user_id: str, device_id: str, cursor: int):
+    # Registered here rather than in event_stream, so a client gone before the
+    # body starts leaves no connection behind
+    sock = StreamSocket()
+    conn = ws_manager.register(user_id, sock, device_id=device_id)
+    try:
+        yield b": connected\n\n"
+        # Events queued while offline go out under the cursors they were queued
+        # with; each poll() acks the batch before it, so a client gone mid-way
+        # keeps the rest queued for its Last-Event-ID
+        while True:
+            batch = await ws_manager.poll(user_id, cursor, EVENTS_BATCH_MAX, 0)
+            if not batch:
+                break
+            yield sse_chunk((c, json.dumps(event).encode()) for c, event in batch)
+            _SSE_EVENTS.inc(len(batch))
+            cursor = batch[-1][0]
+        while True:
+            try:
+                record = await asyncio.wait_for(sock.frames.get(), EVENTS_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                conn.last_seen = time.monotonic()
+                yield b": keepalive\n\n"
+                continue
+            records = [record]
+            while len(records) < EVENTS_BATCH_MAX and not sock.frames.empty():
+                records.append(sock.frames.get_nowait())
+            events = [r for r in records if r is not None]
+            if events:
+                yield sse_chunk(events)
+                _SSE_EVENTS.inc(len(events))
+            conn.last_seen = time.monotonic()
+            if len(events) < len(records):
+                break
+    finally:
+        ws_manager.disconnect(conn)
+        # Events not written yet go back to the offline queue under their
+        # cursors, unless another connection of the user got them too
+        leftover = []
+        while not sock.frames.empty():
+            record = sock.frames.get_nowait()
+            if record is not None:
+                leftover.append((record[0], json.loads(record[1])))
+        if leftover and not ws_manager.is_online(user_id):
+            ws_manager.requeue(user_id, leftover)
+
+
+@router.get("/cofly/events/stream")
+async def event_stream(
+    request: Request,
+    cursor: int = Query(0, ge=0),
+    device_id: str = Query(""),
+    user: User = Depends(_event_user),
+):
+    """Server-Sent Events for clients that can't hold a pbbp2 WebSocket. The
+    stream is a connection in the /ws registry: it gets the offline queue on
+    connect and live pushes after that, as `id: <cursor>` / `data: <event JSON>`
+    records. Resuming with Last-Event-ID (or cursor) skips queued events already seen."""
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    if last_event_id.isdigit():
+        cursor = max(cursor, int(last_event_id))
+    return StreamingResponse(_stream(user.id, device_id, cursor), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/cofly/events/poll")
+async def event_poll(
+    cursor: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=EVENTS_BATCH_MAX),
+    timeout: float = Query(EVENTS_POLL_TIMEOUT_S, ge=0, le=EVENTS_POLL_TIMEOUT_S),
+    user: User = Depends(_event_user),
+):
+    """Long-poll on the offline queue: a poller is not online, so its events
+    queue as for any offline user. Returns the events after cursor, waiting up
+    to timeout seconds if there are none; the returned cursor, sent with the
+    next poll, acknowledges (drops) everything up to it."""
+    batch = await ws_manager.poll(user.id, cursor, limit, timeout)
+    _POLL_EVENTS.inc(len(batch))
+    return {"code": 0, "msg": "ok", "data": {
+        "items": [event for _, event in batch],
+        "cursor": batch[-1][0] if batch else cursor,
+    }}
@@ -1,37 +1,73 @@
+import base64
 import calendar
 import uuid
+from functools import partial
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, Depends, Query, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 
 from auth import get_current_user
-from database import get_db
+from content_text import make_preview
+from config import MESSAGE_BATCH_MAX, PATCH_COALESCE_MS
+from database import get_db, SessionLocal
+from fanout import fanout
+from history import key_of, recent_messages
+from idempotency import idempotency_cache
+from metrics import HISTORY_CACHE
+from recipients import recipient_cache
+from search import index_message, index_messages, reindex_message
+from tracing import MessageTrace, tracer
 from models import User, Chat, ChatMember, Message
-from schemas import SendMessageRequest, ReplyMessageRequest, PatchMessageRequest
-from ws_manager import ws_manager, build_message_event, build_message_sync_event, build_message_update_event, build_ack_event
+from patch_coalescer import PatchCoalescer, PatchState
+from schemas import SendMessageRequest, BatchSendRequest, ReplyMessageRequest, PatchMessageRequest
+from deltas import compute_ops
+from ws_manager import (
+    ws_manager, SharedEvent, build_message_event, build_message_sync_event, build_message_update_event,
+    build_message_delta_event, build_ack_event,
+)
 
 router = APIRouter()
 
 
+def message_to_item(msg: Message) -> dict:
+    """Serialize a message in the shape of Feishu's message list/get items."""
+    return {
+        "message_id": msg.id,
+        "chat_id": msg.chat_id,
+        "msg_type": msg.message_type,
+        "body": {"content": msg.content},
+        "sender": {
+            "id": msg.sender_id,
+            "id_type": "open_id",
+            "sender_type": "user",
+            "tenant_key": "cofly",
+        },
+        "root_id": msg.root_id,
+        "parent_id": msg.parent_id,
+        "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
+        "version": msg.version or 0,
+        "seq": msg.seq,
+    }
+
+
 def _find_or_create_p2p_chat(db: Session, user_a_id: str, user_b_id: str) -> Chat:
     """Find existing p2p chat between two users, or create one."""
+    other = aliased(ChatMember)
     existing = (
         db.query(Chat)
         .join(ChatMember, Chat.id == ChatMember.chat_id)
+        .join(other, Chat.id == other.chat_id)
         .filter(Chat.chat_type == "p2p")
-        .filter(ChatMember.user_id == user_a_id)
-        .all()
+        .filter(ChatMember.user_id == user_a_id, other.user_id == user_b_id)
+        .first()
     )
-    for chat in existing:
-        other = (
-            db.query(ChatMember)
-            .filter(ChatMember.chat_id == chat.id, ChatMember.user_id == user_b_id)
-            .first()
-        )
-        if other:
-            return chat
+    if existing:
+        return existing
 
     chat = Chat(chat_type="p2p", owner_id=user_a_id)
     db.add(chat)
@@ -43,65 +79,180 @@ def _find_or_create_p2p_chat(db: Session, user_a_id: str, user_b_id: str) -> Cha
     return chat
 
 
+def _send_result(msg: Message) -> dict:
+    return {
+        "message_id": msg.id,
+        "chat_id": msg.chat_id,
+        "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
+        "seq": msg.seq,
+    }
+
+
+def _find_idempotent(db: Session, sender_id: str, key: Optional[str]) -> Optional[dict]:
+    """Result of an earlier send with the same uuid, if any (LRU first, then the index)."""
+    if not key:
+        return None
+    data = idempotency_cache.get(sender_id, key)
+    if data is None:
+        msg = (
+            db.query(Message)
+            .filter(Message.sender_id == sender_id, Message.client_uuid == key)
+            .first()
+        )
+        if msg:
+            data = _send_result(msg)
+            idempotency_cache.put(sender_id, key, data)
+    return data
+
+
+def _record_sent(db: Session, chat: Chat, msgs: List[Message]):
+    """Give msgs (in send order, not yet added) the chat's next seqs and point
+    the chat-list summary at the last of them, in one UPDATE ... RETURNING.
+    The chat row stays write-locked until commit, so concurrent senders get
+    distinct seqs and a rolled-back send leaves no gap. Sending also marks the
+    chat read for the sender."""
+    last = msgs[-1]
+    summary = {
+        "last_message_id": last.id,
+        "last_message_type": last.message_type,
+        "last_message_preview": make_preview(last.message_type, last.content),
+        "last_sender_id": last.sender_id,
+        "last_message_at": last.created_at,
+    }
+    top = db.execute(
+        update(Chat).where(Chat.id == chat.id)
+        .values(last_seq=func.coalesce(Chat.last_seq, 0) + len(msgs), **summary)
+        .returning(Chat.last_seq),
+        execution_options={"synchronize_session": False},
+    ).scalar_one()
+    for seq, msg in enumerate(msgs, top - len(msgs) + 1):
+        msg.seq = seq
+    # The row is written already; bring the loaded chat in line without a second UPDATE
+    for key, value in {"last_seq": top, **summary}.items():
+        set_committed_value(chat, key, value)
+    db.query(ChatMember).filter(
+        ChatMember.chat_id == chat.id, ChatMember.user_id == last.sender_id,
+    ).update({ChatMember.last_read_at: last.created_at})
+
+
+def _message_events(db: Session, sender: User, chat: Chat, msg: Message):
+    """(sync, receive, recipients) for a committed message: the sender gets the
+    sync event (ignored by Lark SDK bots), the other members the receive event,
+    encoded once for all of them."""
+    recipients = dict(recipient_cache.get(db, chat.id))
+    event_args = dict(
+        sender_id=sender.id,
+        message_id=msg.id,
+        chat_id=chat.id,
+        chat_type=chat.chat_type,
+        message_type=msg.message_type,
+        content=msg.content,
+        root_id=msg.root_id,
+        parent_id=msg.parent_id,
+        seq=msg.seq,
+    )
+    sync = None
+    if recipients.pop(sender.id, None) is not None:
+        sync = build_message_sync_event(receiver_username=sender.username, **event_args)
+    return sync, SharedEvent(build_message_event, **event_args), recipients
+
+
 async def _save_and_push(
     db: Session, sender: User, chat: Chat, msg_type: str, content: str,
-    root_id: str = "", parent_id: str = "",
+    root_id: str = "", parent_id: str = "", client_uuid: Optional[str] = None,
+    trace: Optional[MessageTrace] = None,
 ) -> Message:
+    now = datetime.now(timezone.utc)
     msg = Message(
+        id=str(uuid.uuid4()),
         chat_id=chat.id,
         sender_id=sender.id,
         message_type=msg_type,
         content=content,
         root_id=root_id,
         parent_id=parent_id,
+        created_at=now,
+        client_uuid=client_uuid,
     )
+    _record_sent(db, chat, [msg])
     db.add(msg)
-    db.commit()
-    db.refresh(msg)
-
-    # Push to all members; sender gets sync event (ignored by Lark SDK bots),
-    # others get receive event.
-    any_bot_delivered = False
-    members = db.query(ChatMember).filter(ChatMember.chat_id == chat.id).all()
-    for m in members:
-        target_user = db.query(User).filter(User.id == m.user_id).first()
-        if not target_user:
-            continue
-        build = build_message_sync_event if m.user_id == sender.id else build_message_event
-        event = build(
-            sender_id=sender.id,
-            receiver_username=target_user.username,
-            message_id=msg.id,
-            chat_id=chat.id,
-            chat_type=chat.chat_type,
-            message_type=msg.message_type,
-            content=msg.content,
-            root_id=msg.root_id,
-            parent_id=msg.parent_id,
+    try:
+        db.flush()
+    except IntegrityError:
+        # A concurrent retry with the same uuid won the insert; don't fan out twice
+        db.rollback()
+        return (
+            db.query(Message)
+            .filter(Message.sender_id == sender.id, Message.client_uuid == client_uuid)
+            .one()
         )
-        delivered = await ws_manager.push_event(m.user_id, event)
-        if delivered and m.user_id != sender.id:
-            any_bot_delivered = True
-
-    # Push ack back to sender
-    ack = build_ack_event(
-        message_id=msg.id,
-        chat_id=chat.id,
-        receiver_username=sender.username,
-        bot_delivered=any_bot_delivered,
-    )
-    await ws_manager.push_event(sender.id, ack)
+    index_message(db, msg)
+    # msg, chat and sender are fully loaded and only this request changed them;
+    # keep that state rather than re-selecting all three after the commit.
+    db.expire_on_commit = False
+    db.commit()
+    recent_messages.add(chat.id, key_of(msg), message_to_item(msg))
+    if client_uuid:
+        idempotency_cache.put(sender.id, client_uuid, _send_result(msg))
+    if trace is not None:
+        tracer.bind(trace, msg.id, chat.id, sender.id)
+        trace.mark("committed")
 
+    sync, receive, recipients = _message_events(db, sender, chat, msg)
+    if trace is not None:
+        trace.users.update(recipients)
+        tracer.add_event(trace, receive.event_json)
+    fanout.dispatch(chat.id, msg.id, partial(
+        _deliver_message, sender.id, sender.username, msg.id, chat.id, sync, receive, recipients, trace,
+    ))
     return msg
 
 
+async def _deliver_message(sender_id: str, sender_username: str, message_id: str, chat_id: str,
+                           sync: Optional[dict], receive: SharedEvent, recipients: dict,
+                           trace: Optional[MessageTrace] = None):
+    if trace is not None:
+        trace.mark("fanout_started", recipients=len(recipients))
+    try:
+        if sync is not None:
+            synced = await ws_manager.push_event(sender_id, sync)
+            if trace is not None:
+                tracer.add_event(trace, sync)
+                trace.mark("sync", delivered=synced)
+        delivered = await fanout.push_shared(receive, recipients, trace)
+        # Push ack back to sender
+        ack = build_ack_event(
+            message_id=message_id,
+            chat_id=chat_id,
+            receiver_username=sender_username,
+            bot_delivered=delivered > 0,
+        )
+        acked = await ws_manager.push_event(sender_id, ack)
+        if trace is not None:
+            tracer.add_event(trace, ack)
+            trace.mark("ack", status=ack["event"]["status"], delivered=acked)
+    except Exception as e:
+        if trace is not None:
+            trace.mark("fanout_failed", error=type(e).__name__)
+        raise
+    finally:
+        if trace is not None:
+            tracer.finish(trace)
+
+
 @router.post("/open-apis/im/v1/messages")
 async def send_message(
     req: SendMessageRequest,
+    request: Request,
     receive_id_type: str = Query("open_id"),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
+    # SDK retries carry the same uuid: answer with the original message
+    done = _find_idempotent(db, user.id, req.uuid)
+    if done:
+        return {"code": 0, "msg": "ok", "data": done}
+
     if receive_id_type in ("open_id", "user_id"):
         target = db.query(User).filter(User.id == req.receive_id).first()
         if not target:
@@ -111,24 +262,198 @@ async def send_message(
         chat = db.query(Chat).filter(Chat.id == req.receive_id).first()
         if not chat:
             return {"code": 1, "msg": "chat not found", "data": {}}
+        if user.id not in recipient_cache.get(db, chat.id):
+            return {"code": 1, "msg": "not a member of this chat", "data": {}}
     else:
         return {"code": 1, "msg": "unsupported receive_id_type", "data": {}}
 
-    msg = await _save_and_push(db, user, chat, req.msg_type, req.content)
-    return {"code": 0, "msg": "ok", "data": {
-        "message_id": msg.id,
-        "chat_id": msg.chat_id,
-        "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
-    }}
+    msg = await _save_and_push(db, user, chat, req.msg_type, req.content, client_uuid=req.uuid,
+                               trace=tracer.start(request))
+    return {"code": 0, "msg": "ok", "data": _send_result(msg)}
+
+
+def _find_idempotent_many(db: Session, sender_id: str, keys) -> Dict[str, dict]:
+    """_find_idempotent for several uuids, with one query for the LRU misses."""
+    found, missing = {}, []
+    for key in keys:
+        data = idempotency_cache.get(sender_id, key)
+        if data is None:
+            missing.append(key)
+        else:
+            found[key] = data
+    if missing:
+        for msg in db.query(Message).filter(Message.sender_id == sender_id, Message.client_uuid.in_(missing)):
+            found[msg.client_uuid] = _send_result(msg)
+            idempotency_cache.put(sender_id, msg.client_uuid, found[msg.client_uuid])
+    return found
+
+
+def _p2p_chats(db: Session, user_id: str, target_ids) -> Dict[str, Chat]:
+    """target_id -> p2p chat with user_id, looked up in one query. Chats for
+    existing users without one are added to the session, not committed."""
+    other = aliased(ChatMember)
+    chats = dict(
+        db.query(other.user_id, Chat)
+        .join(ChatMember, Chat.id == ChatMember.chat_id)
+        .join(other, Chat.id == other.chat_id)
+        .filter(Chat.chat_type == "p2p")
+        .filter(ChatMember.user_id == user_id, other.user_id.in_(target_ids))
+        .all()
+    )
+    missing = [t for t in target_ids if t not in chats]
+    if missing:
+        for (target_id,) in db.query(User.id).filter(User.id.in_(missing)):
+            chat = Chat(id=str(uuid.uuid4()), chat_type="p2p", owner_id=user_id)
+            db.add(chat)
+            db.add(ChatMember(chat_id=chat.id, user_id=user_id))
+            db.add(ChatMember(chat_id=chat.id, user_id=target_id))
+            chats[target_id] = chat
+    return chats
+
+
+async def _batch_send(db: Session, user: User, req: BatchSendRequest, receive_id_type: str) -> Optional[list]:
+    results: List[Optional[dict]] = [None] * len(req.messages)
+    keys = [item.uuid for item in req.messages if item.uuid]
+    done = _find_idempotent_many(db, user.id, keys) if keys else {}
+    first_of: Dict[str, int] = {}
+    open_ids, chat_ids = set(), set()
+    for i, item in enumerate(req.messages):
+        if item.uuid in done:
+            results[i] = {"code": 0, "msg": "ok", "data": done[item.uuid]}
+        elif item.uuid and item.uuid in first_of:
+            continue  # same uuid twice in the batch: answered with the first
+        else:
+            if item.uuid:
+                first_of[item.uuid] = i
+            kind = item.receive_id_type or receive_id_type
+            if kind in ("open_id", "user_id"):
+                open_ids.add(item.receive_id)
+            elif kind == "chat_id":
+                chat_ids.add(item.receive_id)
+
+    p2p = _p2p_chats(db, user.id, list(open_ids)) if open_ids else {}
+    groups = {c.id: c for c in db.query(Chat).filter(Chat.id.in_(chat_ids))} if chat_ids else {}
+    now = datetime.now(timezone.utc)
+    sent = []
+    for i, item in enumerate(req.messages):
+        if results[i] is not None or (item.uuid and first_of.get(item.uuid) != i):
+            continue
+        kind = item.receive_id_type or receive_id_type
+        if kind in ("open_id", "user_id"):
+            chat = p2p.get(item.receive_id)
+            error = "receiver not found" if chat is None else None
+        elif kind == "chat_id":
+            chat = groups.get(item.receive_id)
+            if chat is None:
+                error = "chat not found"
+            elif user.id not in recipient_cache.get(db, chat.id):
+                error = "not a member of this chat"
+            else:
+                error = None
+        else:
+            error = "unsupported receive_id_type"
+        if error:
+            results[i] = {"code": 1, "msg": error, "data": {}}
+            continue
+        # Distinct timestamps keep the batch's order in chat history
+        msg = Message(
+            id=str(uuid.uuid4()),
+            chat_id=chat.id,
+            sender_id=user.id,
+            message_type=item.msg_type,
+            content=item.content,
+            created_at=now + timedelta(microseconds=len(sent)),
+            client_uuid=item.uuid,
+        )
+        sent.append((i, chat, msg))
+
+    if sent:
+        by_chat: Dict[str, tuple] = {}
+        for _, chat, msg in sent:
+            by_chat.setdefault(chat.id, (chat, []))[1].append(msg)
+        for chat, msgs in by_chat.values():
+            _record_sent(db, chat, msgs)
+        db.add_all([msg for _, _, msg in sent])
+        try:
+            db.flush()
+        except IntegrityError:
+            # A concurrent retry won some uuid; start over so it is answered from the index
+            db.rollback()
+            return None
+        index_messages(db, [msg for _, _, msg in sent])
+        db.expire_on_commit = False
+        db.commit()
+
+    deliveries = []
+    for i, chat, msg in sent:
+        recent_messages.add(chat.id, key_of(msg), message_to_item(msg))
+        results[i] = {"code": 0, "msg": "ok", "data": _send_result(msg)}
+        if msg.client_uuid:
+            idempotency_cache.put(user.id, msg.client_uuid, results[i]["data"])
+        deliveries.append((msg.id, chat.id) + _message_events(db, user, chat, msg))
+    for i, item in enumerate(req.messages):
+        if results[i] is None:
+            results[i] = results[first_of[item.uuid]]
+    if deliveries:
+        fanout.dispatch_batch(
+            [chat.id for _, chat, _ in sent], [msg.id for _, _, msg in sent],
+            partial(_deliver_batch, user.id, user.username, deliveries),
+        )
+    return results
+
+
+async def _deliver_batch(sender_id: str, sender_username: str, deliveries: list):
+    """_deliver_message for the messages of one batch send, in order; each
+    recipient gets all of its events from a single push."""
+    for _, _, sync, _, _ in deliveries:
+        if sync is not None:
+            await ws_manager.push_event(sender_id, sync)
+    reached = await fanout.push_shared_batch([(receive, recipients) for _, _, _, receive, recipients in deliveries])
+    for (message_id, chat_id, _, _, _), delivered in zip(deliveries, reached):
+        await ws_manager.push_event(sender_id, build_ack_event(
+            message_id=message_id,
+            chat_id=chat_id,
+            receiver_username=sender_username,
+            bot_delivered=delivered > 0,
+        ))
+
+
+@router.post("/open-apis/im/v1/messages/batch_send")
+async def batch_send_messages(
+    req: BatchSendRequest,
+    receive_id_type: str = Query("open_id"),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Send up to MESSAGE_BATCH_MAX messages, to any mix of users and chats,
+    in one request: chats are resolved with one query per receive_id_type,
+    all messages are committed in one transaction and fanned out together.
+    data.items holds one result per message, in order, shaped like the
+    response of a single send; a failed item doesn't fail the others."""
+    if not req.messages:
+        return {"code": 1, "msg": "no messages", "data": {}}
+    if len(req.messages) > MESSAGE_BATCH_MAX:
+        return {"code": 1, "msg": f"at most {MESSAGE_BATCH_MAX} messages per batch", "data": {}}
+    results = await _batch_send(db, user, req, receive_id_type)
+    if results is None:
+        results = await _batch_send(db, user, req, receive_id_type)
+    if results is None:
+        return {"code": 1, "msg": "conflicting concurrent send, retry", "data": {}}
+    return {"code": 0, "msg": "ok", "data": {"items": results}}
 
 
 @router.post("/open-apis/im/v1/messages/{message_id}/reply")
 async def reply_message(
     message_id: str,
     req: ReplyMessageRequest,
+    request: Request,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
+    done = _find_idempotent(db, user.id, req.uuid)
+    if done:
+        return {"code": 0, "msg": "ok", "data": done}
+
     parent = db.query(Message).filter(Message.id == message_id).first()
     if not parent:
         return {"code": 1, "msg": "parent message not found", "data": {}}
@@ -136,85 +461,196 @@ async def reply_message(
     root_id = parent.root_id if parent.root_id else parent.id
     msg = await _save_and_push(
         db, user, chat, req.msg_type, req.content,
-        root_id=root_id, parent_id=parent.id,
+        root_id=root_id, parent_id=parent.id, client_uuid=req.uuid, trace=tracer.start(request),
+    )
+    return {"code": 0, "msg": "ok", "data": _send_result(msg)}
+
+
+def _visible_messages(db: Session, user_id: str):
+    """Messages of the chats user_id is a member of."""
+    return db.query(Message).join(
+        ChatMember, and_(ChatMember.chat_id == Message.chat_id, ChatMember.user_id == user_id),
     )
+
+
+async def _flush_patches(db: Session, msgs):
+    # As in get_message: persist buffered patches so content and version are current
+    for msg in msgs:
+        if await patch_coalescer.flush_now(msg.id):
+            db.refresh(msg)
+
+
+@router.get("/open-apis/im/v1/messages/mget")
+async def mget_messages(
+    message_ids: List[str] = Query(...),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Several messages by id with one query. Items follow the order of
+    message_ids; unknown ids and messages of chats the user is not in are
+    left out."""
+    message_ids = list(dict.fromkeys(message_ids))
+    if len(message_ids) > MESSAGE_BATCH_MAX:
+        return {"code": 1, "msg": f"at most {MESSAGE_BATCH_MAX} message_ids", "data": {}}
+    found = {m.id: m for m in _visible_messages(db, user.id).filter(Message.id.in_(message_ids))}
+    await _flush_patches(db, found.values())
     return {"code": 0, "msg": "ok", "data": {
-        "message_id": msg.id,
-        "chat_id": msg.chat_id,
-        "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
+        "items": [message_to_item(found[mid]) for mid in message_ids if mid in found]
     }}
 
 
-@router.get("/open-apis/im/v1/messages/{message_id}")
-def get_message(
+def _encode_page_token(created_at: datetime, message_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_page_token(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token.encode()).decode()
+        created_at, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), message_id
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+@router.get("/cofly/messages/{message_id}/thread")
+async def get_thread(
     message_id: str,
+    page_size: int = Query(500, ge=1, le=500),
+    page_token: str = Query(""),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    msg = db.query(Message).filter(Message.id == message_id).first()
-    if not msg:
+    """The thread message_id belongs to: its root followed by every reply
+    (messages whose root_id is the root), in send order, paging while has_more.
+    One query, by the root_id index, instead of walking parent_id one message
+    at a time."""
+    root_id = (
+        select(func.coalesce(func.nullif(Message.root_id, ""), Message.id))
+        .where(Message.id == message_id)
+        .scalar_subquery()
+    )
+    query = _visible_messages(db, user.id).filter(or_(Message.id == root_id, Message.root_id == root_id))
+    if page_token:
+        cursor = _decode_page_token(page_token)
+        if cursor is None:
+            return {"code": 1, "msg": "invalid page_token", "data": {}}
+        created_at, last_id = cursor
+        query = query.filter(or_(Message.created_at > created_at,
+                                 and_(Message.created_at == created_at, Message.id > last_id)))
+    msgs = query.order_by(Message.created_at.asc(), Message.id.asc()).limit(page_size + 1).all()
+    if not msgs and not page_token:
         return {"code": 1, "msg": "message not found", "data": {}}
-    sender = db.query(User).filter(User.id == msg.sender_id).first()
+    has_more = len(msgs) > page_size
+    msgs = msgs[:page_size]
+    await _flush_patches(db, msgs)
     return {"code": 0, "msg": "ok", "data": {
-        "items": [{
-            "message_id": msg.id,
-            "chat_id": msg.chat_id,
-            "msg_type": msg.message_type,
-            "body": {"content": msg.content},
-            "sender": {
-                "id": msg.sender_id,
-                "id_type": "open_id",
-                "sender_type": "user",
-                "tenant_key": "cofly",
-            },
-            "root_id": msg.root_id,
-            "parent_id": msg.parent_id,
-            "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
-        }]
+        "root_id": msgs[0].root_id or msgs[0].id if msgs else "",
+        "items": [message_to_item(msg) for msg in msgs],
+        "has_more": has_more,
+        "page_token": _encode_page_token(msgs[-1].created_at, msgs[-1].id) if has_more else "",
     }}
 
 
-@router.patch("/open-apis/im/v1/messages/{message_id}")
-async def patch_message(
+@router.get("/open-apis/im/v1/messages/{message_id}")
+async def get_message(
     message_id: str,
-    req: PatchMessageRequest,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
+    # A streamed message may have a buffered patch; persist it first so the
+    # content and version returned are consistent (delta clients resync from here).
+    if await patch_coalescer.flush_now(message_id):
+        db.expire_all()
     msg = db.query(Message).filter(Message.id == message_id).first()
     if not msg:
         return {"code": 1, "msg": "message not found", "data": {}}
-    if msg.sender_id != user.id:
-        return {"code": 1, "msg": "no permission to edit this message", "data": {}}
-    msg.message_type = req.msg_type
-    msg.content = req.content
-    db.commit()
-    db.refresh(msg)
+    return {"code": 0, "msg": "ok", "data": {
+        "items": [message_to_item(msg)]
+    }}
+
 
-    # Push update event to chat members
+async def _apply_patch(db: Session, msg: Message, sender_id: str, msg_type: str, content: str):
+    """Persist an edit and push the update event to chat members."""
+    ops = compute_ops(msg.content or "", content)
+    base_version = msg.version or 0
+    msg.message_type = msg_type
+    msg.content = content
+    msg.version = base_version + 1
+    reindex_message(db, msg)
     chat = db.query(Chat).filter(Chat.id == msg.chat_id).first()
+    if chat and chat.last_message_id == msg.id:
+        chat.last_message_type = msg.message_type
+        chat.last_message_preview = make_preview(msg.message_type, msg.content)
+    db.expire_on_commit = False
+    db.commit()
+    recent_messages.update(msg.chat_id, message_to_item(msg))
+
+    # Push update event to chat members, never ahead of the message itself
+    await fanout.wait_for(msg.id)
     if chat:
-        members = db.query(ChatMember).filter(ChatMember.chat_id == chat.id).all()
-        for m in members:
-            target_user = db.query(User).filter(User.id == m.user_id).first()
-            if not target_user:
-                continue
+        for user_id, username in recipient_cache.get(db, chat.id).items():
             event = build_message_update_event(
-                sender_id=user.id,
-                receiver_username=target_user.username,
+                sender_id=sender_id,
+                receiver_username=username,
                 message_id=msg.id,
                 chat_id=chat.id,
                 chat_type=chat.chat_type,
                 message_type=msg.message_type,
                 content=msg.content,
+                version=msg.version,
+            )
+            delta = build_message_delta_event(
+                sender_id=sender_id,
+                receiver_username=username,
+                message_id=msg.id,
+                chat_id=chat.id,
+                chat_type=chat.chat_type,
+                message_type=msg.message_type,
+                base_version=base_version,
+                version=msg.version,
+                ops=ops,
             )
-            await ws_manager.push_event(m.user_id, event)
+            await ws_manager.push_event(user_id, event, delta_event=delta)
+
+
+async def _flush_patch(message_id: str, state: PatchState):
+    sender_id, msg_type, content = state
+    db = SessionLocal()
+    try:
+        msg = db.query(Message).filter(Message.id == message_id).first()
+        if msg:
+            await _apply_patch(db, msg, sender_id, msg_type, content)
+    finally:
+        db.close()
+
+
+patch_coalescer = PatchCoalescer(PATCH_COALESCE_MS, _flush_patch)
+
+
+@router.patch("/open-apis/im/v1/messages/{message_id}")
+async def patch_message(
+    message_id: str,
+    req: PatchMessageRequest,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    msg = db.query(Message).filter(Message.id == message_id).first()
+    if not msg:
+        return {"code": 1, "msg": "message not found", "data": {}}
+    if msg.sender_id != user.id:
+        return {"code": 1, "msg": "no permission to edit this message", "data": {}}
+    # Streaming replies patch many times a second; inside a coalescing window the
+    # patch is only buffered and the window's flush persists the latest content.
+    if not patch_coalescer.submit(msg.id, user.id, req.msg_type, req.content):
+        async with patch_coalescer.serialized(msg.id):
+            await _apply_patch(db, msg, user.id, req.msg_type, req.content)
 
     return {"code": 0, "msg": "ok", "data": {
         "message_id": msg.id,
         "chat_id": msg.chat_id,
-        "msg_type": msg.message_type,
-        "body": {"content": msg.content},
+        "msg_type": req.msg_type,
+        "body": {"content": req.content},
         "update_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
     }}
 
@@ -224,10 +660,14 @@ def list_chat_messages(
     chat_id: str,
     page_size: int = Query(100, ge=1, le=500),
     start_time: Optional[int] = Query(None),
+    since_seq: Optional[int] = Query(None, ge=0),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    """List messages in a chat, optionally filtered by start_time (ms timestamp)."""
+    """List messages in a chat, optionally filtered by start_time (ms timestamp).
+    With since_seq, lists the messages after that seq in seq order instead:
+    a client resumes from the last seq it has and gets exactly what it missed,
+    paging while has_more."""
     chat = db.query(Chat).filter(Chat.id == chat_id).first()
     if not chat:
         return {"code": 1, "msg": "chat not found", "data": {}}
@@ -243,32 +683,155 @@ def list_chat_messages(
 
     query = db.query(Message).filter(Message.chat_id == chat_id)
 
-    if start_time is not None:
-        cutoff = datetime.utcfromtimestamp(start_time / 1000)
-        query = query.filter(Message.created_at >= cutoff)
+    if since_seq is not None:
+        query = query.filter(Message.seq > since_seq).order_by(Message.seq.asc())
+    else:
+        if start_time is not None:
+            cutoff = datetime.utcfromtimestamp(start_time / 1000)
+            query = query.filter(Message.created_at >= cutoff)
+        query = query.order_by(Message.created_at.asc())
 
-    messages = (
-        query.order_by(Message.created_at.asc())
-        .limit(page_size)
-        .all()
-    )
+    messages = query.limit(page_size + 1).all()
+
+    items = [message_to_item(msg) for msg in messages[:page_size]]
+
+    return {"code": 0, "msg": "ok", "data": {"items": items, "has_more": len(messages) > page_size}}
+
+
+_HISTORY_HIT = HISTORY_CACHE.labels("hit")
+_HISTORY_LOADED = HISTORY_CACHE.labels("loaded")
+_HISTORY_MISS = HISTORY_CACHE.labels("miss")
+
+
+def _context_window(db: Session, chat_id: str, message_id: Optional[str], before: int, after: int):
+    """(items, anchor index or None, has_more) for the context endpoint, or None
+    if message_id is not in the chat. Served from the chat's recent-messages
+    window when it covers the range, else by one range query on
+    ix_messages_chat_created (plus a primary-key lookup of the anchor)."""
+    window = recent_messages.get(chat_id)
+    if window is None:
+        depth = recent_messages.depth
+        rows = (
+            db.query(Message).filter(Message.chat_id == chat_id)
+            .order_by(Message.created_at.desc(), Message.id.desc())
+            .limit(depth + 1)
+            .all()
+        )
+        window = recent_messages.load(
+            chat_id, [(key_of(m), message_to_item(m)) for m in reversed(rows[:depth])], len(rows) <= depth,
+        )
+        outcome = _HISTORY_LOADED
+    else:
+        outcome = _HISTORY_HIT
+
+    a = len(window.items) if message_id is None else window.index(message_id)
+    if a is not None and (a >= before or window.complete):
+        outcome.inc()
+        lo = max(0, a - before)
+        items = window.items[lo:a + 1 + after]
+        return items, None if message_id is None else a - lo, lo > 0 or not window.complete
+
+    _HISTORY_MISS.inc()
+    query = db.query(Message).filter(Message.chat_id == chat_id)
+    older = query
+    anchor = None
+    if message_id is not None:
+        anchor = query.filter(Message.id == message_id).first()
+        if anchor is None:
+            return None
+        older = query.filter(
+            Message.created_at <= anchor.created_at,
+            or_(Message.created_at < anchor.created_at, Message.id < anchor.id),
+        )
+    rows = older.order_by(Message.created_at.desc(), Message.id.desc()).limit(before + 1).all()
+    msgs = rows[:before][::-1]
+    if anchor is None:
+        return [message_to_item(m) for m in msgs], None, len(rows) > before
+    a = len(msgs)
+    msgs.append(anchor)
+    if after:
+        msgs += (
+            query.filter(
+                Message.created_at >= anchor.created_at,
+                or_(Message.created_at > anchor.created_at, Message.id > anchor.id),
+            )
+            .order_by(Message.created_at.asc(), Message.id.asc())
+            .limit(after)
+            .all()
+        )
+    return [message_to_item(m) for m in msgs], a, len(rows) > before
+
+
+def _content_bytes(item: dict) -> int:
+    return len(item["body"]["content"].encode())
+
+
+@router.get("/cofly/chats/{chat_id}/context")
+async def chat_context(
+    chat_id: str,
+    message_id: Optional[str] = Query(None),
+    before: int = Query(20, ge=0, le=500),
+    after: int = Query(0, ge=0, le=500),
+    max_bytes: Optional[int] = Query(None, ge=1),
+    with_parents: bool = Query(True),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """History to build an agent's prompt from, oldest first: the newest
+    `before` messages, or with message_id that message with the `before`
+    messages preceding it and the `after` following it. Replies carry the
+    message they quote as parent_message. With max_bytes, messages furthest
+    from the anchor (the newest message without message_id) are dropped until
+    the contents, quoted ones included, fit; the anchor itself is always kept.
+    has_more tells whether older messages exist."""
+    if user.id not in recipient_cache.get(db, chat_id):
+        return {"code": 1, "msg": "not a member of this chat", "data": {}}
+    if message_id is None:
+        after = 0
+    result = _context_window(db, chat_id, message_id, before, after)
+    if result is None:
+        return {"code": 1, "msg": "message not found", "data": {}}
+    # Streamed messages may have a buffered patch: persist it and read again
+    if any(patch_coalescer.pending(item["message_id"]) for item in result[0]):
+        for item in result[0]:
+            await patch_coalescer.flush_now(item["message_id"])
+        db.expire_all()
+        result = _context_window(db, chat_id, message_id, before, after)
+    items, a, has_more = result
+
+    parents = {}
+    if with_parents:
+        wanted = {item["parent_id"] for item in items if item["parent_id"]}
+        window = recent_messages.get(chat_id)
+        for item in items + (window.items if window is not None else []):
+            if item["message_id"] in wanted:
+                parents[item["message_id"]] = item
+        missing = wanted - parents.keys()
+        if missing:
+            for msg in db.query(Message).filter(Message.chat_id == chat_id, Message.id.in_(missing)):
+                parents[msg.id] = message_to_item(msg)
+
+    lo, hi = 0, len(items)
+    if max_bytes is not None and items:
+        # Take messages outward from the anchor while they fit
+        if a is None:
+            order = list(range(len(items) - 1, -1, -1))
+        else:
+            order = list(range(a, -1, -1)) + list(range(a + 1, len(items)))
+        kept, used = [], 0
+        for i in order:
+            cost = _content_bytes(items[i])
+            if items[i]["parent_id"] in parents:
+                cost += _content_bytes(parents[items[i]["parent_id"]])
+            if kept and used + cost > max_bytes:
+                break
+            kept.append(i)
+            used += cost
+        lo, hi = min(kept), max(kept) + 1
+        has_more = has_more or lo > 0
 
-    items = []
-    for msg in messages:
-        items.append({
-            "message_id": msg.id,
-            "chat_id": msg.chat_id,
-            "msg_type": msg.message_type,
-            "body": {"content": msg.content},
-            "sender": {
-                "id": msg.sender_id,
-                "id_type": "open_id",
-                "sender_type": "user",
-                "tenant_key": "cofly",
-            },
-            "root_id": msg.root_id,
-            "parent_id": msg.parent_id,
-            "create_time": str(int(calendar.timegm(msg.created_at.timetuple()) * 1000)),
-        })
-
-    return {"code": 0, "msg": "ok", "data": {"items": items}}
+    out = []
+    for item in items[lo:hi]:
+        parent = parents.get(item["parent_id"])
+        out.append(item if parent is None else {**item, "parent_message": parent})
+    return {"code": 0, "msg": "ok", "data": {"items": out, "has_more": has_more}}
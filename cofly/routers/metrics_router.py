@@ -0,0 +1,78 @@
+import os
+
+import anyio.to_thread
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from admission import admission
+from loop_monitor import loop_monitor
+from metrics import REGISTRY
+from webhooks import webhooks
+from ws_manager import ws_manager
+
+router = APIRouter()
+
+# Users by offline queue depth
+_PENDING_BUCKETS = ((1, "1"), (9, "2-9"), (99, "10-99"), (999, "100-999"))
+
+
+def _pending_users():
+    counts = {label: 0 for _, label in _PENDING_BUCKETS}
+    counts["1000+"] = 0
+    for events in ws_manager.pending_queues():
+        n = len(events)
+        for bound, label in _PENDING_BUCKETS:
+            if n <= bound:
+                counts[label] += 1
+                break
+        else:
+            counts["1000+"] += 1
+    return {(label,): n for label, n in counts.items()}
+
+
+def _threadpool():
+    # Sync endpoints (and the bcrypt work in them) queue for these threads
+    stats = anyio.to_thread.current_default_thread_limiter().statistics()
+    return {("busy",): stats.borrowed_tokens, ("waiting",): stats.tasks_waiting}
+
+
+def _rss_bytes():
+    # Linux only; elsewhere the gauge is simply absent
+    try:
+        with open("/proc/self/statm") as f:
+            return {(): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    except (OSError, ValueError):
+        return {}
+
+
+REGISTRY.gauge("process_resident_memory_bytes", "Resident memory size in bytes.", collect=_rss_bytes)
+REGISTRY.gauge("cofly_ws_connections", "Open WebSocket connections.",
+               collect=lambda: {(): ws_manager.connection_count()})
+REGISTRY.gauge("cofly_ws_shard_connections", "Open WebSocket connections per registry shard.", ("shard",),
+               collect=lambda: {(str(s.index),): s.connections.total for s in ws_manager.shards})
+REGISTRY.gauge("cofly_ws_shard_pending_events", "Events queued for offline users per registry shard.",
+               ("shard",),
+               collect=lambda: {(str(s.index),): s.pending_depth() for s in ws_manager.shards})
+REGISTRY.gauge("cofly_ws_handshakes_in_flight", "Admitted handshakes still running.",
+               collect=lambda: {(): admission.in_flight})
+REGISTRY.gauge("cofly_ws_online_users", "Users with at least one connection.",
+               collect=lambda: {(): ws_manager.online_users()})
+REGISTRY.gauge("cofly_pending_events", "Events queued for offline users.",
+               collect=lambda: {(): sum(len(e) for e in ws_manager.pending_queues())})
+REGISTRY.gauge("cofly_pending_events_uncompacted", "Events queued for offline users, before compaction.",
+               collect=lambda: {(): sum(q.received for q in ws_manager.pending_queues())})
+REGISTRY.gauge("cofly_webhook_buffered_events", "Events waiting for a webhook POST.",
+               collect=lambda: {(): webhooks.buffered()})
+REGISTRY.gauge("cofly_pending_users", "Users with queued events, by queue depth.", ("depth",),
+               collect=_pending_users)
+REGISTRY.gauge("cofly_threadpool_tasks", "Threadpool workers in use and tasks waiting for one.",
+               ("state",), collect=_threadpool)
+REGISTRY.gauge("cofly_event_loop_lag_quantile_seconds", "Event-loop lag over the recent sample window.",
+               ("quantile",), collect=loop_monitor.quantiles)
+REGISTRY.gauge("cofly_load_shedding", "1 while loop lag is shedding load.",
+               collect=lambda: {(): int(loop_monitor.shedding())})
+
+
+@router.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
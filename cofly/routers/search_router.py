@@ -0,0 +1,68 @@
+import base64
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+
+from auth import get_current_user
+from database import get_db
+from models import User, Message
+from routers.message_router import message_to_item
+from search import search_messages
+
+router = APIRouter()
+
+
+def _encode_page_token(score: float, rowid: int) -> str:
+    raw = f"{score!r}|{rowid}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_page_token(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token.encode()).decode()
+        score, rowid = raw.split("|", 1)
+        return float(score), int(rowid)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+@router.get("/cofly/messages/search")
+def search(
+    query: str = Query(..., min_length=1),
+    chat_id: Optional[str] = Query(None),
+    page_size: int = Query(20, ge=1, le=100),
+    page_token: str = Query(""),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Full-text search over messages in the caller's chats, best match first."""
+    if not query.strip():
+        return {"code": 1, "msg": "empty query", "data": {}}
+    after = None
+    if page_token:
+        after = _decode_page_token(page_token)
+        if after is None:
+            return {"code": 1, "msg": "invalid page_token", "data": {}}
+    hits = search_messages(db, user.id, query, limit=page_size + 1, after=after, chat_id=chat_id)
+    has_more = len(hits) > page_size
+    hits = hits[:page_size]
+
+    by_id = {}
+    if hits:
+        msgs = db.query(Message).filter(Message.id.in_([h.message_id for h in hits])).all()
+        by_id = {m.id: m for m in msgs}
+    items = []
+    for h in hits:
+        msg = by_id.get(h.message_id)
+        if msg is None:
+            continue
+        item = message_to_item(msg)
+        item["score"] = -h.score
+        item["snippet"] = h.snippet
+        items.append(item)
+    return {"code": 0, "msg": "ok", "data": {
+        "items": items,
+        "has_more": has_more,
+        "page_token": _encode_page_token(hits[-1].score, hits[-1].rowid) if has_more else "",
+    }}
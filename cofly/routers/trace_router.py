@@ -0,0 +1,27 @@
+from fastapi import APIRouter, Depends, Query
+
+from auth import get_current_user
+from models import User
+from tracing import tracer
+
+router = APIRouter()
+
+
+@router.get("/cofly/traces")
+def list_traces(
+    message_id: str = Query(""),
+    event_id: str = Query(""),
+    limit: int = Query(20, ge=1, le=200),
+    user: User = Depends(get_current_user),
+):
+    """Recent message lifecycle traces the caller took part in, newest first;
+    message_id or event_id (header.event_id of any resulting event) selects one."""
+    if message_id or event_id:
+        trace = tracer.get(message_id=message_id, event_id=event_id)
+        traces = [trace] if trace is not None and user.id in trace.users else []
+    else:
+        traces = tracer.recent(user.id, limit)
+    return {"code": 0, "msg": "ok", "data": {
+        "sample_rate": tracer.sample_rate,
+        "items": [t.to_dict() for t in traces],
+    }}
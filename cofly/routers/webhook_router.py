@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+
+from auth import get_current_user
+from database import get_db
+from models import User, Webhook
+from schemas import WebhookRequest
+from webhooks import webhooks
+
+router = APIRouter()
+
+
+@router.put("/cofly/webhook")
+def set_webhook(req: WebhookRequest, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Receive events by POST to url while not connected, instead of queueing them."""
+    error = webhooks.url_error(req.url)
+    if error:
+        return {"code": 1, "msg": error, "data": {}}
+    hook = db.query(Webhook).filter(Webhook.user_id == user.id).first()
+    if hook is None:
+        hook = Webhook(user_id=user.id)
+        db.add(hook)
+    hook.url = req.url
+    hook.secret = req.secret
+    db.commit()
+    webhooks.register(user.id, req.url, req.secret)
+    return {"code": 0, "msg": "ok", "data": {"url": req.url}}
+
+
+@router.get("/cofly/webhook")
+def get_webhook(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    hook = db.query(Webhook).filter(Webhook.user_id == user.id).first()
+    if hook is None:
+        return {"code": 0, "msg": "ok", "data": {}}
+    return {"code": 0, "msg": "ok", "data": {"url": hook.url, "signed": bool(hook.secret)}}
+
+
+@router.delete("/cofly/webhook")
+def delete_webhook(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Back to the offline queue; events still buffered for the webhook move there."""
+    db.query(Webhook).filter(Webhook.user_id == user.id).delete()
+    db.commit()
+    webhooks.unregister(user.id)
+    return {"code": 0, "msg": "ok", "data": {}}
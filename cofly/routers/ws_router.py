@@ -1,8 +1,11 @@
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, Query, Request
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, Query, Request, Response
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
 from auth import decode_token
+from admission import admission
 from database import get_db, SessionLocal
+from loop_monitor import loop_monitor
 from models import User, make_user_id
 from ws_manager import ws_manager
 from proto import parse_frame, get_header
@@ -17,9 +20,26 @@ def check_online(user_id: str):
 
 
 @router.post("/callback/ws/endpoint")
-async def ws_endpoint(request: Request, db: Session = Depends(get_db)):
+async def ws_endpoint(request: Request, response: Response, db: Session = Depends(get_db)):
     """Return WS URL and client config, mimicking Feishu's endpoint discovery.
     SDK sends {"AppID": "...", "AppSecret": "..."} in the body."""
+    # Shed before the bcrypt and DB work; the SDK retries on code != 0
+    if loop_monitor.sheds("endpoint"):
+        return _busy(response, loop_monitor.retry_after())
+    if not admission.try_acquire():
+        return _busy(response, admission.retry_after(ws_manager.connection_count()))
+    try:
+        return await _discover(request, db)
+    finally:
+        admission.release()
+
+
+def _busy(response: Response, retry_after: int) -> dict:
+    response.headers["Retry-After"] = str(retry_after)
+    return {"code": 1, "msg": "server busy, retry later", "data": {"retry_after": retry_after}}
+
+
+async def _discover(request: Request, db: Session) -> dict:
     import logging
     from auth import create_token, hash_password, verify_password, verify_registration_token
     logger = logging.getLogger("cofly.ws")
@@ -78,18 +98,57 @@ async def ws_endpoint(request: Request, db: Session = Depends(get_db)):
         "msg": "ok",
         "data": {
             "URL": ws_url,
-            "ClientConfig": {
-                "ReconnectCount": 10,
-                "ReconnectInterval": 3,
-                "ReconnectNonce": 5,
-                "PingInterval": 120,
-            },
+            "ClientConfig": admission.client_config(ws_manager.connection_count()),
         },
     }
 
 
 @router.websocket("/ws")
 async def websocket_handler(ws: WebSocket):
+    if loop_monitor.sheds("ws"):
+        await _reject_busy(ws, loop_monitor.retry_after())
+        return
+    if not admission.try_acquire():
+        await _reject_busy(ws, admission.retry_after(ws_manager.connection_count()))
+        return
+    try:
+        user_id = await _authenticate(ws)
+        if user_id is None:
+            return
+        # Clients that can apply cofly.message.delta_v1 opt in with update_mode=delta
+        conn = await ws_manager.connect(
+            user_id, ws,
+            device_id=ws.query_params.get("device_id", ""),
+            service_id=ws.query_params.get("service_id", ""),
+            delta_updates=ws.query_params.get("update_mode") == "delta",
+        )
+    finally:
+        admission.release()
+    try:
+        while True:
+            raw = await ws.receive_bytes()
+            await ws_manager.handle_frame(conn, raw)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        ws_manager.disconnect(conn)
+
+
+async def _reject_busy(ws: WebSocket, retry_after: int):
+    """Turn a handshake away with a retry hint the client actually receives.
+    A close before accept() reaches the client as a bare HTTP 403."""
+    if "websocket.http.response" in ws.scope.get("extensions", {}):
+        # The same body and Retry-After as ws_endpoint's busy reply
+        await ws.send_denial_response(JSONResponse(
+            _busy(Response(), retry_after), status_code=503, headers={"Retry-After": str(retry_after)}))
+    else:
+        # 1013 Try Again Later
+        await ws.accept()
+        await ws.close(code=1013, reason=f"server busy, retry after {retry_after}s")
+
+
+async def _authenticate(ws: WebSocket):
+    """The connecting user's id, or None after closing the socket."""
     import logging
     logger = logging.getLogger("cofly.ws")
 
@@ -139,13 +198,4 @@ async def websocket_handler(ws: WebSocket):
     if not user:
         await ws.close(code=4001, reason="user not found")
         return
-
-    await ws_manager.connect(user_id, ws)
-    try:
-        while True:
-            raw = await ws.receive_bytes()
-            await ws_manager.handle_frame(user_id, ws, raw)
-    except WebSocketDisconnect:
-        pass
-    finally:
-        ws_manager.disconnect(user_id, ws)
+    return user_id
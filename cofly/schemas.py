@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 
 class RegisterRequest(BaseModel):
@@ -25,6 +25,19 @@ class SendMessageRequest(BaseModel):
     uuid: Optional[str] = None
 
 
+class BatchSendItem(BaseModel):
+    receive_id: str
+    # Defaults to the request's receive_id_type query parameter
+    receive_id_type: Optional[str] = None
+    msg_type: str = "text"
+    content: str
+    uuid: Optional[str] = None
+
+
+class BatchSendRequest(BaseModel):
+    messages: List[BatchSendItem]
+
+
 class ReplyMessageRequest(BaseModel):
     msg_type: str = "text"
     content: str
@@ -38,3 +51,18 @@ class PatchMessageRequest(BaseModel):
 
 class AddReactionRequest(BaseModel):
     reaction_type: dict  # {"emoji_type": "THUMBSUP"}
+
+
+class CreateChatRequest(BaseModel):
+    name: str = ""
+    user_id_list: List[str] = []
+    bot_id_list: List[str] = []
+
+
+class ChatMembersRequest(BaseModel):
+    id_list: List[str]
+
+
+class WebhookRequest(BaseModel):
+    url: str
+    secret: str = ""
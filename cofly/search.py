@@ -0,0 +1,166 @@
+"""Full-text message search backed by an SQLite FTS5 table.
+
+messages_fts is an external-content index over messages_search, which holds
+each indexed message's text under a stable INTEGER PRIMARY KEY (the implicit
+rowid of messages, keyed by a Text id, may be renumbered by VACUUM). Triggers
+keep the index in step, so the write path and GC insert, update or delete
+messages_search rows by message_id through its unique index.
+"""
+
+import logging
+from typing import Optional, Tuple
+
+from sqlalchemy import DDL, DateTime, bindparam, event, text
+from sqlalchemy.orm import Session
+
+from config import FTS_TOKENIZER
+from content_text import extract_text
+from models import Message
+
+logger = logging.getLogger("cofly.search")
+
+FTS_TABLE = "messages_fts"
+CONTENT_TABLE = "messages_search"
+# Trigram indexes cannot answer terms shorter than three characters; those
+# terms are applied as LIKE filters instead.
+_TRIGRAM_MIN = 3
+
+_CREATE = (
+    f"CREATE TABLE IF NOT EXISTS {CONTENT_TABLE} "
+    f"(id INTEGER PRIMARY KEY, message_id TEXT NOT NULL UNIQUE, chat_id TEXT NOT NULL, body TEXT NOT NULL)",
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    f"USING fts5(body, chat_id UNINDEXED, content='{CONTENT_TABLE}', content_rowid='id', "
+    f"tokenize='{FTS_TOKENIZER}')",
+    f"CREATE TRIGGER IF NOT EXISTS {CONTENT_TABLE}_ai AFTER INSERT ON {CONTENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, body, chat_id) VALUES (new.id, new.body, new.chat_id); END",
+    f"CREATE TRIGGER IF NOT EXISTS {CONTENT_TABLE}_ad AFTER DELETE ON {CONTENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, chat_id) VALUES ('delete', old.id, old.body, old.chat_id); END",
+    f"CREATE TRIGGER IF NOT EXISTS {CONTENT_TABLE}_au AFTER UPDATE ON {CONTENT_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, chat_id) VALUES ('delete', old.id, old.body, old.chat_id); "
+    f"INSERT INTO {FTS_TABLE}(rowid, body, chat_id) VALUES (new.id, new.body, new.chat_id); END",
+)
+_DROP = (f"DROP TABLE IF EXISTS {FTS_TABLE}", f"DROP TABLE IF EXISTS {CONTENT_TABLE}")
+
+for _ddl in _CREATE:
+    event.listen(Message.__table__, "after_create", DDL(_ddl))
+for _ddl in _DROP:
+    event.listen(Message.__table__, "after_drop", DDL(_ddl))
+
+
+def init_index(engine):
+    """Create the search tables on databases that predate them and backfill them.
+    An index from before messages_search (keyed by the messages rowid) is rebuilt."""
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:n"),
+            {"n": CONTENT_TABLE},
+        ).first()
+        if exists:
+            return
+        for ddl in _DROP + _CREATE:
+            conn.execute(text(ddl))
+        rows = conn.execute(text("SELECT id, chat_id, message_type, content FROM messages")).all()
+        _insert_rows(conn, [
+            {"id": r.id, "chat_id": r.chat_id, "body": extract_text(r.message_type, r.content)}
+            for r in rows
+        ])
+        logger.info("search: built %s with %d messages", FTS_TABLE, len(rows))
+
+
+def _insert_rows(conn, rows):
+    rows = [r for r in rows if r["body"]]
+    if rows:
+        conn.execute(
+            text(f"INSERT INTO {CONTENT_TABLE}(message_id, chat_id, body) VALUES (:id, :chat_id, :body)"),
+            rows,
+        )
+
+
+def index_message(db: Session, msg: Message):
+    """Index a newly flushed message (same transaction as the insert)."""
+    index_messages(db, [msg])
+
+
+def index_messages(db: Session, msgs):
+    """index_message for several messages in one executemany."""
+    _insert_rows(db, [{"id": m.id, "chat_id": m.chat_id, "body": extract_text(m.message_type, m.content)}
+                      for m in msgs])
+
+
+def reindex_message(db: Session, msg: Message):
+    """Replace the indexed text of an edited message."""
+    body = extract_text(msg.message_type, msg.content)
+    if not body:
+        db.execute(text(f"DELETE FROM {CONTENT_TABLE} WHERE message_id = :id"), {"id": msg.id})
+        return
+    db.execute(
+        text(f"INSERT INTO {CONTENT_TABLE}(message_id, chat_id, body) VALUES (:id, :chat_id, :body) "
+             f"ON CONFLICT(message_id) DO UPDATE SET body = excluded.body"),
+        {"id": msg.id, "chat_id": msg.chat_id, "body": body},
+    )
+
+
+def unindex_older_than(db: Session, cutoff):
+    """Drop index rows for messages the GC is about to delete."""
+    db.execute(
+        text(f"DELETE FROM {CONTENT_TABLE} WHERE message_id IN "
+             f"(SELECT id FROM messages WHERE created_at < :cutoff)")
+        .bindparams(bindparam("cutoff", type_=DateTime)),
+        {"cutoff": cutoff},
+    )
+
+
+def _build_match(query: str):
+    """Split a user query into an FTS MATCH expression (terms ANDed, each quoted
+    so FTS syntax characters are literal) and a list of short LIKE terms."""
+    match_terms, like_terms = [], []
+    for term in query.split():
+        if FTS_TOKENIZER.startswith("trigram") and len(term) < _TRIGRAM_MIN:
+            like_terms.append(term)
+        else:
+            match_terms.append('"' + term.replace('"', '""') + '"')
+    return " ".join(match_terms), like_terms
+
+
+def search_messages(db: Session, user_id: str, query: str, limit: int,
+                    after: Optional[Tuple[float, int]] = None, chat_id: str = None):
+    """Return [(message_id, score, snippet, rowid)] for the caller's chats, best
+    match first. `after` is the (score, rowid) of the last hit of the previous
+    page; the next page continues from it rather than re-ranking skipped rows."""
+    match, like_terms = _build_match(query)
+    params = {"user_id": user_id, "limit": limit}
+    where = ["s.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = :user_id)"]
+    if chat_id:
+        where.append("s.chat_id = :chat_id")
+        params["chat_id"] = chat_id
+    for i, term in enumerate(like_terms):
+        escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append(f"s.body LIKE :like{i} ESCAPE '\\'")
+        params[f"like{i}"] = f"%{escaped}%"
+    if match:
+        where.append(f"{FTS_TABLE} MATCH :match")
+        params["match"] = match
+        score = f"bm25({FTS_TABLE})"
+        snippet = f"snippet({FTS_TABLE}, 0, '<b>', '</b>', '…', 16)"
+    else:
+        # LIKE-only queries have no relevance signal; newest first
+        score, snippet = "0.0", "substr(s.body, 1, 64)"
+        if after is not None:
+            where.append(f"{FTS_TABLE}.rowid < :after_rowid")
+    if after is not None:
+        params["after_score"], params["after_rowid"] = after
+    hits = (
+        f"SELECT s.message_id AS message_id, {score} AS score, {snippet} AS snippet, "
+        f"{FTS_TABLE}.rowid AS rowid "
+        f"FROM {FTS_TABLE} JOIN {CONTENT_TABLE} AS s ON s.id = {FTS_TABLE}.rowid "
+        f"WHERE {' AND '.join(where)}"
+    )
+    if match:
+        # Materialized so bm25() runs once per hit, not again in the `after` filter
+        sql = f"WITH hits AS MATERIALIZED ({hits}) SELECT * FROM hits"
+        if after is not None:
+            sql += " WHERE score > :after_score OR (score = :after_score AND rowid > :after_rowid)"
+        sql += " ORDER BY score, rowid LIMIT :limit"
+    else:
+        sql = f"{hits} ORDER BY {FTS_TABLE}.rowid DESC LIMIT :limit"
+    return db.execute(text(sql), params).all()
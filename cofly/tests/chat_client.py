@@ -76,8 +76,15 @@ class WSListener:
                 print("[WS] ping/pong 失败", flush=True)
                 return
             print("[WS] 已连接", flush=True)
+            # 按 pong 下发的 PingInterval 定期 ping，否则服务端会当作断线回收连接
+            ping_interval = json.loads(frame.payload).get("PingInterval", 120)
+            last_ping, seq = time.monotonic(), 1
 
             while not self._stop:
+                if time.monotonic() - last_ping >= ping_interval:
+                    seq += 1
+                    await ws.send(make_frame(seq_id=seq, method=0, headers={"type": "ping"}))
+                    last_ping = time.monotonic()
                 try:
                     raw = await asyncio.wait_for(ws.recv(), timeout=2.0)
                 except asyncio.TimeoutError:
@@ -0,0 +1,44 @@
+"""
+测试公共夹具 — 重建数据库、同步/异步测试客户端
+
+测试模块按需使用：
+    pytestmark = pytest.mark.usefixtures("fresh_db")
+
+辅助函数见 helpers.py。
+"""
+
+import sys
+import os
+
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient, ASGITransport
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine, Base
+from main import app
+from ws_manager import ws_manager
+
+
+@pytest.fixture
+def fresh_db():
+    """Empty tables and no connections or queued events, both before and after the test."""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    ws_manager.reset()
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def sc():
+    return TestClient(app)
+
+
+@pytest_asyncio.fixture
+async def client():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
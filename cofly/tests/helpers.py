@@ -0,0 +1,111 @@
+"""
+测试辅助 — 假 WebSocket、注册并登录用户、鉴权头、发送消息
+
+测试模块直接导入（pytest 会把 tests 目录加入 sys.path）：
+    from helpers import FakeWS, auth, setup_user
+"""
+
+import asyncio
+import json
+
+from database import SessionLocal
+from fanout import fanout
+from models import User
+from proto import parse_frame
+
+
+class FakeWS:
+    """Stands in for a server-side WebSocket; keeps every frame written, each write taking `delay` seconds."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.frames = []
+        self.closed = None
+
+    async def accept(self):
+        pass
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(self.delay)
+        self.frames.append(data)
+
+    async def close(self, code=1000, reason=""):
+        self.closed = code
+
+    @property
+    def events(self):
+        return [json.loads(parse_frame(f).payload) for f in self.frames]
+
+
+def setup_user(sc, name, pwd="123"):
+    r = sc.post("/cofly/register", json={
+        "username": name, "password": pwd, "display_name": name.title(),
+    })
+    uid = r.json()["data"]["user_id"]
+    r = sc.post("/open-apis/auth/v3/tenant_access_token/internal",
+                json={"app_id": name, "app_secret": pwd})
+    return uid, r.json()["tenant_access_token"]
+
+
+async def setup_user_async(c, name, pwd="123"):
+    r = await c.post("/cofly/register", json={
+        "username": name, "password": pwd, "display_name": name.title(),
+    })
+    uid = r.json()["data"]["user_id"]
+    r = await c.post("/open-apis/auth/v3/tenant_access_token/internal",
+                     json={"app_id": name, "app_secret": pwd})
+    return uid, r.json()["tenant_access_token"]
+
+
+def auth(token, **extra):
+    return {"Authorization": f"Bearer {token}", **extra}
+
+
+def send(sc, token, receive_id, content, msg_type="text", **fields):
+    """Send to an open_id and return the response data; extra fields (uuid, ...) go in the body."""
+    r = sc.post(
+        "/open-apis/im/v1/messages?receive_id_type=open_id",
+        json={"receive_id": receive_id, "msg_type": msg_type, "content": content, **fields},
+        headers=auth(token),
+    )
+    assert r.json()["code"] == 0
+    return r.json()["data"]
+
+
+async def send_async(c, token, receive_id, content, msg_type="text", headers=None, **fields):
+    """send() for an async client; `headers` are added to the auth header."""
+    r = await c.post(
+        "/open-apis/im/v1/messages?receive_id_type=open_id",
+        json={"receive_id": receive_id, "msg_type": msg_type, "content": content, **fields},
+        headers=auth(token, **(headers or {})),
+    )
+    assert r.json()["code"] == 0
+    return r.json()["data"]
+
+
+async def send_and_drain(c, token, receive_id, text):
+    """Send a text message and wait for its fan-out; returns the message_id."""
+    sent = await send_async(c, token, receive_id, text_content(text))
+    await fanout.drain()
+    return sent["message_id"]
+
+
+def text_content(s):
+    return json.dumps({"text": s})
+
+
+def bulk_users(n):
+    """Users that never log in; skips bcrypt so large memberships stay fast to set up."""
+    db = SessionLocal()
+    users = [User(username=f"agent{i}", password_hash="") for i in range(n)]
+    db.add_all(users)
+    db.commit()
+    ids = [u.id for u in users]
+    db.close()
+    return ids
+
+
+def event_texts(events):
+    """The texts of the im.message.receive_v1 text events among `events`, in order."""
+    return [json.loads(e["event"]["message"]["content"])["text"] for e in events
+            if e["header"]["event_type"] == "im.message.receive_v1" and e["event"]["message"]["message_type"] == "text"]
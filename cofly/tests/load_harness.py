@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Cofly 端到端压测工具 — 模拟 N 个 bot 与 M 个用户通过 WebSocket 收发消息
+
+每个 bot / 用户都是一个 CoflyClient（HTTP）加一条 WS 长连接（make_frame ping/pong）：
+  用户：按 --mix 比例发消息、编辑（PATCH）自己的消息、加 reaction、上传图片并发图片消息
+  bot：收到用户消息后回复，并以 PATCH 模拟流式输出（--bot-patches 次）
+
+统计（JSON 输出，便于版本间对比）：
+  - 各操作吞吐与 HTTP 延迟 p50/p95/p99、错误数
+  - 发送到对端收到事件的延迟 p50/p95/p99（用户→bot、bot→用户、PATCH→update）
+  - 每 --sample-interval 秒采样一次：客户端连接数、服务端连接数、服务端 RSS（读 /metrics）
+
+重连风暴（--storm-bots N --storm-at T）：另有 N 个只保持连接的 bot，在第 T 秒同时断线，
+再按 SDK 的方式重连：先等待 0..ReconnectNonce 秒随机抖动，经 ws_endpoint 获取地址后连接
+/ws，被拒绝则隔 ReconnectInterval 秒重试（ClientConfig 取自最近一次 pong / ws_endpoint）。
+报告给出全部重连完成的耗时、被拒次数，以及已连接用户在风暴前 / 风暴期间的投递延迟。
+
+使用方式：
+    # 自动启动一个使用临时数据库的本地 cofly
+    python tests/load_harness.py --start-server --bots 5 --users 50 --duration 60
+
+    # 压测已启动的实例（需关闭注册 token 或通过 --registration-token 传入）
+    python tests/load_harness.py --base-url http://localhost:8000 --output result.json
+
+    # 500 个 bot 在第 20 秒模拟服务端重启后的重连风暴
+    python tests/load_harness.py --start-server --storm-bots 500 --storm-at 20 --duration 180
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from proto import make_frame, parse_frame, get_header
+
+from test_clawdbot import CoflyClient, _make_tiny_png
+
+COFLY_DIR = os.path.join(os.path.dirname(__file__), "..")
+DEFAULT_MIX = "message=70,patch=15,reaction=10,media=5"
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+
+    def pick(p):
+        return round(s[min(len(s) - 1, int(len(s) * p))] * 1000, 2)
+
+    return {"count": len(s), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def _parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("message", "patch", "reaction", "media"):
+            raise SystemExit(f"unknown mix entry: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+# ── 服务端 ──
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(**env_overrides):
+    """Start uvicorn on a free port with a throwaway database; returns (process, base_url, tmpdir).
+    Keyword arguments are extra environment variables (COFLY_* settings)."""
+    tmpdir = tempfile.mkdtemp(prefix="cofly-load-")
+    port = _free_port()
+    env = dict(os.environ, COFLY_DB_PATH=os.path.join(tmpdir, "load.db"), COFLY_REGISTRATION_TOKEN="",
+               **env_overrides)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=COFLY_DIR, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return proc, base_url, tmpdir
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("cofly did not start within 30s")
+
+
+def scrape_server(base_url):
+    """(connections, rss_bytes) from /metrics; None for what is unavailable."""
+    try:
+        text = requests.get(base_url + "/metrics", timeout=5).text
+    except requests.RequestException:
+        return None, None
+    values = {}
+    for name in ("cofly_ws_connections", "process_resident_memory_bytes"):
+        m = re.search(rf"^{name} (\S+)$", text, re.M)
+        values[name] = float(m.group(1)) if m else None
+    return values["cofly_ws_connections"], values["process_resident_memory_bytes"]
+
+
+# ── 统计 ──
+
+
+class Stats:
+    def __init__(self):
+        self.http = {}           # op -> [seconds]
+        self.errors = {}         # op -> count
+        self.delivery = {}       # kind -> [seconds]
+        self.delivery_log = []   # (t, kind, seconds) of every delivery, for phase breakdowns
+        self.events = {}         # event_type -> count
+        self.sent_at = {}        # message_id -> (kind, t0)
+        self.received_at = {}    # message_id -> t (events that beat the HTTP response)
+        self.patched_at = {}     # (message_id, content) -> t0
+        self.samples = []
+
+    def http_done(self, op, seconds):
+        self.http.setdefault(op, []).append(seconds)
+
+    def http_failed(self, op):
+        self.errors[op] = self.errors.get(op, 0) + 1
+
+    def _delivered(self, kind, seconds):
+        self.delivery.setdefault(kind, []).append(seconds)
+        self.delivery_log.append((time.perf_counter(), kind, seconds))
+
+    def message_sent(self, message_id, kind, t0):
+        t = self.received_at.pop(message_id, None)
+        if t is not None:
+            self._delivered(kind, t - t0)
+        else:
+            self.sent_at[message_id] = (kind, t0)
+
+    def message_received(self, message_id, t):
+        sent = self.sent_at.pop(message_id, None)
+        if sent is not None:
+            self._delivered(sent[0], t - sent[1])
+        else:
+            self.received_at[message_id] = t
+
+    def update_received(self, message_id, content, t):
+        t0 = self.patched_at.pop((message_id, content), None)
+        if t0 is not None:
+            self._delivered("patch_to_update", t - t0)
+
+
+# ── 模拟客户端 ──
+
+
+class Agent:
+    """One simulated account: an HTTP client plus a WebSocket connection."""
+
+    def __init__(self, harness, username, is_bot):
+        self.h = harness
+        self.username = username
+        self.is_bot = is_bot
+        self.client = CoflyClient(harness.base_url)
+        self.user_id = None
+        self.connected = False
+        self.recent_sent = []      # message ids this agent sent
+        self.recent_received = []  # message ids this agent received
+        self.inbox = asyncio.Queue()
+        # Latest ClientConfig from a pong or ws_endpoint, as the SDK keeps it
+        self.client_config = {"ReconnectCount": 10, "ReconnectInterval": 3, "ReconnectNonce": 5}
+
+    async def http(self, op, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.h.pool, fn, *args)
+        except (Exception, SystemExit):
+            self.h.stats.http_failed(op)
+            return None
+        self.h.stats.http_done(op, time.perf_counter() - t0)
+        return result
+
+    def login(self):
+        if self.h.registration_token is not None:
+            requests.post(self.h.base_url + "/cofly/register", json={
+                "username": self.username, "password": "load", "registration_token": self.h.registration_token,
+            })
+        self.client.login(self.username, "load")
+        self.user_id = self.client.lookup_user(self.username)
+
+    async def run_ws(self, stop, drop=None):
+        """Hold a connection until `stop` (or `drop`, a simulated server-side disconnect)."""
+        uri = self.h.base_url.replace("http://", "ws://").replace("https://", "wss://")
+        uri = f"{uri}/ws?token={self.client.token}&device_id=load-{self.username}&service_id=1"
+        async with websockets.connect(uri, max_size=None) as ws:
+            self.connected = True
+            self.h.connections += 1
+            pinger = asyncio.create_task(self._ping(ws, stop))
+            try:
+                while not stop.is_set() and not (drop is not None and drop.is_set()):
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        continue
+                    self._on_frame(parse_frame(raw), time.perf_counter())
+            except websockets.ConnectionClosed:
+                pass
+            finally:
+                pinger.cancel()
+                self.connected = False
+                self.h.connections -= 1
+
+    async def _ping(self, ws, stop):
+        for seq in itertools.count(1):
+            await ws.send(make_frame(seq_id=seq, method=0, headers={"type": "ping"}))
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.h.ping_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_frame(self, frame, t):
+        if frame.method == 0 and get_header(frame, "type") == "pong" and frame.payload:
+            self.client_config = json.loads(frame.payload)
+            return
+        if frame.method != 1 or get_header(frame, "type") != "event":
+            return
+        event = json.loads(frame.payload)
+        event_type = event["header"]["event_type"]
+        stats = self.h.stats
+        stats.events[event_type] = stats.events.get(event_type, 0) + 1
+        message = event.get("event", {}).get("message", {})
+        if event_type == "im.message.receive_v1":
+            stats.message_received(message["message_id"], t)
+            self.recent_received = (self.recent_received + [message["message_id"]])[-20:]
+            if self.is_bot:
+                self.inbox.put_nowait(message["message_id"])
+        elif event_type == "im.message.update_v1":
+            stats.update_received(message["message_id"], message["content"], t)
+
+    # ── 用户行为 ──
+
+    async def _send_text(self, kind, text):
+        bot = random.choice(self.h.bots)
+        t0 = time.perf_counter()
+        data = await self.http("message", self.client.send_message, bot.user_id, text)
+        if data:
+            self.h.stats.message_sent(data["message_id"], kind, t0)
+            self.recent_sent = (self.recent_sent + [data["message_id"]])[-20:]
+
+    async def _patch(self, message_id, text):
+        content = json.dumps({"text": text})
+        self.h.stats.patched_at[(message_id, content)] = time.perf_counter()
+        await self.http("patch", self.client.patch_message, message_id, text)
+
+    async def act(self, op, n):
+        if op == "message" or (op in ("patch", "reaction") and not self.recent_sent + self.recent_received):
+            await self._send_text("user_to_bot", f"{self.username} says {n} " + "x" * self.h.message_bytes)
+        elif op == "patch":
+            if self.recent_sent:
+                await self._patch(random.choice(self.recent_sent), f"{self.username} edit {n}")
+        elif op == "reaction":
+            target = random.choice(self.recent_received or self.recent_sent)
+            await self.http("reaction", self.client.add_reaction, target, "THUMBSUP")
+        elif op == "media":
+            key = await self.http("media_upload", self.client.upload_image, self.h.png)
+            if key:
+                bot = random.choice(self.h.bots)
+                t0 = time.perf_counter()
+                data = await self.http("message", self.client.send_message, bot.user_id,
+                                       json.dumps({"image_key": key}), "image")
+                if data:
+                    self.h.stats.message_sent(data["message_id"], "user_to_bot", t0)
+
+    async def run_user(self, stop):
+        ops, weights = zip(*self.h.mix.items())
+        interval = 1.0 / self.h.rate
+        # Spread users over the first interval so they don't fire in lockstep
+        await asyncio.sleep(random.random() * interval)
+        for n in itertools.count():
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            await self.act(random.choices(ops, weights)[0], n)
+            await asyncio.sleep(max(0.0, interval - (time.perf_counter() - start)))
+
+    # ── 重连风暴 ──
+
+    def discover(self):
+        """POST ws_endpoint as the SDK does before every (re)connect."""
+        r = requests.post(self.h.base_url + "/callback/ws/endpoint",
+                          json={"AppID": self.username, "AppSecret": "load"}, timeout=30)
+        body = r.json()
+        if body.get("code") != 0:
+            raise RuntimeError(body.get("msg"))
+        self.client_config = body["data"]["ClientConfig"]
+        return True
+
+    async def connect(self, stop, drop=None, jitter=False):
+        """The SDK's connect loop (with jitter: as after a drop); returns the session task,
+        or None if it gave up."""
+        if jitter:
+            await asyncio.sleep(random.uniform(0, self.client_config["ReconnectNonce"]))
+        for _ in range(max(1, self.client_config["ReconnectCount"])):
+            if stop.is_set():
+                return None
+            if await self.http("ws_endpoint", self.discover):
+                session = asyncio.create_task(self.run_ws(stop, drop))
+                while not self.connected and not session.done():
+                    await asyncio.sleep(0.05)
+                if self.connected:
+                    return session
+                # Handshake rejected with 503 + Retry-After
+                await asyncio.gather(session, return_exceptions=True)
+            self.h.storm_rejections += 1
+            await asyncio.sleep(self.client_config["ReconnectInterval"])
+        return None
+
+    # ── bot 行为 ──
+
+    async def run_bot(self, stop):
+        while not stop.is_set():
+            try:
+                message_id = await asyncio.wait_for(self.inbox.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            t0 = time.perf_counter()
+            data = await self.http("reply", self.client.reply_message, message_id, "thinking")
+            if not data:
+                continue
+            self.h.stats.message_sent(data["message_id"], "bot_to_user", t0)
+            text = ""
+            for i in range(self.h.bot_patches):
+                text += f" chunk{i}" + "y" * self.h.message_bytes
+                await self._patch(data["message_id"], text)
+
+
+class Harness:
+    def __init__(self, args):
+        self.base_url = args.base_url.rstrip("/")
+        self.registration_token = args.registration_token
+        self.mix = _parse_mix(args.mix)
+        self.rate = args.rate
+        self.bot_patches = args.bot_patches
+        self.message_bytes = args.message_bytes
+        self.ping_interval = args.ping_interval
+        self.pool = ThreadPoolExecutor(max_workers=args.http_workers)
+        self.png = _make_tiny_png()
+        self.stats = Stats()
+        self.connections = 0
+        tag = args.tag or str(int(time.time()))
+        self.bots = [Agent(self, f"loadbot_{tag}_{i}", True) for i in range(args.bots)]
+        self.users = [Agent(self, f"loaduser_{tag}_{i}", False) for i in range(args.users)]
+        self.storm_bots = [Agent(self, f"loadstorm_{tag}_{i}", True) for i in range(args.storm_bots)]
+        self.storm_at = args.storm_at
+        self.storm_rejections = 0
+        self.storm = None
+
+    async def _sample(self, stop, interval, t_start):
+        while True:
+            conns, rss = await asyncio.get_running_loop().run_in_executor(self.pool, scrape_server, self.base_url)
+            self.stats.samples.append({
+                "t": round(time.perf_counter() - t_start, 1),
+                "client_connections": self.connections,
+                "server_connections": conns,
+                "server_rss_mb": round(rss / 2**20, 1) if rss else None,
+            })
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_storm(self, stop, drop, t_start):
+        """Drop every storm bot at once, then let them reconnect the way the SDK would."""
+        await asyncio.sleep(self.storm_at)
+        self.storm_rejections = 0
+        t_drop = time.perf_counter()
+        drop.set()
+        while any(a.connected for a in self.storm_bots):
+            await asyncio.sleep(0.05)
+
+        async def _back(agent):
+            session = await agent.connect(stop, jitter=True)
+            return session, (time.perf_counter() - t_drop if session else None)
+
+        results = await asyncio.gather(*(_back(a) for a in self.storm_bots))
+        t_recovered = time.perf_counter()
+        recovered = [t for _, t in results if t is not None]
+        self.storm = {
+            "bots": len(self.storm_bots),
+            "dropped_at_s": round(t_drop - t_start, 1),
+            "recovered": len(recovered),
+            "recovery_s": round(t_recovered - t_drop, 2),
+            "reconnect_latency": _percentiles(recovered),
+            "rejected_handshakes": self.storm_rejections,
+            "window": (t_drop, t_recovered),
+        }
+        return [session for session, _ in results if session]
+
+    async def run(self, duration, sample_interval):
+        loop = asyncio.get_running_loop()
+        agents = self.bots + self.users + self.storm_bots
+        await asyncio.gather(*(loop.run_in_executor(self.pool, a.login) for a in agents))
+
+        stop, drop = asyncio.Event(), asyncio.Event()
+        t_start = time.perf_counter()
+        # Handshakes over the admission limit are rejected; connect() retries them
+        sessions = await asyncio.gather(*(a.connect(stop, drop if a in self.storm_bots else None)
+                                          for a in agents))
+        connect_s = time.perf_counter() - t_start
+
+        t_start = time.perf_counter()
+        sampler = asyncio.create_task(self._sample(stop, sample_interval, t_start))
+        workers = [asyncio.create_task(b.run_bot(stop)) for b in self.bots]
+        workers += [asyncio.create_task(u.run_user(stop)) for u in self.users]
+        storm = asyncio.create_task(self._run_storm(stop, drop, t_start)) if self.storm_bots else None
+        await asyncio.sleep(duration)
+        stop.set()
+        await asyncio.gather(*workers, sampler, *filter(None, sessions), return_exceptions=True)
+        if storm is not None:
+            sessions = await storm
+            await asyncio.gather(*sessions, return_exceptions=True)
+        elapsed = time.perf_counter() - t_start
+        return self.report(elapsed, connect_s)
+
+    def _storm_report(self):
+        if self.storm is None:
+            return None
+        t_drop, t_recovered = self.storm.pop("window")
+        phases = {"before": {}, "during": {}, "after": {}}
+        for t, kind, seconds in self.stats.delivery_log:
+            phase = "before" if t < t_drop else "during" if t <= t_recovered else "after"
+            phases[phase].setdefault(kind, []).append(seconds)
+        self.storm["delivery_latency"] = {
+            phase: {kind: _percentiles(v) for kind, v in kinds.items()} for phase, kinds in phases.items()
+        }
+        return self.storm
+
+    def report(self, elapsed, connect_s):
+        s = self.stats
+        return {
+            "harness": "cofly_load",
+            "config": {
+                "base_url": self.base_url, "bots": len(self.bots), "users": len(self.users),
+                "mix": self.mix, "rate_per_user": self.rate, "bot_patches": self.bot_patches,
+                "message_bytes": self.message_bytes, "storm_bots": len(self.storm_bots),
+            },
+            "duration_s": round(elapsed, 1),
+            "connect_s": round(connect_s, 2),
+            "throughput_per_s": {op: round(len(v) / elapsed, 1) for op, v in s.http.items()},
+            "http_latency": {op: _percentiles(v) for op, v in s.http.items()},
+            "http_errors": s.errors,
+            "delivery_latency": {kind: _percentiles(v) for kind, v in s.delivery.items()},
+            "undelivered_messages": len(s.sent_at),
+            "events_received": s.events,
+            "storm": self._storm_report(),
+            "samples": s.samples,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cofly 端到端压测")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--start-server", action="store_true", help="启动本地 cofly（临时数据库）")
+    parser.add_argument("--registration-token", default=None, help="服务端开启注册 token 时传入")
+    parser.add_argument("--bots", type=int, default=5)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="压测时长（秒）")
+    parser.add_argument("--rate", type=float, default=1.0, help="每个用户每秒操作数")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"操作比例，默认 {DEFAULT_MIX}")
+    parser.add_argument("--bot-patches", type=int, default=3, help="bot 每条回复的流式 PATCH 次数")
+    parser.add_argument("--message-bytes", type=int, default=64, help="消息正文填充字节数")
+    parser.add_argument("--ping-interval", type=float, default=120)
+    parser.add_argument("--sample-interval", type=float, default=5)
+    parser.add_argument("--http-workers", type=int, default=64)
+    parser.add_argument("--storm-bots", type=int, default=0, help="重连风暴中同时断线的 bot 数")
+    parser.add_argument("--storm-at", type=float, default=10, help="压测开始后第几秒触发重连风暴")
+    parser.add_argument("--tag", default="", help="账号名后缀，默认取当前时间")
+    parser.add_argument("--output", default="", help="结果写入文件（默认输出到 stdout）")
+    args = parser.parse_args()
+
+    proc = tmpdir = None
+    if args.start_server:
+        proc, args.base_url, tmpdir = start_server()
+    try:
+        report = asyncio.run(Harness(args).run(args.duration, args.sample_interval))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    out = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
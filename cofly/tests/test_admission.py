@@ -0,0 +1,153 @@
+"""
+WS 握手准入与动态 ClientConfig 测试 — 重连风暴下的限流与重连间隔
+
+使用方式：
+    cd cofly && python -m pytest tests/test_admission.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+import shutil
+
+import pytest
+import requests
+import websockets
+from starlette.testclient import WebSocketDenialResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from admission import HandshakeAdmission, admission
+from database import SessionLocal
+from models import User
+from proto import make_frame, parse_frame, get_header
+
+from load_harness import start_server
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(admission, "tokens", float(admission.burst))
+    monkeypatch.setattr(admission, "_config", None)
+
+
+def _admission(**overrides):
+    args = dict(rate=10, burst=5, concurrency=3, ping_interval=120, reconnect_count=10,
+                interval=3, max_interval=60, nonce=5, max_nonce=120)
+    args.update(overrides)
+    return HandshakeAdmission(**args)
+
+
+def test_db_checkout_never_waits_for_held_connections():
+    # During a reconnect storm, async endpoints hold their connections across
+    # awaits; a checkout on the event loop must not wait for them to return
+    held = [SessionLocal() for _ in range(32)]
+    try:
+        for db in held:
+            db.query(User).first()
+        extra = SessionLocal()
+        assert extra.query(User).count() == 0
+        extra.close()
+    finally:
+        for db in held:
+            db.close()
+
+
+def test_rate_and_concurrency_limits():
+    a = _admission()
+    assert [a.try_acquire() for _ in range(4)] == [True, True, True, False]   # 3 in flight
+    a.release()
+    a.release()
+    a.release()
+    assert [a.try_acquire() for _ in range(3)] == [True, True, False]         # burst of 5 spent
+    a.release()
+    a.release()
+    a.tokens = 1.0
+    assert a.try_acquire()
+
+
+def test_zero_burst_and_concurrency_admit_one_at_a_time():
+    a = _admission(burst=0, concurrency=0)
+    assert a.load() == 0.0
+    assert a.try_acquire()
+    assert a.load() == 1.0
+    assert not a.try_acquire()
+    assert a.client_config(connections=10)["ReconnectInterval"] == 60
+    a.release()
+
+
+def test_client_config_scales_with_connections_and_load():
+    a = _admission()
+    idle = a.client_config(connections=10)
+    assert idle == {"ReconnectCount": 10, "ReconnectInterval": 3, "ReconnectNonce": 5, "PingInterval": 120}
+
+    # 500 connections at 10 handshakes/s need at least 50s of jitter
+    a._config = None
+    assert a.client_config(connections=500)["ReconnectNonce"] == 50
+
+    # Fully loaded: longest interval, jitter doubled up to the cap
+    a._config = None
+    a.tokens = 0.0
+    loaded = a.client_config(connections=500)
+    assert loaded["ReconnectInterval"] == 60
+    assert loaded["ReconnectNonce"] == 100
+    assert all(isinstance(v, int) for v in loaded.values())
+
+
+def test_rejected_handshakes_get_retry_hint(sc, monkeypatch):
+    sc.post("/cofly/register", json={"username": "bot", "password": "123"})
+    monkeypatch.setattr(admission, "tokens", 0.0)
+    monkeypatch.setattr(admission, "rate", 1e-6)
+
+    r = sc.post("/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+    assert r.json()["code"] == 1
+    retry_after = r.json()["data"]["retry_after"]
+    assert 1 <= retry_after <= 120
+    assert r.headers["Retry-After"] == str(retry_after)
+
+    with pytest.raises(WebSocketDenialResponse) as exc:
+        with sc.websocket_connect("/ws?token=anything"):
+            pass
+    assert exc.value.status_code == 503
+    assert 1 <= int(exc.value.headers["Retry-After"]) <= 120
+    assert admission.in_flight == 0
+
+
+def test_pong_carries_client_config(sc):
+    sc.post("/cofly/register", json={"username": "bot", "password": "123"})
+    r = sc.post("/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+    data = r.json()["data"]
+    assert data["ClientConfig"]["ReconnectNonce"] >= 1
+    url = data["URL"]
+    with sc.websocket_connect(url[url.index("/ws"):]) as ws:
+        ws.send_bytes(make_frame(seq_id=1, method=0, headers={"type": "ping"}))
+        pong = parse_frame(ws.receive_bytes())
+        assert get_header(pong, "type") == "pong"
+        assert json.loads(pong.payload) == data["ClientConfig"]
+    assert admission.in_flight == 0
+
+
+def test_rejection_reaches_the_client_on_a_real_server():
+    # BURST=0 is clamped to 1: discovery takes the only token, so /ws is turned away
+    proc, base_url, tmpdir = start_server(COFLY_WS_HANDSHAKE_BURST="0", COFLY_WS_HANDSHAKE_RATE="0.001")
+
+    async def handshake(url):
+        try:
+            async with websockets.connect(url):
+                pass
+        except websockets.InvalidStatus as e:
+            return e.response
+
+    try:
+        requests.post(base_url + "/cofly/register", json={"username": "bot", "password": "123"})
+        r = requests.post(base_url + "/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+        assert r.status_code == 200
+        url = r.json()["data"]["URL"]
+        response = asyncio.run(handshake(base_url.replace("http://", "ws://") + url[url.index("/ws"):]))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
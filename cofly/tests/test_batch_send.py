@@ -0,0 +1,100 @@
+"""
+批量发送测试 — 一次请求多条消息（混合接收方），单事务持久化，逐条结果按序返回，扇出合并
+
+使用方式：
+    cd cofly && python -m pytest tests/test_batch_send.py -v
+"""
+
+import sys
+import os
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fanout import fanout
+from helpers import FakeWS, auth, event_texts, setup_user_async, text_content
+from idempotency import idempotency_cache
+from ws_manager import ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db):
+    idempotency_cache.clear()
+
+
+async def _batch(c, token, messages, **params):
+    r = await c.post("/open-apis/im/v1/messages/batch_send", params=params, json={"messages": messages},
+                     headers=auth(token))
+    return r.json()
+
+
+@pytest.mark.asyncio
+async def test_batch_send_mixed_receivers_in_order(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    carol_id, _ = await setup_user_async(client, "carol")
+    group_id = (await client.post("/open-apis/im/v1/chats", headers=auth(a_tok), json={
+        "name": "team", "user_id_list": [bob_id, carol_id],
+    })).json()["data"]["chat_id"]
+    bob_ws = FakeWS()
+    ws_manager.register(bob_id, bob_ws)
+
+    body = await _batch(client, a_tok, [
+        {"receive_id": bob_id, "content": text_content("text")},
+        {"receive_id": bob_id, "msg_type": "image", "content": json.dumps({"image_key": "img_1"})},
+        {"receive_id": group_id, "receive_id_type": "chat_id", "content": text_content("to team")},
+        {"receive_id": "nobody", "content": text_content("lost")},
+        {"receive_id": carol_id, "content": text_content("hi carol")},
+    ])
+    assert body["code"] == 0
+    items = body["data"]["items"]
+    assert [i["code"] for i in items] == [0, 0, 0, 1, 0]
+    assert items[3]["msg"] == "receiver not found"
+    p2p_chat = items[0]["data"]["chat_id"]
+    assert items[1]["data"]["chat_id"] == p2p_chat
+    assert items[2]["data"]["chat_id"] == group_id
+    await fanout.drain()
+
+    # bob is online and gets all three events in send order; carol's are queued
+    assert event_texts(bob_ws.events) == ["text", "to team"]
+    assert [e["event"]["message"]["message_type"] for e in bob_ws.events] == ["text", "image", "text"]
+    assert event_texts(ws_manager.pending(carol_id)) == ["to team", "hi carol"]
+    assert ws_manager.pending(alice_id)[-1]["header"]["event_type"] == "cofly.message.ack"
+
+    r = await client.get(f"/open-apis/im/v1/chats/{p2p_chat}/messages", headers=auth(a_tok))
+    assert [m["msg_type"] for m in r.json()["data"]["items"]] == ["text", "image"]
+    chats = (await client.get("/open-apis/im/v1/chats", headers=auth(a_tok))).json()["data"]["items"]
+    assert {c["chat_id"] for c in chats} >= {p2p_chat, group_id}
+
+
+@pytest.mark.asyncio
+async def test_batch_send_is_idempotent_per_item(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    messages = [
+        {"receive_id": bob_id, "content": text_content("one"), "uuid": "u-1"},
+        {"receive_id": bob_id, "content": text_content("one again"), "uuid": "u-1"},
+        {"receive_id": bob_id, "content": text_content("two"), "uuid": "u-2"},
+    ]
+    first = (await _batch(client, a_tok, messages))["data"]["items"]
+    assert first[0] == first[1]
+    idempotency_cache.clear()
+    again = (await _batch(client, a_tok, messages))["data"]["items"]
+    assert again == first
+    await fanout.drain()
+    assert event_texts(ws_manager.pending(bob_id)) == ["one", "two"]
+
+
+@pytest.mark.asyncio
+async def test_batch_send_limits(client, monkeypatch):
+    from routers import message_router
+    monkeypatch.setattr(message_router, "MESSAGE_BATCH_MAX", 2)
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    assert (await _batch(client, a_tok, []))["code"] == 1
+    too_many = [{"receive_id": bob_id, "content": text_content(str(i))} for i in range(3)]
+    assert (await _batch(client, a_tok, too_many))["code"] == 1
+    body = await _batch(client, a_tok, [{"receive_id": "c", "content": text_content("x")}], receive_id_type="email")
+    assert body["data"]["items"][0]["msg"] == "unsupported receive_id_type"
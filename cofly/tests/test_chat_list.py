@@ -0,0 +1,86 @@
+"""
+会话列表测试 — 最后一条消息预览、未读数、分页
+
+使用方式：
+    cd cofly && python -m pytest tests/test_chat_list.py -v
+"""
+
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import auth, send, setup_user
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+def test_list_chats_preview_and_unread(sc):
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    send(sc, a_tok, bob_id, '{"text":"one"}')
+    sent = send(sc, a_tok, bob_id, '{"text":"two"}')
+
+    # bob: 2 unread, preview is the latest text
+    r = sc.get("/open-apis/im/v1/chats", headers=auth(b_tok))
+    items = r.json()["data"]["items"]
+    assert len(items) == 1
+    assert items[0]["unread_count"] == 2
+    last = items[0]["last_message"]
+    assert last["message_id"] == sent["message_id"]
+    assert last["preview"] == "two"
+    assert last["sender_id"] == alice_id
+
+    # alice sent them, so nothing is unread for her
+    r = sc.get("/open-apis/im/v1/chats", headers=auth(a_tok))
+    assert r.json()["data"]["items"][0]["unread_count"] == 0
+
+    # bob reads the chat
+    r = sc.post(f"/cofly/chats/{sent['chat_id']}/read", headers=auth(b_tok))
+    assert r.json()["code"] == 0
+    r = sc.get("/open-apis/im/v1/chats", headers=auth(b_tok))
+    assert r.json()["data"]["items"][0]["unread_count"] == 0
+
+
+def test_list_chats_post_preview_and_patch(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    post = '{"zh_cn":{"title":"","content":[[{"tag":"md","text":"rich"}]]}}'
+    sent = send(sc, a_tok, bob_id, post, msg_type="post")
+    r = sc.get("/open-apis/im/v1/chats", headers=auth(b_tok))
+    assert r.json()["data"]["items"][0]["last_message"]["preview"] == "rich"
+
+    sc.patch(f"/open-apis/im/v1/messages/{sent['message_id']}",
+             json={"msg_type": "text", "content": '{"text":"edited"}'},
+             headers=auth(a_tok))
+    r = sc.get("/open-apis/im/v1/chats", headers=auth(b_tok))
+    assert r.json()["data"]["items"][0]["last_message"]["preview"] == "edited"
+
+
+def test_list_chats_paging(sc):
+    _, a_tok = setup_user(sc, "alice")
+    peers = []
+    for i in range(5):
+        uid, _ = setup_user(sc, f"bot{i}")
+        peers.append(uid)
+        send(sc, a_tok, uid, f'{{"text":"hi {i}"}}')
+
+    seen = []
+    page_token = ""
+    while True:
+        r = sc.get("/open-apis/im/v1/chats",
+                   params={"page_size": 2, "page_token": page_token},
+                   headers=auth(a_tok))
+        data = r.json()["data"]
+        seen.extend(item["last_message"]["preview"] for item in data["items"])
+        if not data["has_more"]:
+            break
+        page_token = data["page_token"]
+
+    # Most recently active first, each chat exactly once
+    assert seen == [f"hi {i}" for i in reversed(range(5))]
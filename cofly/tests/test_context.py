@@ -0,0 +1,125 @@
+"""
+上下文窗口测试 — /cofly/chats/{chat_id}/context 返回某消息前后 N 条（或最新 N 条），
+字节预算裁剪、引用消息内联，由每会话最近消息缓存（发送路径保温）或一次索引范围查询提供
+
+使用方式：
+    cd cofly && python -m pytest tests/test_context.py -v
+"""
+
+import sys
+import os
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine
+from helpers import auth, setup_user, text_content
+from history import recent_messages
+from metrics import HISTORY_CACHE
+from query_stats import assert_max_queries
+from recipients import recipient_cache
+from routers import message_router
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    recent_messages.clear()
+    monkeypatch.setattr(recent_messages, "depth", 10)
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0)
+
+
+def _texts(items):
+    return [json.loads(i["body"]["content"])["text"] for i in items]
+
+
+@pytest.fixture
+def chat(sc):
+    """alice/bob p2p chat with messages m0..m29; m25 quotes m2."""
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    ids = []
+    for i in range(30):
+        if i == 25:
+            r = sc.post(f"/open-apis/im/v1/messages/{ids[2]}/reply", headers=auth(b_tok),
+                        json={"msg_type": "text", "content": text_content("m25")})
+        else:
+            r = sc.post("/open-apis/im/v1/messages?receive_id_type=open_id", headers=auth(a_tok),
+                        json={"receive_id": bob_id, "msg_type": "text", "content": text_content(f"m{i}")})
+        ids.append(r.json()["data"]["message_id"])
+    chat_id = r.json()["data"]["chat_id"]
+    return {"a_tok": a_tok, "b_tok": b_tok, "bob": bob_id, "ids": ids, "chat_id": chat_id}
+
+
+def _context(sc, chat, token=None, **params):
+    r = sc.get(f"/cofly/chats/{chat['chat_id']}/context", params=params, headers=auth(token or chat["a_tok"]))
+    return r.json()
+
+
+def test_recent_messages_come_from_the_warm_cache(sc, chat):
+    data = _context(sc, chat, before=5)["data"]
+    assert _texts(data["items"]) == ["m25", "m26", "m27", "m28", "m29"]
+    assert data["has_more"] is True
+    assert _texts([data["items"][0]["parent_message"]]) == ["m2"]
+
+    # The first request loaded the chat's window; sends keep it current
+    sc.post("/open-apis/im/v1/messages?receive_id_type=open_id", headers=auth(chat["a_tok"]),
+            json={"receive_id": chat["bob"], "msg_type": "text", "content": text_content("m30")})
+    with assert_max_queries(engine, 1):                           # the token's user lookup only
+        data = _context(sc, chat, before=3, with_parents=False)["data"]
+    assert _texts(data["items"]) == ["m28", "m29", "m30"]
+
+    # Edits too
+    sc.patch(f"/open-apis/im/v1/messages/{chat['ids'][29]}", headers=auth(chat["a_tok"]),
+             json={"msg_type": "text", "content": text_content("m29 edited")})
+    data = _context(sc, chat, before=2)["data"]
+    assert _texts(data["items"]) == ["m29 edited", "m30"]
+    assert data["items"][0]["version"] == 1
+    assert 'cofly_history_cache_total{outcome="hit"}' in sc.get("/metrics").text
+
+
+def test_window_around_a_message(sc, chat):
+    ids = chat["ids"]
+    # Inside the cached window
+    data = _context(sc, chat, message_id=ids[27], before=3, after=1)["data"]
+    assert _texts(data["items"]) == ["m24", "m25", "m26", "m27", "m28"]
+    # Older than the window: one range query, same shape
+    misses = HISTORY_CACHE.labels("miss").value
+    with assert_max_queries(engine, 4):
+        data = _context(sc, chat, message_id=ids[6], before=3, after=2, with_parents=False)["data"]
+    assert HISTORY_CACHE.labels("miss").value == misses + 1
+    assert _texts(data["items"]) == ["m3", "m4", "m5", "m6", "m7", "m8"]
+    assert data["has_more"] is True
+    data = _context(sc, chat, message_id=ids[1], before=5)["data"]
+    assert _texts(data["items"]) == ["m0", "m1"]
+    assert data["has_more"] is False
+
+    # The cache and the database agree on the same request
+    cached = _context(sc, chat, message_id=ids[28], before=8, after=1)["data"]
+    recent_messages.clear()
+    recent_messages.depth = 5
+    recipient_cache.clear()
+    misses = HISTORY_CACHE.labels("miss").value
+    with assert_max_queries(engine, 7):                           # window load, anchor, range x2, m2
+        fresh = _context(sc, chat, message_id=ids[28], before=8, after=1)["data"]
+    assert HISTORY_CACHE.labels("miss").value == misses + 1
+    assert fresh == cached
+
+    assert _context(sc, chat, message_id="nope")["code"] == 1
+    _, e_tok = setup_user(sc, "eve")
+    assert _context(sc, chat, token=e_tok)["code"] == 1
+
+
+def test_byte_budget_keeps_the_anchor_and_its_neighbours(sc, chat):
+    ids = chat["ids"]
+    size = len(text_content("m10"))
+    data = _context(sc, chat, message_id=ids[20], before=5, after=5, max_bytes=4 * size)["data"]
+    # The anchor, then preceding messages, then following ones while they fit
+    assert _texts(data["items"]) == ["m17", "m18", "m19", "m20"]
+    assert data["has_more"] is True
+    # A quoted message counts against the budget too
+    data = _context(sc, chat, before=10, max_bytes=3 * size)["data"]
+    assert _texts(data["items"]) == ["m27", "m28", "m29"]
+    data = _context(sc, chat, message_id=ids[25], before=10, max_bytes=1)["data"]
+    assert _texts(data["items"]) == ["m25"]
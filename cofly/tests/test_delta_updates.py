@@ -0,0 +1,131 @@
+"""
+增量更新事件测试（cofly.message.delta_v1）
+
+使用方式：
+    cd cofly && python -m pytest tests/test_delta_updates.py -v
+"""
+
+import sys
+import os
+import json
+import threading
+
+import pytest
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from deltas import apply_ops, compute_ops
+from helpers import auth, send, setup_user
+from main import app
+from proto import make_frame, parse_frame
+from routers import message_router
+from ws_manager import ws_manager
+
+
+@pytest.fixture
+def sc():
+    # One event loop for HTTP and WS, so pushes reach the listener threads
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0)
+
+
+def test_compute_and_apply_ops():
+    assert compute_ops("hello", "hello world") == [{"op": "append", "text": " world"}]
+    assert compute_ops("same", "same") == []
+    for old, new in [("abc", "axc"), ("abc", ""), ("", "abc"), ("你好世界", "你好，世界！"), ("aaa", "aa")]:
+        assert apply_ops(old, compute_ops(old, new)) == new
+
+
+def _listen(sc, token, query, events, ready, expect):
+    with sc.websocket_connect(f"/ws?token={token}&device_id=d1&service_id=1{query}") as ws:
+        ws.send_bytes(make_frame(seq_id=1, method=0, headers={"type": "ping"}))
+        # Queued events are flushed on connect, so they may precede the pong
+        while parse_frame(raw := ws.receive_bytes()).method == 1:
+            events.append(json.loads(parse_frame(raw).payload))
+        ready.set()
+        while len(events) < expect:
+            frame = parse_frame(ws.receive_bytes())
+            if frame.method == 1:
+                events.append(json.loads(frame.payload))
+
+
+def test_delta_clients_get_ops_others_get_full_content(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    carol_id, c_tok = setup_user(sc, "carol")
+
+    delta_events, full_events = [], []
+    ready_b, ready_c = threading.Event(), threading.Event()
+    tb = threading.Thread(target=_listen, args=(sc, b_tok, "&update_mode=delta", delta_events, ready_b, 3), daemon=True)
+    tb.start()
+    ready_b.wait(timeout=3)
+
+    msg_id = send(sc, a_tok, bob_id, '{"text":"He"}')["message_id"]
+    for text in ("Hello", "Hello, world"):
+        sc.patch(f"/open-apis/im/v1/messages/{msg_id}",
+                 json={"msg_type": "text", "content": json.dumps({"text": text})},
+                 headers=auth(a_tok))
+    tb.join(timeout=5)
+
+    types = [e["header"]["event_type"] for e in delta_events]
+    assert types == ["im.message.receive_v1", "cofly.message.delta_v1", "cofly.message.delta_v1"]
+    content = delta_events[0]["event"]["message"]["content"]
+    version = 0
+    for evt in delta_events[1:]:
+        m = evt["event"]["message"]
+        assert m["base_version"] == version
+        content, version = apply_ops(content, m["ops"]), m["version"]
+    assert json.loads(content) == {"text": "Hello, world"}
+    assert version == 2
+
+    # A non-opted client keeps receiving full update_v1 events
+    msg2 = send(sc, a_tok, carol_id, '{"text":"x"}')["message_id"]
+    tc = threading.Thread(target=_listen, args=(sc, c_tok, "", full_events, ready_c, 2), daemon=True)
+    tc.start()
+    ready_c.wait(timeout=3)
+    sc.patch(f"/open-apis/im/v1/messages/{msg2}",
+             json={"msg_type": "text", "content": '{"text":"xy"}'}, headers=auth(a_tok))
+    tc.join(timeout=5)
+    update = full_events[-1]
+    assert update["header"]["event_type"] == "im.message.update_v1"
+    assert update["event"]["message"]["content"] == '{"text":"xy"}'
+    assert update["event"]["message"]["version"] == 1
+
+
+def test_delta_client_without_base_is_resynced_with_full_update(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    msg_id = send(sc, a_tok, bob_id, '{"text":"a"}')["message_id"]
+    sc.patch(f"/open-apis/im/v1/messages/{msg_id}",
+             json={"msg_type": "text", "content": '{"text":"ab"}'}, headers=auth(a_tok))
+    ws_manager.clear_pending()
+
+    # bob connects mid-stream: he has never seen version 1, so the next edit
+    # arrives as a full update, and the one after that as a delta
+    events, ready = [], threading.Event()
+    t = threading.Thread(target=_listen, args=(sc, b_tok, "&update_mode=delta", events, ready, 2), daemon=True)
+    t.start()
+    ready.wait(timeout=3)
+    for text in ("abc", "abcd"):
+        sc.patch(f"/open-apis/im/v1/messages/{msg_id}",
+                 json={"msg_type": "text", "content": json.dumps({"text": text})},
+                 headers=auth(a_tok))
+    t.join(timeout=5)
+
+    assert [e["header"]["event_type"] for e in events] == [
+        "im.message.update_v1", "cofly.message.delta_v1"]
+    assert events[0]["event"]["message"]["version"] == 2
+    assert events[1]["event"]["message"]["base_version"] == 2
+
+    # Resync path: GET returns content and version together
+    r = sc.get(f"/open-apis/im/v1/messages/{msg_id}", headers=auth(b_tok))
+    item = r.json()["data"]["items"][0]
+    assert item["version"] == 3
+    assert json.loads(item["body"]["content"]) == {"text": "abcd"}
@@ -0,0 +1,95 @@
+"""
+按设备区分的连接注册表测试 — device_id/service_id、同设备重连替换旧连接、O(1) 计数、按 user_id 分片
+
+使用方式：
+    cd cofly && python -m pytest tests/test_devices.py -v
+"""
+
+import sys
+import os
+import asyncio
+
+import pytest
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import FakeWS
+from main import app
+from ws_manager import WSManager, ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db):
+    yield
+    ws_manager.reset()
+
+
+@pytest.mark.asyncio
+async def test_same_device_replaces_old_connection():
+    stale, fresh, phone = FakeWS(), FakeWS(), FakeWS()
+    old = await ws_manager.connect("u1", stale, device_id="laptop", service_id="1")
+    await ws_manager.connect("u1", phone, device_id="phone", service_id="1")
+    new = await ws_manager.connect("u1", fresh, device_id="laptop", service_id="1")
+    await asyncio.sleep(0.01)   # the replaced socket is closed in the background
+
+    assert stale.closed == 4002
+    assert not old.active and new.active
+    assert ws_manager.connection_count() == 2
+    assert {c.ws for c in ws_manager.connections_of("u1")} == {fresh, phone}
+
+    # The replaced socket's handler unregistering itself must not drop its successor
+    ws_manager.disconnect(old)
+    assert ws_manager.connection_count() == 2
+
+    await ws_manager.push_event("u1", {"header": {"event_type": "x"}})
+    assert len(fresh.frames) == 1 and len(phone.frames) == 1 and not stale.frames
+
+
+@pytest.mark.asyncio
+async def test_connections_without_device_id_coexist():
+    a = await ws_manager.connect("u1", FakeWS())
+    b = await ws_manager.connect("u1", FakeWS())
+    assert a.device_id != b.device_id
+    assert ws_manager.connection_count() == 2
+    ws_manager.disconnect(a)
+    ws_manager.disconnect(a)
+    assert ws_manager.connection_count() == 1
+    assert ws_manager.is_online("u1")
+    ws_manager.disconnect(b)
+    assert not ws_manager.is_online("u1")
+    assert ws_manager.connection_count() == 0
+
+
+@pytest.mark.asyncio
+async def test_users_are_partitioned_across_shards():
+    manager = WSManager(4)
+    users = [f"u{i}" for i in range(200)]
+    for uid in users:
+        await manager.connect(uid, FakeWS())
+    sizes = [len(shard.connections) for shard in manager.shards]
+    assert sum(sizes) == manager.online_users() == 200
+    assert all(sizes)
+    assert all(uid in manager.shard_for(uid).connections for uid in users)
+
+    # Offline queues live on the same shard as the user's connections
+    manager.disconnect_user("u7")
+    await manager.push_event("u7", {"header": {"event_type": "x"}})
+    assert len(manager.pending("u7")) == 1
+    assert [len(q) for q in manager.pending_queues()] == [1]
+    conn = await manager.connect("u7", FakeWS())
+    assert manager.pending("u7") == []
+    assert conn.ws.frames
+
+
+def test_ws_handler_registers_device():
+    sc = TestClient(app)
+    r = sc.post("/cofly/register", json={"username": "bot", "password": "123"})
+    uid = r.json()["data"]["user_id"]
+    r = sc.post("/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+    url = r.json()["data"]["URL"]
+    path = url[url.index("/ws"):] + "&device_id=dev-1&service_id=7"
+    with sc.websocket_connect(path):
+        (conn,) = ws_manager.connections_of(uid)
+        assert (conn.device_id, conn.service_id) == ("dev-1", "7")
+    assert ws_manager.connection_count() == 0
@@ -36,7 +36,7 @@ from ws_manager import ws_manager
 def setup_db():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
-    ws_manager.connections.clear()
+    ws_manager.reset()
     yield
     Base.metadata.drop_all(bind=engine)
 
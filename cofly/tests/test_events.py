@@ -0,0 +1,222 @@
+"""
+HTTP 事件投递测试 — SSE 流（/cofly/events/stream）与长轮询（/cofly/events/poll），游标续传与批量投递
+
+使用方式：
+    cd cofly && python -m pytest tests/test_events.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import FakeWS, auth, send_and_drain, setup_user_async
+from main import app
+from routers import events_router, message_router
+from ws_manager import ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0)
+
+
+async def _poll(c, token, cursor, timeout=0, **params):
+    r = await c.get("/cofly/events/poll", params={"cursor": cursor, "timeout": timeout, **params},
+                    headers=auth(token))
+    data = r.json()["data"]
+    return [(e["header"]["event_type"], json.loads(e["event"]["message"]["content"])["text"])
+            for e in data["items"]], data["cursor"]
+
+
+class Stream:
+    """Drives the SSE endpoint over raw ASGI (httpx's ASGITransport buffers
+    the whole body, which never ends for a stream)."""
+
+    def __init__(self, token, cursor=None):
+        query = f"token={token}" + (f"&cursor={cursor}" if cursor is not None else "")
+        self.scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/cofly/events/stream", "raw_path": b"/cofly/events/stream",
+            "query_string": query.encode(), "headers": [(b"host", b"test")], "root_path": "",
+            "server": ("test", 80), "client": ("test", 1),
+        }
+        self.chunks = asyncio.Queue()
+        self.closed = asyncio.Event()
+
+    async def _receive(self):
+        await self.closed.wait()
+        return {"type": "http.disconnect"}
+
+    async def _send(self, message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            self.chunks.put_nowait(message["body"])
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(app(self.scope, self._receive, self._send))
+        assert await self.read() == b": connected\n\n"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.closed.set()
+        await asyncio.wait_for(self.task, 2)
+
+    async def read(self):
+        return await asyncio.wait_for(self.chunks.get(), 2)
+
+    async def records(self):
+        """(id, event_type, text) for each record of the next write."""
+        out = []
+        for record in (await self.read()).decode().strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in record.split("\n"))
+            event = json.loads(fields["data"])
+            text = json.loads(event["event"]["message"]["content"])["text"] if "message" in event["event"] else ""
+            out.append((int(fields["id"]), event["header"]["event_type"], text))
+        return out
+
+
+@pytest.mark.asyncio
+async def test_poll_batches_and_resumes_by_cursor(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    for text in ("one", "two", "three"):
+        await send_and_drain(client, a_tok, bob_id, text)
+
+    items, cursor = await _poll(client, b_tok, 0, limit=2)
+    assert items == [("im.message.receive_v1", "one"), ("im.message.receive_v1", "two")]
+    # Not acknowledged yet: a retry with the old cursor gets the same batch
+    assert (await _poll(client, b_tok, 0, limit=2))[0] == items
+
+    items, cursor = await _poll(client, b_tok, cursor)
+    assert items == [("im.message.receive_v1", "three")]
+    assert await _poll(client, b_tok, cursor) == ([], cursor)
+    assert ws_manager.pending(bob_id) == []
+
+    # Handed-out events are not rewritten: an edit arrives as its own update
+    msg_id = await send_and_drain(client, a_tok, bob_id, "draft")
+    items, cursor = await _poll(client, b_tok, cursor)
+    await client.patch(f"/open-apis/im/v1/messages/{msg_id}",
+                       json={"msg_type": "text", "content": '{"text":"final"}'},
+                       headers=auth(a_tok))
+    items, cursor = await _poll(client, b_tok, cursor)
+    assert items == [("im.message.update_v1", "final")]
+    await _poll(client, b_tok, cursor)
+    assert ws_manager.pending(bob_id) == []
+
+
+@pytest.mark.asyncio
+async def test_long_poll_wakes_on_new_event(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+
+    t0 = time.perf_counter()
+    waiting = asyncio.ensure_future(_poll(client, b_tok, 0, timeout=5))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+    await send_and_drain(client, a_tok, bob_id, "ping")
+    items, _ = await asyncio.wait_for(waiting, 2)
+    assert items == [("im.message.receive_v1", "ping")]
+    assert time.perf_counter() - t0 < 2
+
+    r = await client.get("/cofly/events/poll", params={"timeout": 0})
+    assert r.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_ws_connect_leaves_a_waiting_long_poll_attached(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+
+    waiting = asyncio.ensure_future(_poll(client, b_tok, 0, timeout=5))
+    await asyncio.sleep(0.1)
+    # A WebSocket comes and goes while the poll waits on bob's (empty) queue
+    conn = await ws_manager.connect(bob_id, FakeWS())
+    ws_manager.disconnect(conn)
+    await send_and_drain(client, a_tok, bob_id, "after")
+    items, _ = await asyncio.wait_for(waiting, 2)
+    assert items == [("im.message.receive_v1", "after")]
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_delivers_queued_then_live_events(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    await send_and_drain(client, a_tok, bob_id, "while away")
+
+    async with Stream(b_tok) as stream:
+        assert ws_manager.is_online(bob_id)
+        (queued,) = await stream.records()
+        assert queued[1:] == ("im.message.receive_v1", "while away")
+
+        await send_and_drain(client, a_tok, bob_id, "live")
+        (live,) = await stream.records()
+        assert live[1:] == ("im.message.receive_v1", "live")
+        assert live[0] > queued[0]
+    assert not ws_manager.is_online(bob_id)
+
+    # Offline again: resuming from the last id gets only what came after
+    await send_and_drain(client, a_tok, bob_id, "after")
+    async with Stream(b_tok, cursor=live[0]) as stream:
+        assert [r[1:] for r in await stream.records()] == [("im.message.receive_v1", "after")]
+
+    r = await client.get("/metrics")
+    assert 'cofly_http_events_delivered_total{transport="sse"}' in r.text
+
+
+@pytest.mark.asyncio
+async def test_sse_writes_a_burst_in_one_chunk(client):
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    async with Stream(b_tok) as stream:
+        for i in range(5):
+            await ws_manager.push_event(bob_id, {
+                "header": {"event_type": "cofly.message.ack"},
+                "event": {"message_id": f"m{i}", "status": "delivered"},
+            })
+        ids = [r[0] for r in await stream.records()]
+        assert len(ids) == 5 and ids == sorted(ids)
+
+
+@pytest.mark.asyncio
+async def test_sse_ids_are_the_queue_cursors(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    for text in ("one", "two"):
+        await send_and_drain(client, a_tok, bob_id, text)
+    # A poll hands out the first event's cursor without acknowledging it
+    _, first_cursor = await _poll(client, b_tok, 0, limit=1)
+
+    async with Stream(b_tok) as stream:
+        records = await stream.records()
+    assert [r[1:] for r in records] == [("im.message.receive_v1", "one"), ("im.message.receive_v1", "two")]
+    assert records[0][0] == first_cursor
+
+    # Resuming from "one" re-delivers only what the queue still holds after it
+    await send_and_drain(client, a_tok, bob_id, "three")
+    async with Stream(b_tok, cursor=records[0][0]) as stream:
+        assert [r[1:] for r in await stream.records()] == [("im.message.receive_v1", "three")]
+
+
+@pytest.mark.asyncio
+async def test_sse_registers_only_while_the_body_streams(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+
+    body = events_router._stream(bob_id, "", 0)
+    assert not ws_manager.is_online(bob_id)
+    assert await body.__anext__() == b": connected\n\n"
+    assert ws_manager.is_online(bob_id)
+    await send_and_drain(client, a_tok, bob_id, "written")
+    seen = int((await body.__anext__()).split(b"\n")[0].removeprefix(b"id: "))
+    # Pushed to the stream, but the client is gone before it is written
+    await send_and_drain(client, a_tok, bob_id, "unwritten")
+    await body.aclose()
+    assert not ws_manager.is_online(bob_id)
+
+    async with Stream(b_tok, cursor=seen) as stream:
+        (record,) = await stream.records()
+    assert record[1:] == ("im.message.receive_v1", "unwritten") and record[0] > seen
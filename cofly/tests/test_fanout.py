@@ -0,0 +1,75 @@
+"""
+异步扇出测试 — HTTP 响应不等待推送、同会话保序、ack 携带真实投递状态
+
+使用方式：
+    cd cofly && python -m pytest tests/test_fanout.py -v
+"""
+
+import sys
+import os
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fanout import fanout
+from helpers import FakeWS, auth, send_async, setup_user_async, text_content
+from ws_manager import ws_manager
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+@pytest.mark.asyncio
+async def test_response_does_not_wait_for_delivery(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    alice_ws, bob_ws = FakeWS(), FakeWS(delay=0.5)
+    ws_manager.register(alice_id, alice_ws)
+    ws_manager.register(bob_id, bob_ws)
+
+    t0 = time.perf_counter()
+    sent = await send_async(client, a_tok, bob_id, text_content("hi"))
+    assert time.perf_counter() - t0 < 0.5
+    assert bob_ws.events == []
+
+    await fanout.drain()
+    assert bob_ws.events[0]["event"]["message"]["message_id"] == sent["message_id"]
+    # The ack follows the fan-out and reports the real delivery outcome
+    types = [e["header"]["event_type"] for e in alice_ws.events]
+    assert types == ["cofly.message.sync_v1", "cofly.message.ack"]
+    assert alice_ws.events[-1]["event"]["status"] == "delivered"
+
+
+@pytest.mark.asyncio
+async def test_ack_reports_queued_when_receiver_offline(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    alice_ws = FakeWS()
+    ws_manager.register(alice_id, alice_ws)
+
+    await send_async(client, a_tok, bob_id, text_content("anyone?"))
+    await fanout.drain()
+    assert alice_ws.events[-1]["event"]["status"] == "queued"
+    assert len(ws_manager.pending(bob_id)) == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_order_preserved_and_updates_follow_receive(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    bob_ws = FakeWS(delay=0.05)
+    ws_manager.register(bob_id, bob_ws)
+
+    ids = [(await send_async(client, a_tok, bob_id, text_content(f"m{i}")))["message_id"] for i in range(3)]
+    r = await client.patch(
+        f"/open-apis/im/v1/messages/{ids[-1]}",
+        json={"msg_type": "text", "content": text_content("m2 edited")},
+        headers=auth(a_tok),
+    )
+    assert r.json()["code"] == 0
+    await fanout.drain()
+
+    seen = [(e["header"]["event_type"], e["event"]["message"]["message_id"]) for e in bob_ws.events]
+    assert seen == [("im.message.receive_v1", i) for i in ids] + [("im.message.update_v1", ids[-1])]
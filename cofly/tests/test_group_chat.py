@@ -0,0 +1,170 @@
+"""
+群聊测试 — 建群、入群、退群，以及群消息扇出（共享编码、离线批量入队）
+
+使用方式：
+    cd cofly && python -m pytest tests/test_group_chat.py -v
+"""
+
+import sys
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fanout import fanout
+from helpers import FakeWS, auth, setup_user_async, text_content
+from recipients import RecipientCache, recipient_cache
+from ws_manager import ws_manager, SharedEvent, build_message_event
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db):
+    recipient_cache.clear()
+
+
+async def _send_to_chat(c, token, chat_id, text):
+    r = await c.post(
+        "/open-apis/im/v1/messages?receive_id_type=chat_id",
+        json={"receive_id": chat_id, "msg_type": "text", "content": text_content(text)},
+        headers=auth(token),
+    )
+    return r.json()
+
+
+async def _members(c, token, chat_id, method, ids):
+    r = await c.request(method, f"/open-apis/im/v1/chats/{chat_id}/members",
+                        json={"id_list": ids}, headers=auth(token))
+    return r.json()
+
+
+def test_shared_event_payload_matches_per_recipient_encoding():
+    shared = SharedEvent(
+        build_message_event, sender_id="s", message_id="m", chat_id="c", chat_type="group",
+        message_type="text", content=json.dumps({"text": 'tricky "\x00app_id\x00" 文本'}),
+    )
+    for name in ("bot_a", "ünïcode", 'q"uote'):
+        assert shared.payload_for(name) == json.dumps(shared.event_for(name)).encode()
+        assert json.loads(shared.payload_for(name))["header"]["app_id"] == name
+
+
+@pytest.mark.asyncio
+async def test_group_fanout_online_and_offline(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    carol_id, _ = await setup_user_async(client, "carol")
+
+    r = await client.post("/open-apis/im/v1/chats", headers=auth(a_tok), json={
+        "name": "agents", "user_id_list": [bob_id], "bot_id_list": [carol_id, "nobody"],
+    })
+    data = r.json()["data"]
+    assert data["owner_id"] == alice_id
+    assert data["invalid_id_list"] == ["nobody"]
+    chat_id = data["chat_id"]
+
+    alice_ws, bob_ws = FakeWS(), FakeWS()
+    ws_manager.register(alice_id, alice_ws)
+    ws_manager.register(bob_id, bob_ws)
+
+    sent = await _send_to_chat(client, a_tok, chat_id, "hello group")
+    assert sent["code"] == 0
+    await fanout.drain()
+
+    event = bob_ws.events[0]
+    assert event["header"]["event_type"] == "im.message.receive_v1"
+    assert event["header"]["app_id"] == "bob"
+    assert event["event"]["message"]["chat_type"] == "group"
+    # carol is offline: her copy is queued with her own app_id
+    queued = ws_manager.pending(carol_id)
+    assert [e["header"]["app_id"] for e in queued] == ["carol"]
+    assert [e["header"]["event_type"] for e in alice_ws.events] == [
+        "cofly.message.sync_v1", "cofly.message.ack",
+    ]
+    assert alice_ws.events[-1]["event"]["status"] == "delivered"
+
+    # The group shows up in everyone's chat list
+    r = await client.get("/open-apis/im/v1/chats", headers=auth(a_tok))
+    item = r.json()["data"]["items"][0]
+    assert item["chat_type"] == "group" and item["name"] == "agents"
+
+
+@pytest.mark.asyncio
+async def test_join_leave_and_membership_checks(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    dave_id, d_tok = await setup_user_async(client, "dave")
+
+    r = await client.post("/open-apis/im/v1/chats", headers=auth(a_tok), json={"name": "g"})
+    chat_id = r.json()["data"]["chat_id"]
+    dave_ws = FakeWS()
+    ws_manager.register(dave_id, dave_ws)
+
+    # Non-members can neither post nor manage members
+    assert (await _send_to_chat(client, d_tok, chat_id, "let me in"))["code"] == 1
+    assert (await _members(client, d_tok, chat_id, "POST", [dave_id]))["code"] == 1
+
+    # Warm the recipient cache, then join: the next fan-out must include dave
+    await _send_to_chat(client, a_tok, chat_id, "before")
+    r = await client.patch(f"/open-apis/im/v1/chats/{chat_id}/members/me_join", headers=auth(d_tok))
+    assert r.json()["code"] == 0
+    await _send_to_chat(client, a_tok, chat_id, "after")
+    await fanout.drain()
+    texts = [json.loads(e["event"]["message"]["content"])["text"] for e in dave_ws.events]
+    assert texts == ["after"]
+
+    # A member adds bob; only the owner may remove others
+    r = await _members(client, d_tok, chat_id, "POST", [bob_id, "ghost"])
+    assert r["data"]["not_existed_id_list"] == ["ghost"]
+    assert (await _members(client, d_tok, chat_id, "DELETE", [bob_id]))["code"] == 1
+
+    # Leaving stops delivery
+    assert (await _members(client, d_tok, chat_id, "DELETE", [dave_id]))["code"] == 0
+    await _send_to_chat(client, a_tok, chat_id, "gone")
+    await fanout.drain()
+    assert len(dave_ws.events) == 1
+
+    # The owner leaving hands the group to the next member
+    assert (await _members(client, a_tok, chat_id, "DELETE", [alice_id]))["code"] == 0
+    r = await client.get("/open-apis/im/v1/chats", headers=auth(b_tok))
+    assert r.json()["data"]["items"][0]["owner_id"] == bob_id
+
+
+@pytest.mark.asyncio
+async def test_member_endpoints_reject_p2p(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    r = await client.post(
+        "/open-apis/im/v1/messages?receive_id_type=open_id",
+        json={"receive_id": bob_id, "msg_type": "text", "content": '{"text":"hi"}'},
+        headers=auth(a_tok),
+    )
+    chat_id = r.json()["data"]["chat_id"]
+    assert (await _members(client, a_tok, chat_id, "POST", [bob_id]))["msg"] == "chat is not a group"
+
+
+def test_recipient_cache_hit_is_atomic_against_invalidate():
+    # Threadpool endpoints invalidate while fan-out reads on the event loop; an
+    # invalidate landing between a hit's lookup and move_to_end must wait.
+    cache = RecipientCache(capacity=4)
+    hit, invalidated = threading.Event(), threading.Event()
+
+    class SlowMembers(OrderedDict):
+        def move_to_end(self, key, last=True):
+            hit.set()
+            invalidated.wait(0.3)
+            super().move_to_end(key, last)
+
+    def invalidate():
+        hit.wait()
+        cache.invalidate("c")
+        invalidated.set()
+
+    cache._members = SlowMembers(c={"u": "alice"})
+    t = threading.Thread(target=invalidate)
+    t.start()
+    assert cache.get(None, "c") == {"u": "alice"}
+    t.join()
+    assert "c" not in cache._members
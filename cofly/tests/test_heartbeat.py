@@ -0,0 +1,79 @@
+"""
+心跳追踪与空闲连接回收测试 — 半开连接不再被当作在线
+
+使用方式：
+    cd cofly && python -m pytest tests/test_heartbeat.py -v
+"""
+
+import sys
+import os
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import FakeWS
+from proto import make_frame
+from ws_manager import ws_manager
+
+
+@pytest.fixture(autouse=True)
+def reset_manager():
+    ws_manager.reset()
+    yield
+    ws_manager.reset()
+
+
+def _ping(seq=1):
+    return make_frame(seq_id=seq, method=0, headers={"type": "ping"})
+
+
+@pytest.mark.asyncio
+async def test_silent_connection_reaped():
+    timeout = ws_manager.idle_timeout()
+    alive, half_open = FakeWS(), FakeWS()
+    start = time.monotonic()
+    alive_conn = await ws_manager.connect("u_alive", alive)
+    await ws_manager.connect("u_gone", half_open)
+
+    # Nothing is due yet
+    assert await ws_manager.reap_idle(start + timeout / 2) == 0
+
+    alive_conn.last_seen = start + timeout / 2   # a ping arrived half way
+    assert await ws_manager.reap_idle(start + timeout + 1) == 1
+    assert half_open.closed == 1001
+    assert alive.closed is None
+    assert not ws_manager.is_online("u_gone")
+    assert ws_manager.is_online("u_alive")
+
+    # Events for the reaped user go to the offline queue instead of the void
+    delivered = await ws_manager.push_event("u_gone", {"header": {"event_type": "x"}})
+    assert delivered is False
+    assert len(ws_manager.pending("u_gone")) == 1
+
+    # The live connection was re-armed for its new deadline, and is reaped when it passes
+    assert sum(len(shard._idle_heap) for shard in ws_manager.shards) == 1
+    assert await ws_manager.reap_idle(start + timeout * 1.5 + 1) == 1
+    assert alive.closed == 1001
+
+
+@pytest.mark.asyncio
+async def test_ping_frames_update_last_seen():
+    ws = FakeWS()
+    conn = await ws_manager.connect("u1", ws)
+    conn.last_seen -= 100
+    before = conn.last_seen
+    await ws_manager.handle_frame(conn, _ping())
+    assert conn.last_seen > before + 99
+    assert len(ws.frames) == 1   # pong
+
+
+@pytest.mark.asyncio
+async def test_disconnected_entries_are_skipped():
+    ws = FakeWS()
+    conn = await ws_manager.connect("u1", ws)
+    ws_manager.disconnect(conn)
+    assert await ws_manager.reap_idle(time.monotonic() + ws_manager.idle_timeout() + 1) == 0
+    assert ws.closed is None
+    assert not any(shard._idle_heap for shard in ws_manager.shards)
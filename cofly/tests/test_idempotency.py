@@ -0,0 +1,79 @@
+"""
+幂等发送测试 — SendMessageRequest.uuid / ReplyMessageRequest.uuid
+
+使用方式：
+    cd cofly && python -m pytest tests/test_idempotency.py -v
+"""
+
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import auth, send, setup_user
+from idempotency import idempotency_cache
+from ws_manager import ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db):
+    idempotency_cache.clear()
+
+
+def _send(sc, token, receive_id, uuid):
+    return send(sc, token, receive_id, '{"text":"hi"}', uuid=uuid)
+
+
+def _history(sc, token, chat_id):
+    r = sc.get(f"/open-apis/im/v1/chats/{chat_id}/messages", headers=auth(token))
+    return r.json()["data"]["items"]
+
+
+def test_send_retry_returns_original_message(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    first = _send(sc, a_tok, bob_id, "req-1")
+    retry = _send(sc, a_tok, bob_id, "req-1")
+    assert retry == first
+
+    # Served from the database once the hot cache is cold
+    idempotency_cache.clear()
+    assert _send(sc, a_tok, bob_id, "req-1") == first
+
+    assert len(_history(sc, b_tok, first["chat_id"])) == 1
+    # bob is offline: exactly one receive event was queued, not one per retry
+    assert len(ws_manager.pending(bob_id)) == 1
+
+    # A new uuid (or none) is a new message
+    assert _send(sc, a_tok, bob_id, "req-2")["message_id"] != first["message_id"]
+    assert _send(sc, a_tok, bob_id, None)["message_id"] != first["message_id"]
+
+
+def test_uuid_is_scoped_per_sender(sc):
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    a = _send(sc, a_tok, bob_id, "same-key")
+    b = _send(sc, b_tok, alice_id, "same-key")
+    assert a["message_id"] != b["message_id"]
+    assert len(_history(sc, a_tok, a["chat_id"])) == 2
+
+
+def test_reply_retry_returns_original_message(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    sent = _send(sc, a_tok, bob_id, None)
+
+    replies = []
+    for _ in range(3):
+        r = sc.post(
+            f"/open-apis/im/v1/messages/{sent['message_id']}/reply",
+            json={"msg_type": "text", "content": '{"text":"yo"}', "uuid": "reply-1"},
+            headers=auth(b_tok),
+        )
+        replies.append(r.json()["data"]["message_id"])
+    assert len(set(replies)) == 1
+    assert len(_history(sc, a_tok, sent["chat_id"])) == 2
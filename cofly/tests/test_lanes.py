@@ -0,0 +1,179 @@
+"""
+每连接发送优先级通道测试 — 控制帧（pong / ack）优先于新消息，更新事件可合并或丢弃
+
+使用方式：
+    cd cofly && python -m pytest tests/test_lanes.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import ws_manager as ws_module
+from metrics import REGISTRY
+from proto import make_frame, parse_frame, get_header
+from ws_manager import (
+    build_ack_event, build_message_delta_event, build_message_event, build_message_sync_event,
+    build_message_update_event, ws_manager,
+)
+
+
+class GatedWS:
+    """send_bytes blocks while the gate is closed, like a socket whose buffer is full."""
+
+    def __init__(self):
+        self.frames = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def accept(self):
+        pass
+
+    async def send_bytes(self, data):
+        await self.gate.wait()
+        self.frames.append(data)
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def reset_manager():
+    ws_manager.reset()
+    yield
+    ws_manager.reset()
+
+
+def _args(message_id):
+    return dict(sender_id="s", receiver_username="bob", message_id=message_id,
+                chat_id="c", chat_type="p2p", message_type="text")
+
+
+def _update(message_id, text, version):
+    return build_message_update_event(content=json.dumps({"text": text}), version=version, **_args(message_id))
+
+
+def _kind(frame_bytes):
+    frame = parse_frame(frame_bytes)
+    if get_header(frame, "type") == "pong":
+        return ("pong",)
+    event = json.loads(frame.payload)
+    message = event["event"].get("message", {})
+    return (event["header"]["event_type"], message.get("message_id"), message.get("version"))
+
+
+async def _busy(ws):
+    """Start a write that blocks until the gate opens; returns its task."""
+    ws.gate.clear()
+    task = asyncio.ensure_future(ws_manager.push_event("bob", build_message_event(content="{}", **_args("m0"))))
+    await asyncio.sleep(0)
+    return task
+
+
+async def _release(ws, task):
+    ws.gate.set()
+    await task
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_control_frames_jump_the_update_backlog():
+    ws = GatedWS()
+    conn = await ws_manager.connect("bob", ws)
+    blocked = await _busy(ws)
+
+    for version in (2, 3, 4):
+        assert await ws_manager.push_event("bob", _update("m1", f"v{version}", version)) is True
+    await ws_manager.push_event("bob", _update("m2", "x", 2))
+    await ws_manager.push_event("bob", build_message_event(content="{}", **_args("m3")))
+    await ws_manager.push_event("bob", build_ack_event("m3", "c", "bob", True))
+    await ws_manager.handle_frame(conn, make_frame(seq_id=1, method=0, headers={"type": "ping"}))
+    assert ws.frames == []
+
+    await _release(ws, blocked)
+    assert [_kind(f) for f in ws.frames] == [
+        ("im.message.receive_v1", "m0", None),     # the write that was in flight
+        ("cofly.message.ack", None, None),
+        ("pong",),
+        ("im.message.receive_v1", "m3", None),
+        ("im.message.update_v1", "m1", 4),         # three edits coalesced into the latest
+        ("im.message.update_v1", "m2", 2),
+    ]
+    assert not conn.writing and not any(conn.lanes)
+
+    text = REGISTRY.render()
+    assert 'cofly_ws_lane_frames_total{lane="update",outcome="coalesced"}' in text
+    assert 'cofly_ws_lane_queued_frames{lane="update"} 0' in text
+    assert 'cofly_ws_lane_wait_seconds_count{lane="control"}' in text
+
+
+@pytest.mark.asyncio
+async def test_update_backlog_drops_oldest(monkeypatch):
+    monkeypatch.setattr(ws_module, "WS_UPDATE_LANE_MAX", 2)
+    ws = GatedWS()
+    await ws_manager.connect("bob", ws)
+    blocked = await _busy(ws)
+
+    for i in range(4):
+        await ws_manager.push_event("bob", build_message_sync_event(content="{}", **_args(f"s{i}")))
+    await ws_manager.push_event("bob", build_message_event(content="{}", **_args("m1")))
+
+    await _release(ws, blocked)
+    assert [_kind(f)[:2] for f in ws.frames] == [
+        ("im.message.receive_v1", "m0"),
+        ("im.message.receive_v1", "m1"),           # messages are never dropped
+        ("cofly.message.resync_v1", None),         # names what was dropped
+        ("cofly.message.sync_v1", "s2"),
+        ("cofly.message.sync_v1", "s3"),
+    ]
+    resync = json.loads(parse_frame(ws.frames[2]).payload)
+    assert resync["header"]["app_id"] == "bob"
+    assert resync["event"]["message_ids"] == ["s0", "s1"]
+
+
+@pytest.mark.asyncio
+async def test_dropped_edit_leaves_a_resync_for_its_message(monkeypatch):
+    # Edits are coalesced per message, so a dropped one is the only queued copy
+    # of that message's content: a full-update client must learn to re-fetch it
+    monkeypatch.setattr(ws_module, "WS_UPDATE_LANE_MAX", 2)
+    ws = GatedWS()
+    conn = await ws_manager.connect("bob", ws)
+    blocked = await _busy(ws)
+
+    await ws_manager.push_event("bob", _update("m1", "edited", 2))
+    await ws_manager.push_event("bob", _update("m2", "x", 2))
+    await ws_manager.push_event("bob", _update("m3", "y", 2))
+    await ws_manager.push_event("bob", _update("m2", "xx", 3))   # coalesces, drops nothing
+
+    await _release(ws, blocked)
+    assert [_kind(f) for f in ws.frames[1:]] == [
+        ("cofly.message.resync_v1", None, None),
+        ("im.message.update_v1", "m2", 3),
+        ("im.message.update_v1", "m3", 2),
+    ]
+    assert json.loads(parse_frame(ws.frames[1]).payload)["event"]["message_ids"] == ["m1"]
+    assert conn.resync is None and not any(conn.lanes)
+
+
+@pytest.mark.asyncio
+async def test_delta_behind_a_queued_edit_is_sent_in_full():
+    ws = GatedWS()
+    await ws_manager.connect("bob", ws, delta_updates=True)
+    await ws_manager.push_event("bob", _update("m1", "a", 1))
+    blocked = await _busy(ws)
+
+    for version, text in ((2, "ab"), (3, "abc")):
+        delta = build_message_delta_event(base_version=version - 1, version=version,
+                                          ops=[{"op": "append", "text": text[-1]}], **_args("m1"))
+        await ws_manager.push_event("bob", _update("m1", text, version), delta_event=delta)
+
+    await _release(ws, blocked)
+    # v2 was queued as a delta, then replaced by v3, which the client can't apply
+    # on top of v1: the replacement is the full update
+    assert [_kind(f) for f in ws.frames[2:]] == [("im.message.update_v1", "m1", 3)]
@@ -0,0 +1,116 @@
+"""
+事件循环延迟监控测试 — 延迟采样、阻塞堆栈日志与过载卸载
+
+使用方式：
+    cd cofly && python -m pytest tests/test_loop_monitor.py -v
+"""
+
+import sys
+import os
+import asyncio
+import logging
+import shutil
+import time
+
+import pytest
+import websockets
+from starlette.testclient import WebSocketDenialResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from loop_monitor import LoopMonitor, loop_monitor
+
+from load_harness import start_server
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(loop_monitor, "_shed_until", 0.0)
+
+
+def _block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_stall_logged_with_stack_and_sheds(caplog):
+    monitor = LoopMonitor(interval_ms=10, stall_ms=100, shed_lag_ms=150, shed_hold_s=2, shed="ws,gc")
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        assert not monitor.shedding()
+        with caplog.at_level(logging.WARNING, logger="cofly.loop"):
+            _block_the_loop(0.3)
+            await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+
+    stalls = [r.getMessage() for r in caplog.records if "event loop blocked" in r.getMessage()]
+    assert len(stalls) == 1
+    assert "_block_the_loop" in stalls[0]
+    assert max(monitor.samples) >= 0.25
+    assert monitor.quantiles()[("1.0",)] == max(monitor.samples)
+
+    assert monitor.shedding()
+    assert monitor.sheds("ws") and monitor.sheds("gc")
+    assert not monitor.sheds("endpoint")
+    assert 1 <= monitor.retry_after() <= 2
+
+
+def test_short_lag_does_not_shed():
+    monitor = LoopMonitor(interval_ms=10, stall_ms=100, shed_lag_ms=150, shed_hold_s=2, shed="ws")
+    monitor.record(0.02)
+    assert not monitor.shedding()
+    monitor.record(0.2)
+    assert monitor.sheds("ws")
+
+
+def test_shedding_rejects_ws_and_endpoint(sc, monkeypatch):
+    sc.post("/cofly/register", json={"username": "bot", "password": "123"})
+    monkeypatch.setattr(loop_monitor, "shed_kinds", {"ws", "endpoint"})
+    monkeypatch.setattr(loop_monitor, "_shed_until", time.perf_counter() + 3)
+
+    r = sc.post("/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+    assert r.json()["code"] == 1
+    assert r.json()["data"]["retry_after"] == 3
+    assert r.headers["Retry-After"] == "3"
+
+    with pytest.raises(WebSocketDenialResponse) as exc:
+        with sc.websocket_connect("/ws?token=anything"):
+            pass
+    assert exc.value.status_code == 503
+    assert exc.value.headers["Retry-After"] == "3"
+
+    text = sc.get("/metrics").text
+    assert 'cofly_load_shed_total{kind="endpoint"} ' in text
+    assert "cofly_load_shedding 1" in text
+
+    monkeypatch.setattr(loop_monitor, "_shed_until", 0.0)
+    r = sc.post("/callback/ws/endpoint", json={"AppID": "bot", "AppSecret": "123"})
+    assert r.json()["code"] == 0
+
+
+def test_shed_handshake_reaches_the_client_on_a_real_server():
+    # Any lag sheds /ws; the TestClient hides what a real server sends before accept()
+    proc, base_url, tmpdir = start_server(COFLY_LOOP_SHED="ws", COFLY_LOOP_SHED_LAG_MS="0.001")
+
+    async def handshake():
+        # Until the first lag sample the bad token gets as far as authentication
+        for _ in range(50):
+            try:
+                async with websockets.connect(base_url.replace("http://", "ws://") + "/ws?token=anything"):
+                    pass
+            except websockets.InvalidStatus as e:
+                if e.response.status_code == 503:
+                    return e.response
+            await asyncio.sleep(0.1)
+
+    try:
+        response = asyncio.run(handshake())
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert b'"retry_after"' in response.body
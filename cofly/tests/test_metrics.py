@@ -0,0 +1,92 @@
+"""
+/metrics 测试 — Prometheus 文本格式与热点路径埋点
+
+使用方式：
+    cd cofly && python -m pytest tests/test_metrics.py -v
+"""
+
+import sys
+import os
+import re
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import auth, send, setup_user
+from metrics import Registry
+from ws_manager import ws_manager
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+def _sample(text, name, **labels):
+    """Value of one sample line, or None."""
+    for line in text.splitlines():
+        if not line.startswith(name + ("{" if labels else " ")):
+            continue
+        found = dict(re.findall(r'(\w+)="([^"]*)"', line.split(" ")[0]))
+        if all(found.get(k) == v for k, v in labels.items()):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_render_format():
+    reg = Registry()
+    c = reg.counter("t_events_total", "Events.", ("kind",))
+    c.labels("a").inc()
+    c.labels("a").inc(2)
+    h = reg.histogram("t_seconds", "Latency.", buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 5):
+        h.observe(v)
+    reg.gauge("t_live", "Live.", collect=lambda: {(): 7})
+    text = reg.render()
+
+    assert "# TYPE t_events_total counter" in text
+    assert _sample(text, "t_events_total", kind="a") == 3
+    # Buckets are cumulative and end with +Inf == count
+    assert _sample(text, "t_seconds_bucket", le="0.1") == 1
+    assert _sample(text, "t_seconds_bucket", le="1") == 2
+    assert _sample(text, "t_seconds_bucket", le="+Inf") == 3
+    assert _sample(text, "t_seconds_count") == 3
+    assert _sample(text, "t_seconds_sum") == pytest.approx(5.55)
+    assert _sample(text, "t_live") == 7
+    with pytest.raises(ValueError):
+        reg.counter("t_live", "dup")
+
+
+def test_metrics_endpoint_reports_hot_paths(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, _ = setup_user(sc, "bob")
+    before = _sample(sc.get("/metrics").text, "cofly_push_total", outcome="queued") or 0
+
+    message_id = send(sc, a_tok, bob_id, '{"text":"hi"}')["message_id"]
+    sc.get(f"/open-apis/im/v1/messages/{message_id}", headers=auth(a_tok))
+
+    r = sc.get("/metrics")
+    assert r.headers["content-type"].startswith("text/plain")
+    text = r.text
+    # Routes are labelled by template, not by concrete path
+    route = "/open-apis/im/v1/messages/{message_id}"
+    assert _sample(text, "cofly_http_request_duration_seconds_count",
+                   method="GET", route=route, status="200") >= 1
+    assert message_id not in text
+    assert _sample(text, "cofly_db_queries_per_request_count", route=route) >= 1
+    assert _sample(text, "cofly_db_queries_total") > 0
+    # Nobody is online: bob's receive event and alice's sync + ack were queued
+    assert _sample(text, "cofly_push_total", outcome="queued") == before + 3
+    assert _sample(text, "cofly_pending_events") == 3
+    assert _sample(text, "cofly_pending_users", depth="1") == 1
+    assert _sample(text, "cofly_pending_users", depth="2-9") == 1
+    assert _sample(text, "cofly_bcrypt_duration_seconds_count", op="hash") >= 2
+    assert _sample(text, "cofly_threadpool_tasks", state="waiting") == 0
+    assert "# TYPE cofly_gc_runs_total counter" in text
+    assert _sample(text, "process_resident_memory_bytes") > 0
+
+
+def test_pending_users_bucket_edges(monkeypatch):
+    from routers.metrics_router import _pending_users
+    depths = [1, 2, 9, 10, 99, 100, 999, 1000]
+    monkeypatch.setattr(ws_manager, "pending_queues", lambda: [[None] * n for n in depths])
+    assert _pending_users() == {("1",): 1, ("2-9",): 2, ("10-99",): 2, ("100-999",): 2, ("1000+",): 1}
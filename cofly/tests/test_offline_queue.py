@@ -0,0 +1,92 @@
+"""
+离线队列压缩测试 — 同一消息只保留最新的更新事件，未投递的接收事件直接合并最新内容
+
+使用方式：
+    cd cofly && python -m pytest tests/test_offline_queue.py -v
+"""
+
+import sys
+import os
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import FakeWS, auth, send_and_drain, setup_user_async, text_content
+from routers import message_router
+from ws_manager import OfflineQueue, ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0)
+
+
+async def _patch(c, token, message_id, text):
+    r = await c.patch(f"/open-apis/im/v1/messages/{message_id}",
+                      json={"msg_type": "text", "content": text_content(text)},
+                      headers=auth(token))
+    assert r.json()["code"] == 0
+
+
+def _summary(events):
+    return [(e["header"]["event_type"], e["event"]["message"]["message_id"],
+             json.loads(e["event"]["message"]["content"])["text"], e["event"]["message"].get("version"))
+            for e in events]
+
+
+@pytest.mark.asyncio
+async def test_updates_merge_into_pending_receive(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+
+    msg_id = await send_and_drain(client, a_tok, bob_id, "h")
+    for text in ("he", "hel", "hell", "hello"):
+        await _patch(client, a_tok, msg_id, text)
+
+    assert _summary(ws_manager.pending(bob_id)) == [("im.message.receive_v1", msg_id, "hello", 4)]
+    (queue,) = [q for q in ws_manager.pending_queues() if q.events == ws_manager.pending(bob_id)]
+    assert (queue.received, len(queue)) == (5, 1)
+
+    # Alice's own sync event was merged the same way; her ack is untouched
+    r = await client.get("/metrics")
+    assert "cofly_pending_events 3" in r.text
+    assert "cofly_pending_events_uncompacted 11" in r.text
+    assert 'cofly_pending_compacted_total{how="merged"}' in r.text
+
+    ws = FakeWS()
+    await ws_manager.connect(bob_id, ws)
+    assert _summary(ws.events) == [("im.message.receive_v1", msg_id, "hello", 4)]
+
+
+@pytest.mark.asyncio
+async def test_only_latest_update_survives(client):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+    bob = ws_manager.register(bob_id, FakeWS())
+    first = await send_and_drain(client, a_tok, bob_id, "a")
+    second = await send_and_drain(client, a_tok, bob_id, "x")
+    ws_manager.disconnect(bob)
+
+    # A streamed answer: hundreds of edits while bob is away, interleaved with another message
+    for i in range(1, 301):
+        await _patch(client, a_tok, first, "a" * (i + 1))
+        if i == 150:
+            await _patch(client, a_tok, second, "xy")
+    third = await send_and_drain(client, a_tok, bob_id, "later")
+
+    assert _summary(ws_manager.pending(bob_id)) == [
+        ("im.message.update_v1", first, "a" * 301, 300),
+        ("im.message.update_v1", second, "xy", 1),
+        ("im.message.receive_v1", third, "later", None),
+    ]
+
+
+def test_acks_are_never_compacted():
+    queue = OfflineQueue()
+    for status in ("queued", "delivered"):
+        queue.append({"header": {"event_type": "cofly.message.ack"},
+                      "event": {"message_id": "m1", "status": status}})
+    assert [e["event"]["status"] for e in queue] == ["queued", "delivered"]
+    assert queue.received == 2
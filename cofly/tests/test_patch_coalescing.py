@@ -0,0 +1,184 @@
+"""
+流式 PATCH 合并写测试
+
+使用方式：
+    cd cofly && python -m pytest tests/test_patch_coalescing.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import auth, send, setup_user
+from main import app
+from patch_coalescer import PatchCoalescer
+from proto import make_frame, parse_frame
+from routers import message_router
+from ws_manager import ws_manager
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+# ── PatchCoalescer ──
+
+
+@pytest.mark.asyncio
+async def test_burst_is_flushed_once_per_window():
+    flushed = []
+
+    async def flush(message_id, state):
+        flushed.append((message_id, state[2]))
+
+    c = PatchCoalescer(50, flush)
+    assert c.submit("m1", "u", "text", "v0") is False  # leading edge: caller applies
+    for i in range(1, 20):
+        assert c.submit("m1", "u", "text", f"v{i}") is True
+    assert c.pending("m1") == ("u", "text", "v19")
+
+    await asyncio.sleep(0.2)
+    # Only the latest buffered state is flushed, and the window then closes
+    assert flushed == [("m1", "v19")]
+    assert c.pending("m1") is None
+    assert c.submit("m1", "u", "text", "v20") is False
+
+
+@pytest.mark.asyncio
+async def test_flush_all_on_shutdown():
+    flushed = []
+
+    async def flush(message_id, state):
+        flushed.append(state[2])
+
+    c = PatchCoalescer(10_000, flush)
+    c.submit("m1", "u", "text", "a")
+    c.submit("m1", "u", "text", "b")
+    await c.flush_all()
+    assert flushed == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_read_flush_waits_for_the_window_flush():
+    log = []
+
+    async def flush(message_id, state):
+        log.append(("start", state[2]))
+        await asyncio.sleep(0.05)
+        log.append(("end", state[2]))
+
+    c = PatchCoalescer(20, flush)
+    c.submit("m1", "u", "text", "a")
+    c.submit("m1", "u", "text", "b")
+    await asyncio.sleep(0.03)                      # the window is flushing "b"
+    c.submit("m1", "u", "text", "c")
+    assert await c.flush_now("m1")
+    assert log == [("start", "b"), ("end", "b"), ("start", "c"), ("end", "c")]
+    await asyncio.sleep(0.05)
+    assert c._locks == {}
+
+
+def test_disabled_window_applies_every_patch():
+    c = PatchCoalescer(0, None)
+    assert all(c.submit("m1", "u", "text", str(i)) is False for i in range(5))
+
+
+# ── API ──
+
+
+def test_streaming_patches_coalesced(monkeypatch):
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0.3)
+
+    with TestClient(app) as sc:
+        _, a_tok = setup_user(sc, "alice")
+        bob_id, b_tok = setup_user(sc, "bob")
+        msg_id = send(sc, a_tok, bob_id, '{"text":""}')["message_id"]
+
+        updates = []
+        ready = threading.Event()
+
+        def bob_listener():
+            with sc.websocket_connect(f"/ws?token={b_tok}&device_id=d1&service_id=1") as ws:
+                ws.send_bytes(make_frame(seq_id=1, method=0, headers={"type": "ping"}))
+                ws.receive_bytes()  # queued receive event or pong
+                ready.set()
+                deadline = time.time() + 3
+                while time.time() < deadline:
+                    frame = parse_frame(ws.receive_bytes())
+                    if frame.method != 1:
+                        continue
+                    evt = json.loads(frame.payload)
+                    if evt["header"]["event_type"] == "im.message.update_v1":
+                        updates.append(evt["event"]["message"]["content"])
+                        if updates[-1] == '{"text":"chunk 29"}':
+                            return
+
+        t = threading.Thread(target=bob_listener)
+        t.start()
+        ready.wait(timeout=3)
+
+        for i in range(30):
+            r = sc.patch(f"/open-apis/im/v1/messages/{msg_id}",
+                         json={"msg_type": "text", "content": f'{{"text":"chunk {i}"}}'},
+                         headers=auth(a_tok))
+            assert r.json()["data"]["body"]["content"] == f'{{"text":"chunk {i}"}}'
+
+        # Reads see the newest content before the window flushes
+        r = sc.get(f"/open-apis/im/v1/messages/{msg_id}", headers=auth(a_tok))
+        assert r.json()["data"]["items"][0]["body"]["content"] == '{"text":"chunk 29"}'
+
+        t.join(timeout=5)
+
+    # Far fewer update events than patches, and the final content always arrives
+    assert updates[-1] == '{"text":"chunk 29"}'
+    assert len(updates) <= 5
+
+
+@pytest.mark.asyncio
+async def test_members_see_versions_in_order_across_interleaved_flushes(monkeypatch):
+    from httpx import AsyncClient, ASGITransport
+
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 0.05)
+    pushed = {}
+
+    async def slow_push(user_id, event, delta_event=None):
+        version = event["event"]["message"].get("version")
+        await asyncio.sleep(0.03 if version == 2 else 0.001)   # v2's pushes lag
+        pushed.setdefault(user_id, []).append(version)
+        return False
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
+        async def setup(name):
+            r = await c.post("/cofly/register", json={"username": name, "password": "123"})
+            uid = r.json()["data"]["user_id"]
+            r = await c.post("/open-apis/auth/v3/tenant_access_token/internal",
+                             json={"app_id": name, "app_secret": "123"})
+            return uid, auth(r.json()["tenant_access_token"])
+
+        alice_id, a_auth = await setup("alice")
+        bob_id, b_auth = await setup("bob")
+        r = await c.post("/open-apis/im/v1/messages?receive_id_type=open_id", headers=a_auth,
+                         json={"receive_id": bob_id, "msg_type": "text", "content": json.dumps({"text": "x"})})
+        mid = r.json()["data"]["message_id"]
+        monkeypatch.setattr(ws_manager, "push_event", slow_push)
+
+        async def patch(text):
+            await c.patch(f"/open-apis/im/v1/messages/{mid}", headers=a_auth,
+                          json={"msg_type": "text", "content": json.dumps({"text": text})})
+
+        await patch("1")                            # applied at once
+        await patch("2")                            # buffered; the window flushes it
+        await asyncio.sleep(0.07)
+        await patch("3")                            # buffered; the read below flushes it
+        r = await c.get(f"/open-apis/im/v1/messages/{mid}", headers=b_auth)
+        assert json.loads(r.json()["data"]["items"][0]["body"]["content"])["text"] == "3"
+        await asyncio.sleep(0.1)
+
+    assert pushed == {alice_id: [1, 2, 3], bob_id: [1, 2, 3]}
@@ -0,0 +1,198 @@
+"""
+SQL 查询预算测试 — 每个路由的语句数上限，防止 N+1 回归
+
+预算与群成员数、消息数无关：会话里有 GROUP_SIZE 个成员时，
+逐成员查询会立刻超出预算。超出时失败信息会列出全部 SQL。
+
+使用方式：
+    cd cofly && python -m pytest tests/test_query_budgets.py -v
+"""
+
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine
+from helpers import auth, bulk_users, send, setup_user, text_content
+from idempotency import idempotency_cache
+from query_stats import assert_max_queries, QueryBudgetExceeded
+from recipients import recipient_cache
+
+GROUP_SIZE = 20
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db):
+    recipient_cache.clear()
+    idempotency_cache.clear()
+
+
+@pytest.fixture
+def query_budget():
+    """query_budget(n) is a context manager failing when the block issues more than n statements."""
+    return lambda limit: assert_max_queries(engine, limit)
+
+
+@pytest.fixture
+def world(sc):
+    """alice and bob with a p2p message, and a GROUP_SIZE-member group with a few messages."""
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    others = bulk_users(GROUP_SIZE - 2)
+    p2p = send(sc, a_tok, bob_id, text_content("hi"))
+    group_id = sc.post("/open-apis/im/v1/chats", headers=auth(a_tok), json={
+        "name": "big", "user_id_list": [bob_id] + others,
+    }).json()["data"]["chat_id"]
+    for i in range(3):
+        sc.post("/open-apis/im/v1/messages?receive_id_type=chat_id", headers=auth(b_tok),
+                json={"receive_id": group_id, "msg_type": "text", "content": text_content(f"deploy {i}")})
+    recipient_cache.clear()
+    return {
+        "alice": alice_id, "a_tok": a_tok, "bob": bob_id, "b_tok": b_tok,
+        "p2p_message": p2p["message_id"], "p2p_chat": p2p["chat_id"], "group": group_id,
+    }
+
+
+def test_budget_helper_reports_statements(query_budget):
+    from sqlalchemy import text
+    with pytest.raises(QueryBudgetExceeded) as exc:
+        with query_budget(1):
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                conn.execute(text("SELECT 2"))
+    assert "2 queries, budget 1" in str(exc.value)
+    assert "SELECT 2" in str(exc.value)
+
+
+def test_auth_router(sc, query_budget):
+    with query_budget(3):
+        sc.post("/cofly/register", json={"username": "zed", "password": "pw"})
+    with query_budget(1):
+        sc.post("/open-apis/auth/v3/tenant_access_token/internal",
+                json={"app_id": "zed", "app_secret": "pw"})
+
+
+def test_contact_router(sc, world, query_budget):
+    with query_budget(2):
+        sc.get(f"/open-apis/contact/v3/users/{world['bob']}", headers=auth(world["a_tok"]))
+    with query_budget(1):
+        sc.get("/cofly/users/bob")
+    with query_budget(1):
+        sc.get("/open-apis/bot/v3/info", headers=auth(world["a_tok"]))
+
+
+def test_chat_router(sc, world, query_budget):
+    a = auth(world["a_tok"])
+    with query_budget(2):
+        sc.get("/open-apis/im/v1/chats", headers=a)
+    with query_budget(3):
+        sc.post(f"/cofly/chats/{world['group']}/read", headers=a)
+    with query_budget(6):
+        sc.post("/open-apis/im/v1/chats", headers=a, json={"name": "x", "user_id_list": [world["bob"]]})
+    zed_id, z_tok = setup_user(sc, "zed")
+    with query_budget(6):
+        sc.post(f"/open-apis/im/v1/chats/{world['group']}/members", headers=a, json={"id_list": [zed_id]})
+    with query_budget(4):
+        sc.request("DELETE", f"/open-apis/im/v1/chats/{world['group']}/members",
+                   headers=auth(z_tok), json={"id_list": [zed_id]})
+    with query_budget(5):
+        sc.patch(f"/open-apis/im/v1/chats/{world['group']}/members/me_join", headers=auth(z_tok))
+
+
+def test_message_router(sc, world, query_budget):
+    a, b = auth(world["a_tok"]), auth(world["b_tok"])
+    # Group send: membership + fan-out recipients come from one (cached) query
+    with query_budget(7):
+        r = sc.post("/open-apis/im/v1/messages?receive_id_type=chat_id", headers=a,
+                    json={"receive_id": world["group"], "msg_type": "text", "content": text_content("x")})
+    group_message = r.json()["data"]["message_id"]
+    with query_budget(8):
+        sc.post("/open-apis/im/v1/messages?receive_id_type=open_id", headers=a,
+                json={"receive_id": world["bob"], "msg_type": "text", "content": text_content("y")})
+    with query_budget(8):
+        sc.post(f"/open-apis/im/v1/messages/{group_message}/reply", headers=b,
+                json={"msg_type": "text", "content": text_content("z"), "uuid": "r-1"})
+    # A batch costs the same whatever its size: one commit, one query per receiver kind
+    batch = [{"receive_id": world["bob"], "content": text_content(f"b{i}")} for i in range(GROUP_SIZE)]
+    batch += [{"receive_id": world["group"], "receive_id_type": "chat_id", "content": text_content(f"g{i}")}
+              for i in range(GROUP_SIZE)]
+    with query_budget(9):
+        r = sc.post("/open-apis/im/v1/messages/batch_send", headers=a, json={"messages": batch})
+    assert [i["code"] for i in r.json()["data"]["items"]] == [0] * len(batch)
+    # An idempotent retry answers from the cache
+    with query_budget(1):
+        sc.post(f"/open-apis/im/v1/messages/{group_message}/reply", headers=b,
+                json={"msg_type": "text", "content": text_content("z"), "uuid": "r-1"})
+    with query_budget(2):
+        sc.get(f"/open-apis/im/v1/messages/{group_message}", headers=a)
+    with query_budget(2):
+        sc.get("/open-apis/im/v1/messages/mget", headers=a,
+               params={"message_ids": [group_message, world["p2p_message"]]})
+    with query_budget(2):
+        sc.get(f"/cofly/messages/{group_message}/thread", headers=a)
+    with query_budget(6):
+        sc.patch(f"/open-apis/im/v1/messages/{group_message}", headers=a,
+                 json={"msg_type": "text", "content": text_content("x edited")})
+    with query_budget(4):
+        sc.get(f"/open-apis/im/v1/chats/{world['group']}/messages", headers=a)
+
+
+def test_reaction_router(sc, world, query_budget):
+    a = auth(world["a_tok"])
+    mid = world["p2p_message"]
+    with query_budget(5):
+        r = sc.post(f"/open-apis/im/v1/messages/{mid}/reactions", headers=a,
+                    json={"reaction_type": {"emoji_type": "THUMBSUP"}})
+    reaction_id = r.json()["data"]["reaction_id"]
+    with query_budget(3):
+        sc.get(f"/open-apis/im/v1/messages/{mid}/reactions", headers=a)
+    with query_budget(3):
+        sc.delete(f"/open-apis/im/v1/messages/{mid}/reactions/{reaction_id}", headers=a)
+
+
+def test_media_router(sc, world, query_budget):
+    a = auth(world["a_tok"])
+    with query_budget(3):
+        r = sc.post("/open-apis/im/v1/images", headers=a, data={"image_type": "message"},
+                    files={"image": ("a.png", b"\x89PNG", "image/png")})
+    key = r.json()["data"]["image_key"]
+    with query_budget(2):
+        sc.get(f"/open-apis/im/v1/images/{key}", headers=a)
+    with query_budget(3):
+        r = sc.post("/open-apis/im/v1/files", headers=a, data={"file_type": "stream", "file_name": "f.txt"},
+                    files={"file": ("f.txt", b"hello", "text/plain")})
+    with query_budget(3):
+        sc.get(f"/open-apis/im/v1/messages/{world['p2p_message']}/resources/{r.json()['data']['file_key']}",
+               headers=a)
+
+
+def test_search_router(sc, world, query_budget):
+    with query_budget(3):
+        r = sc.get("/cofly/messages/search", params={"query": "deploy"}, headers=auth(world["a_tok"]))
+    assert len(r.json()["data"]["items"]) == 3
+
+
+def test_ws_router(sc, world, query_budget):
+    with query_budget(0):
+        sc.get(f"/cofly/online/{world['alice']}")
+    with query_budget(1):
+        sc.post("/callback/ws/endpoint", json={"AppID": "alice", "AppSecret": "123"})
+
+
+def test_metrics_router(sc, query_budget):
+    with query_budget(0):
+        sc.get("/metrics")
+
+
+def test_slow_query_log(sc, world, monkeypatch, caplog):
+    import query_stats
+    monkeypatch.setattr(query_stats, "SLOW_QUERY_MS", 1e-6)
+    with caplog.at_level("WARNING", logger="cofly.sql"):
+        sc.get("/open-apis/im/v1/chats", headers=auth(world["a_tok"]))
+    messages = [r.getMessage() for r in caplog.records]
+    assert any(m.startswith("slow query:") and "[/open-apis/im/v1/chats]" in m for m in messages)
+    # The request summary names the route template and its slowest statement
+    assert any(m.startswith("slow request: /open-apis/im/v1/chats: 2 queries") for m in messages)
@@ -32,7 +32,7 @@ BOT_PASSWORD = "<bot app secret key>"
 def setup_db():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
-    ws_manager.connections.clear()
+    ws_manager.reset()
     yield
     Base.metadata.drop_all(bind=engine)
 
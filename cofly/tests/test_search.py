@@ -0,0 +1,151 @@
+"""
+消息全文搜索测试（SQLite FTS5）
+
+使用方式：
+    cd cofly && python -m pytest tests/test_search.py -v
+"""
+
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine, SessionLocal
+from helpers import auth, send, setup_user
+from models import Message
+from search import init_index, search_messages, unindex_older_than
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+def _search(sc, token, query, **params):
+    r = sc.get("/cofly/messages/search", params={"query": query, **params},
+               headers=auth(token))
+    body = r.json()
+    assert body["code"] == 0
+    return body["data"]
+
+
+def test_search_text_and_post(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    t = send(sc, a_tok, bob_id, '{"text":"deploy the staging cluster"}')
+    p = send(sc, a_tok, bob_id,
+             '{"zh_cn":{"title":"周报","content":[[{"tag":"md","text":"部署生产集群完成"}]]}}',
+             msg_type="post")
+    send(sc, a_tok, bob_id, '{"text":"unrelated"}')
+
+    data = _search(sc, b_tok, "staging")
+    assert [i["message_id"] for i in data["items"]] == [t["message_id"]]
+    assert "<b>" in data["items"][0]["snippet"]
+
+    data = _search(sc, b_tok, "生产集群")
+    assert [i["message_id"] for i in data["items"]] == [p["message_id"]]
+
+    # Two-character CJK terms fall back to LIKE
+    data = _search(sc, b_tok, "周报")
+    assert [i["message_id"] for i in data["items"]] == [p["message_id"]]
+
+
+def test_search_scoped_to_member_chats(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, _ = setup_user(sc, "bob")
+    _, c_tok = setup_user(sc, "carol")
+
+    send(sc, a_tok, bob_id, '{"text":"secret roadmap"}')
+    assert _search(sc, c_tok, "roadmap")["items"] == []
+    assert len(_search(sc, a_tok, "roadmap")["items"]) == 1
+
+
+def test_search_follows_patch_and_paging(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+
+    sent = send(sc, a_tok, bob_id, '{"text":"draft answer"}')
+    sc.patch(f"/open-apis/im/v1/messages/{sent['message_id']}",
+             json={"msg_type": "text", "content": '{"text":"final answer"}'},
+             headers=auth(a_tok))
+    assert _search(sc, b_tok, "draft")["items"] == []
+    assert len(_search(sc, b_tok, "final")["items"]) == 1
+
+    for i in range(4):
+        send(sc, a_tok, bob_id, f'{{"text":"answer number {i}"}}')
+    first = _search(sc, b_tok, "answer", page_size=3)
+    assert first["has_more"]
+    rest = _search(sc, b_tok, "answer", page_size=3, page_token=first["page_token"])
+    assert not rest["has_more"]
+    ids = [i["message_id"] for i in first["items"] + rest["items"]]
+    assert len(ids) == len(set(ids)) == 5
+
+
+def test_page_token_continues_after_new_messages(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    sent = [send(sc, a_tok, bob_id, f'{{"text":"ok {i}"}}')["message_id"] for i in range(5)]
+
+    # Two-character terms are LIKE-only: newest first
+    first = _search(sc, b_tok, "ok", page_size=2)
+    assert [i["message_id"] for i in first["items"]] == sent[:2:-1]
+    send(sc, a_tok, bob_id, '{"text":"ok 5"}')
+    second = _search(sc, b_tok, "ok", page_size=2, page_token=first["page_token"])
+    assert [i["message_id"] for i in second["items"]] == sent[2:0:-1]
+
+    r = sc.get("/cofly/messages/search", params={"query": "ok", "page_token": "3"}, headers=auth(b_tok))
+    assert r.json()["msg"] == "invalid page_token"
+
+
+def test_gc_unindexes_deleted_messages(sc):
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, _ = setup_user(sc, "bob")
+    sent = send(sc, a_tok, bob_id, '{"text":"old news"}')
+
+    db = SessionLocal()
+    try:
+        db.query(Message).filter(Message.id == sent["message_id"]).update(
+            {Message.created_at: datetime.now(timezone.utc) - timedelta(days=3)})
+        cutoff = datetime.now(timezone.utc) - timedelta(days=2)
+        unindex_older_than(db, cutoff)
+        db.query(Message).filter(Message.created_at < cutoff).delete()
+        db.commit()
+        assert search_messages(db, alice_id, "old news", limit=10) == []
+    finally:
+        db.close()
+
+
+def test_index_survives_vacuum(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    gone = send(sc, a_tok, bob_id, '{"text":"first to go"}')["message_id"]
+    kept = [send(sc, a_tok, bob_id, f'{{"text":"kept {w}"}}')["message_id"] for w in ("alpha", "beta")]
+
+    # VACUUM may renumber the implicit rowids of messages (its key is a Text id)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM messages_search WHERE message_id = :id"), {"id": gone})
+        conn.execute(text("DELETE FROM messages WHERE id = :id"), {"id": gone})
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+
+    assert [i["message_id"] for i in _search(sc, b_tok, "alpha")["items"]] == [kept[0]]
+    sc.patch(f"/open-apis/im/v1/messages/{kept[1]}", json={"msg_type": "text", "content": '{"text":"kept gamma"}'},
+             headers=auth(a_tok))
+    assert _search(sc, b_tok, "beta")["items"] == []
+    assert [i["message_id"] for i in _search(sc, b_tok, "gamma")["items"]] == [kept[1]]
+
+
+def test_rowid_keyed_index_is_rebuilt(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    sent = send(sc, a_tok, bob_id, '{"text":"legacy index"}')["message_id"]
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE messages_fts"))
+        conn.execute(text("DROP TABLE messages_search"))
+        conn.execute(text("CREATE VIRTUAL TABLE messages_fts USING fts5(body, chat_id UNINDEXED)"))
+
+    init_index(engine)
+    assert [i["message_id"] for i in _search(sc, b_tok, "legacy")["items"]] == [sent]
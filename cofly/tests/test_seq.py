@@ -0,0 +1,123 @@
+"""
+会话序号测试 — 每条消息在会话内获得单调递增的 seq（并发写入无重复、无空洞），
+事件与历史记录携带 seq，since_seq 增量同步，旧库升级时回填
+
+使用方式：
+    cd cofly && python -m pytest tests/test_seq.py -v
+"""
+
+import sys
+import os
+import json
+import threading
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine, SessionLocal, init_db
+from helpers import auth, send, setup_user, text_content
+from models import Chat, Message
+from routers import message_router
+from ws_manager import ws_manager
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+def _list(sc, token, chat_id, **params):
+    r = sc.get(f"/open-apis/im/v1/chats/{chat_id}/messages", params=params, headers=auth(token))
+    return r.json()["data"]
+
+
+def test_seq_on_sends_events_and_history(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    first = send(sc, a_tok, bob_id, text_content("one"))
+    assert first["seq"] == 1
+    chat_id = first["chat_id"]
+    r = sc.post(f"/open-apis/im/v1/messages/{first['message_id']}/reply", headers=auth(b_tok),
+                json={"msg_type": "text", "content": text_content("two")})
+    assert r.json()["data"]["seq"] == 2
+    r = sc.post("/open-apis/im/v1/messages/batch_send", headers=auth(a_tok), json={"messages": [
+        {"receive_id": bob_id, "content": text_content("three")},
+        {"receive_id": bob_id, "content": text_content("four")},
+    ]})
+    assert [i["data"]["seq"] for i in r.json()["data"]["items"]] == [3, 4]
+
+    # Other chats count on their own
+    carol_id, _ = setup_user(sc, "carol")
+    assert send(sc, a_tok, carol_id, text_content("hi"))["seq"] == 1
+
+    events = [e for e in ws_manager.pending(bob_id) if e["header"]["event_type"] == "im.message.receive_v1"]
+    assert [e["event"]["message"]["seq"] for e in events] == [1, 3, 4]
+    assert [i["seq"] for i in _list(sc, a_tok, chat_id)["items"]] == [1, 2, 3, 4]
+
+
+def test_since_seq_returns_exactly_the_missed_messages(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    chat_id = [send(sc, a_tok, bob_id, text_content(f"m{i}")) for i in range(1, 8)][0]["chat_id"]
+
+    data = _list(sc, b_tok, chat_id, since_seq=3, page_size=2)
+    assert [i["seq"] for i in data["items"]] == [4, 5]
+    assert data["has_more"] is True
+    data = _list(sc, b_tok, chat_id, since_seq=5, page_size=2)
+    assert [i["seq"] for i in data["items"]] == [6, 7]
+    assert data["has_more"] is False
+    assert _list(sc, b_tok, chat_id, since_seq=7) == {"items": [], "has_more": False}
+
+
+def test_concurrent_writers_get_distinct_gapless_seqs(sc):
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, _ = setup_user(sc, "bob")
+    chat_id = send(sc, a_tok, bob_id, text_content("first"))["chat_id"]
+    errors = []
+
+    def writer(n):
+        db = SessionLocal()
+        try:
+            chat = db.get(Chat, chat_id)
+            for i in range(n):
+                msg = Message(id=str(uuid.uuid4()), chat_id=chat_id, sender_id=alice_id,
+                              content=text_content(str(i)), created_at=datetime.now(timezone.utc))
+                message_router._record_sent(db, chat, [msg])
+                db.add(msg)
+                db.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=writer, args=(20,)) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    db = SessionLocal()
+    seqs = sorted(s for (s,) in db.query(Message.seq).filter(Message.chat_id == chat_id))
+    assert seqs == list(range(1, 122))
+    assert db.get(Chat, chat_id).last_seq == 121
+    db.close()
+
+
+def test_existing_database_is_backfilled(sc):
+    _, a_tok = setup_user(sc, "alice")
+    bob_id, _ = setup_user(sc, "bob")
+    chat_id = [send(sc, a_tok, bob_id, text_content(f"m{i}")) for i in range(3)][0]["chat_id"]
+    # A database from before seq existed
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_messages_chat_seq"))
+        conn.execute(text("ALTER TABLE messages DROP COLUMN seq"))
+        conn.execute(text("ALTER TABLE chats DROP COLUMN last_seq"))
+    # Upgrades run at startup, on fresh connections
+    engine.dispose()
+
+    init_db()
+    items = _list(sc, a_tok, chat_id)["items"]
+    assert [(json.loads(i["body"]["content"])["text"], i["seq"]) for i in items] == [("m0", 1), ("m1", 2), ("m2", 3)]
+    assert send(sc, a_tok, bob_id, text_content("m3"))["seq"] == 4
@@ -0,0 +1,117 @@
+"""
+批量获取与话题测试 — /open-apis/im/v1/messages/mget 一次查询取多条消息，/cofly/messages/{id}/thread 按 root_id 取整个话题
+
+使用方式：
+    cd cofly && python -m pytest tests/test_threads.py -v
+"""
+
+import sys
+import os
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from database import engine
+from helpers import auth, send, setup_user, text_content
+from query_stats import assert_max_queries
+from routers import message_router
+
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+def _texts(items):
+    return [json.loads(i["body"]["content"])["text"] for i in items]
+
+
+def _reply(sc, token, message_id, text):
+    r = sc.post(f"/open-apis/im/v1/messages/{message_id}/reply", headers=auth(token),
+                json={"msg_type": "text", "content": text_content(text)})
+    return r.json()["data"]["message_id"]
+
+
+@pytest.fixture
+def thread(sc):
+    """alice/bob p2p chat: a root, a reply chain 50 deep, and an unrelated message."""
+    alice_id, a_tok = setup_user(sc, "alice")
+    bob_id, b_tok = setup_user(sc, "bob")
+    root = send(sc, a_tok, bob_id, text_content("root"))["message_id"]
+    ids = [root]
+    for i in range(49):
+        ids.append(_reply(sc, b_tok if i % 2 == 0 else a_tok, ids[-1], f"r{i}"))
+    other = send(sc, a_tok, bob_id, text_content("unrelated"))["message_id"]
+    return {"a_tok": a_tok, "b_tok": b_tok, "bob": bob_id, "ids": ids, "other": other}
+
+
+def test_thread_in_one_round_trip(sc, thread):
+    with assert_max_queries(engine, 2):
+        r = sc.get(f"/cofly/messages/{thread['ids'][17]}/thread", headers=auth(thread["a_tok"]))
+    data = r.json()["data"]
+    assert data["root_id"] == thread["ids"][0]
+    assert [i["message_id"] for i in data["items"]] == thread["ids"]
+    assert _texts(data["items"])[:3] == ["root", "r0", "r1"]
+    assert all(i["root_id"] == thread["ids"][0] for i in data["items"][1:])
+
+    # The root finds the same thread; a message outside any thread is its own
+    r = sc.get(f"/cofly/messages/{thread['ids'][0]}/thread", params={"page_size": 5},
+               headers=auth(thread["b_tok"]))
+    assert [i["message_id"] for i in r.json()["data"]["items"]] == thread["ids"][:5]
+    assert r.json()["data"]["has_more"]
+    r = sc.get(f"/cofly/messages/{thread['other']}/thread", headers=auth(thread["a_tok"]))
+    assert _texts(r.json()["data"]["items"]) == ["unrelated"]
+
+    _, e_tok = setup_user(sc, "eve")
+    r = sc.get(f"/cofly/messages/{thread['ids'][3]}/thread", headers=auth(e_tok))
+    assert r.json()["code"] == 1
+    assert sc.get("/cofly/messages/nope/thread", headers=auth(thread["a_tok"])).json()["code"] == 1
+
+
+def test_thread_pages_until_has_more_is_false(sc, thread):
+    ids, token = [], ""
+    while True:
+        r = sc.get(f"/cofly/messages/{thread['ids'][30]}/thread", params={"page_size": 20, "page_token": token},
+                   headers=auth(thread["a_tok"]))
+        data = r.json()["data"]
+        assert data["root_id"] == thread["ids"][0]
+        ids += [i["message_id"] for i in data["items"]]
+        if not data["has_more"]:
+            assert data["page_token"] == ""
+            break
+        token = data["page_token"]
+    assert ids == thread["ids"]
+
+    r = sc.get(f"/cofly/messages/{thread['ids'][0]}/thread", params={"page_token": "x"},
+               headers=auth(thread["a_tok"]))
+    assert r.json()["msg"] == "invalid page_token"
+
+
+def test_mget_keeps_request_order(sc, thread):
+    wanted = [thread["other"], thread["ids"][5], "missing", thread["ids"][0], thread["ids"][5]]
+    with assert_max_queries(engine, 2):
+        r = sc.get("/open-apis/im/v1/messages/mget", params={"message_ids": wanted},
+                   headers=auth(thread["b_tok"]))
+    items = r.json()["data"]["items"]
+    assert [i["message_id"] for i in items] == [thread["other"], thread["ids"][5], thread["ids"][0]]
+    assert items[1]["parent_id"] == thread["ids"][4]
+
+    # Messages of chats the caller is not in are left out
+    _, e_tok = setup_user(sc, "eve")
+    r = sc.get("/open-apis/im/v1/messages/mget", params={"message_ids": wanted}, headers=auth(e_tok))
+    assert r.json()["data"]["items"] == []
+    # The single-message route still resolves
+    r = sc.get(f"/open-apis/im/v1/messages/{thread['other']}", headers=auth(thread["a_tok"]))
+    assert _texts(r.json()["data"]["items"]) == ["unrelated"]
+
+
+def test_mget_sees_buffered_patch(sc, thread, monkeypatch):
+    monkeypatch.setattr(message_router.patch_coalescer, "window", 60)
+    mid = thread["ids"][0]
+    # Outside a window the first patch is written; the second is buffered in it
+    for text in ("streaming", "streaming done"):
+        sc.patch(f"/open-apis/im/v1/messages/{mid}", headers=auth(thread["a_tok"]),
+                 json={"msg_type": "text", "content": text_content(text)})
+    r = sc.get("/open-apis/im/v1/messages/mget", params={"message_ids": [mid]}, headers=auth(thread["b_tok"]))
+    (item,) = r.json()["data"]["items"]
+    assert _texts([item]) == ["streaming done"]
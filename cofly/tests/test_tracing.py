@@ -0,0 +1,155 @@
+"""
+消息链路追踪测试 — 从 HTTP 发送到 WS 投递的各阶段时间点
+
+使用方式：
+    cd cofly && python -m pytest tests/test_tracing.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fanout import fanout
+from helpers import FakeWS, auth, send_async, setup_user_async, text_content
+from tracing import MessageTrace, Tracer, tracer
+from ws_manager import SharedEvent, build_message_event, ws_manager
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    tracer.clear()
+    monkeypatch.setattr(tracer, "sample_rate", 0.0)
+
+
+@pytest.mark.asyncio
+async def test_trace_records_lifecycle(client, tmp_path, monkeypatch):
+    export = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracer, "export_path", str(export))
+    monkeypatch.setattr(tracer, "_export", None)
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    ws_manager.register(alice_id, FakeWS())
+    ws_manager.register(bob_id, FakeWS())
+
+    sent = await send_async(client, a_tok, bob_id, text_content("traced"), headers={"X-Cofly-Trace": "1"})
+    await fanout.drain()
+
+    r = await client.get("/cofly/traces", params={"message_id": sent["message_id"]}, headers=auth(b_tok))
+    items = r.json()["data"]["items"]
+    assert len(items) == 1
+    trace = items[0]
+    stages = [m["stage"] for m in trace["marks"]]
+    assert stages == ["received", "committed", "fanout_started", "sync", "written", "ack"]
+    assert [m["ms"] for m in trace["marks"]] == sorted(m["ms"] for m in trace["marks"])
+    written = trace["marks"][stages.index("written")]
+    assert written["user_id"] == bob_id
+    assert trace["marks"][-1]["status"] == "delivered"
+
+    # Every event the message produced resolves back to the trace
+    assert len(trace["event_ids"]) == 3
+    for event_id in trace["event_ids"]:
+        r = await client.get("/cofly/traces", params={"event_id": event_id}, headers=auth(a_tok))
+        assert r.json()["data"]["items"][0]["message_id"] == sent["message_id"]
+
+    # Outsiders can't read it
+    _, c_tok = await setup_user_async(client, "carol")
+    r = await client.get("/cofly/traces", params={"message_id": sent["message_id"]}, headers=auth(c_tok))
+    assert r.json()["data"]["items"] == []
+
+    lines = export.read_text().splitlines()
+    assert json.loads(lines[0])["message_id"] == sent["message_id"]
+
+
+@pytest.mark.asyncio
+async def test_lane_queued_frame_is_marked_written_when_drained():
+    bob = FakeWS(delay=0.05)
+    ws_manager.register("bob", bob)
+    shared = {"sender_id": "alice", "chat_id": "c", "chat_type": "p2p", "message_type": "text", "content": "{}"}
+    busy = asyncio.ensure_future(ws_manager.push_shared(
+        "bob", "bob", SharedEvent(build_message_event, message_id="m0", **shared)))
+    await asyncio.sleep(0)
+
+    trace = MessageTrace(time.perf_counter())
+    assert await ws_manager.push_shared(
+        "bob", "bob", SharedEvent(build_message_event, message_id="m1", **shared), trace) is True
+    assert [stage for _, stage, _ in trace.marks] == ["received", "lane_queued"]
+    await busy
+    for _ in range(10):
+        if len(bob.frames) == 2:
+            break
+        await asyncio.sleep(0.05)
+
+    assert len(bob.frames) == 2
+    assert [(stage, attrs.get("user_id")) for _, stage, attrs in trace.marks[1:]] == [
+        ("lane_queued", "bob"), ("written", "bob"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_offline_recipient_marked_enqueued(client):
+    alice_id, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+
+    sent = await send_async(client, a_tok, bob_id, text_content("are you there"), headers={"X-Cofly-Trace": "1"})
+    await fanout.drain()
+    trace = tracer.get(sent["message_id"]).to_dict()
+    enqueued = [m for m in trace["marks"] if m["stage"] == "enqueued"]
+    assert [m["user_id"] for m in enqueued] == [bob_id]
+    assert trace["marks"][-1]["status"] == "queued"
+
+
+@pytest.mark.asyncio
+async def test_sampling(client, monkeypatch):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+
+    await send_async(client, a_tok, bob_id, text_content("not sampled"))
+    await fanout.drain()
+    r = await client.get("/cofly/traces", headers=auth(a_tok))
+    assert r.json()["data"]["items"] == []
+
+    monkeypatch.setattr(tracer, "sample_rate", 1.0)
+    for i in range(3):
+        await send_async(client, a_tok, bob_id, text_content(f"sampled {i}"))
+    await fanout.drain()
+    r = await client.get("/cofly/traces", params={"limit": 2}, headers=auth(a_tok))
+    assert len(r.json()["data"]["items"]) == 2
+
+
+def test_evicted_traces_index_no_more_events():
+    t = Tracer(sample_rate=0.0, capacity=2)
+    traces = [MessageTrace(time.perf_counter()) for _ in range(3)]
+    for i, trace in enumerate(traces):
+        t.bind(trace, f"m{i}", "c", "u")
+    # m0 was evicted; its late fan-out events must not leak into the event index
+    t.add_event(traces[0], {"header": {"event_id": "late"}})
+    t.add_event(traces[2], {"header": {"event_id": "e2"}})
+    assert t._by_event == {"e2": "m2"}
+    assert t.get(event_id="late") is None
+
+
+@pytest.mark.asyncio
+async def test_failed_fanout_still_finishes_the_trace(client, tmp_path, monkeypatch):
+    export = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracer, "export_path", str(export))
+    monkeypatch.setattr(tracer, "_export", None)
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, _ = await setup_user_async(client, "bob")
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("push failed")
+
+    monkeypatch.setattr(fanout, "push_shared", broken)
+    sent = await send_async(client, a_tok, bob_id, text_content("doomed"), headers={"X-Cofly-Trace": "1"})
+    await fanout.drain()
+    (line,) = export.read_text().splitlines()
+    exported = json.loads(line)
+    assert exported["message_id"] == sent["message_id"]
+    assert exported["marks"][-1] == {"ms": exported["marks"][-1]["ms"], "stage": "fanout_failed",
+                                     "error": "RuntimeError"}
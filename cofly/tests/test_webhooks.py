@@ -0,0 +1,226 @@
+"""
+Webhook 投递测试 — 离线用户的事件批量 POST 到注册地址，失败指数退避重试后回落离线队列
+
+使用本地 http.server 作为接收端。
+
+使用方式：
+    cd cofly && python -m pytest tests/test_webhooks.py -v
+"""
+
+import sys
+import os
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import webhooks as webhooks_module
+from fanout import fanout
+from helpers import FakeWS, auth, event_texts, send_async, setup_user_async, text_content
+from webhooks import sign, webhooks
+from ws_manager import ws_manager
+
+
+class Receiver:
+    """A local webhook endpoint recording each POST; `status` and `delay` shape its replies."""
+
+    def __init__(self):
+        self.posts = []
+        self.status = 200
+        self.delay = 0.0
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(receiver.delay)
+                receiver.posts.append((dict(self.headers), body, self.client_address[1]))
+                self.send_response(receiver.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def events(self):
+        return [e for _, body, _ in self.posts for e in json.loads(body)["events"]]
+
+
+@pytest.fixture
+def receiver():
+    r = Receiver()
+    yield r
+    r.server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def setup_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(webhooks, "targets", {})
+    monkeypatch.setattr(webhooks, "backoff", 0.01)
+    # The test receiver listens on loopback
+    monkeypatch.setattr(webhooks, "allowed_hosts", {"127.0.0.1"})
+
+
+@pytest.mark.asyncio
+async def test_events_are_posted_in_batches_over_one_connection(client, receiver):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    r = await client.put("/cofly/webhook", json={"url": receiver.url, "secret": "s3"}, headers=auth(b_tok))
+    assert r.json()["code"] == 0
+    r = await client.get("/cofly/webhook", headers=auth(b_tok))
+    assert r.json()["data"] == {"url": receiver.url, "signed": True}
+
+    # The first POST is slow, so the rest pile up and go out together
+    receiver.delay = 0.2
+    for i in range(6):
+        await send_async(client, a_tok, bob_id, text_content(f"m{i}"))
+        await fanout.drain()
+    receiver.delay = 0
+    await webhooks.drain()
+
+    assert event_texts(receiver.events()) == [f"m{i}" for i in range(6)]
+    assert len(receiver.posts) < 6
+    assert len({port for _, _, port in receiver.posts}) == 1      # keep-alive
+    headers, body, _ = receiver.posts[0]
+    assert headers["X-Cofly-Signature"] == sign("s3", body)
+    assert ws_manager.pending(bob_id) == []
+
+    # A connected user gets events on the connection, not the webhook
+    ws_manager.register(bob_id, FakeWS())
+    await send_async(client, a_tok, bob_id, text_content("live"))
+    await fanout.drain()
+    await webhooks.drain()
+    assert len(receiver.events()) == 6
+
+
+@pytest.mark.asyncio
+async def test_failing_webhook_retries_then_falls_back_to_offline_queue(client, receiver, monkeypatch):
+    monkeypatch.setattr(webhooks, "retries", 2)
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+
+    receiver.status = 503
+    await send_async(client, a_tok, bob_id, text_content("lost?"))
+    await fanout.drain()
+    await webhooks.drain()
+
+    assert len(receiver.posts) == 3                               # first try + 2 retries
+    assert "X-Cofly-Signature" not in receiver.posts[0][0]
+    assert event_texts(ws_manager.pending(bob_id)) == ["lost?"]
+    text = (await client.get("/metrics")).text
+    assert 'cofly_webhook_events_total{outcome="fallback"}' in text
+    assert 'cofly_webhook_posts_total{outcome="failed"}' in text
+
+
+@pytest.mark.asyncio
+async def test_unregistered_webhook_stops_receiving(client, receiver):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    r = await client.put("/cofly/webhook", json={"url": "ftp://example.com"}, headers=auth(b_tok))
+    assert r.json()["code"] == 1
+
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+    await client.delete("/cofly/webhook", headers=auth(b_tok))
+    await send_async(client, a_tok, bob_id, text_content("queued"))
+    await fanout.drain()
+    await webhooks.drain()
+    assert receiver.posts == []
+    assert event_texts(ws_manager.pending(bob_id)) == ["queued"]
+    assert (await client.get("/cofly/webhook", headers=auth(b_tok))).json()["data"] == {}
+
+
+@pytest.mark.asyncio
+async def test_internal_addresses_are_refused(client, receiver, monkeypatch):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    monkeypatch.setattr(webhooks, "allowed_hosts", set())
+    for url in (receiver.url, "http://localhost:8000/hook", "http://10.1.2.3/hook",
+                "http://169.254.169.254/latest/meta-data", "http://[::1]/hook", "http://[::ffff:192.168.0.1]/"):
+        r = await client.put("/cofly/webhook", json={"url": url}, headers=auth(b_tok))
+        assert r.json() == {"code": 1, "msg": "url must resolve to a public address", "data": {}}, url
+    assert webhooks.url_error("http://93.184.215.14/hook") is None
+
+    # Registered while allowed, refused at POST time once it no longer is
+    monkeypatch.setattr(webhooks, "allowed_hosts", {"127.0.0.1"})
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+    monkeypatch.setattr(webhooks, "allowed_hosts", set())
+    monkeypatch.setattr(webhooks, "retries", 1)
+    await send_async(client, a_tok, bob_id, text_content("not for you"))
+    await fanout.drain()
+    await webhooks.drain()
+    assert receiver.posts == []
+    assert event_texts(ws_manager.pending(bob_id)) == ["not for you"]
+
+
+@pytest.mark.asyncio
+async def test_post_connects_to_the_address_that_was_checked(receiver, monkeypatch):
+    # A rebinding host: the first lookup answers with the receiver, any later one
+    # elsewhere. Both count as public here; the POST must not look the host up again.
+    port = receiver.server.server_address[1]
+    real_getaddrinfo = socket.getaddrinfo
+    lookups = []
+
+    def rebinding(host, *args, **kwargs):
+        if host != "hook.example":
+            return real_getaddrinfo(host, *args, **kwargs)
+        lookups.append(host)
+        address = "127.0.0.1" if len(lookups) == 1 else "127.0.0.2"
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, port))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", rebinding)
+    monkeypatch.setattr(webhooks_module, "_public", lambda address: True)
+    monkeypatch.setattr(webhooks, "allowed_hosts", set())
+
+    assert await webhooks._post(f"http://hook.example:{port}/hook", "", [{"n": 1}])
+    assert lookups == ["hook.example"]
+    ((headers, _, _),) = receiver.posts
+    assert headers["Host"] == f"hook.example:{port}"
+
+
+@pytest.mark.asyncio
+async def test_drain_with_timeout_falls_back_what_is_left(client, receiver):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+
+    # Shutdown: one POST hangs while more events are buffered behind it
+    receiver.delay = 1.0
+    for text in ("a", "b"):
+        await send_async(client, a_tok, bob_id, text_content(text))
+        await fanout.drain()
+    await webhooks.drain(timeout=0.2)
+    assert webhooks.buffered() == 0
+    assert event_texts(ws_manager.pending(bob_id)) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_reregistering_during_a_post_keeps_delivering(client, receiver):
+    _, a_tok = await setup_user_async(client, "alice")
+    bob_id, b_tok = await setup_user_async(client, "bob")
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+
+    receiver.delay = 0.2
+    await send_async(client, a_tok, bob_id, text_content("first"))
+    await fanout.drain()
+    await asyncio.sleep(0.05)                                     # "first" is in flight
+    await client.delete("/cofly/webhook", headers=auth(b_tok))
+    await client.put("/cofly/webhook", json={"url": receiver.url}, headers=auth(b_tok))
+    receiver.delay = 0
+    await send_async(client, a_tok, bob_id, text_content("second"))
+    await fanout.drain()
+    await webhooks.drain()
+    assert event_texts(receiver.events()) == ["first", "second"]
+    assert webhooks.buffered() == 0
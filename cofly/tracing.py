@@ -0,0 +1,123 @@
+"""Sampled lifecycle traces of sent messages, from HTTP request to WS delivery.
+
+A trace is a list of (offset_ms, stage, attrs) marks on the monotonic clock,
+relative to the moment the send request was received:
+
+    received -> committed -> fanout_started -> per recipient: written / enqueued
+    / write_failed -> sync -> ack
+
+A recipient whose connection is busy writing gets lane_queued first, then
+written (or write_failed) once its connection's writer sends the frame.
+
+Only sampled sends (COFLY_TRACE_SAMPLE_RATE, or an "X-Cofly-Trace: 1" request
+header) allocate a trace; everything else pays one random() call. Finished
+traces are kept in a bounded in-memory store, looked up by message id or by
+the header.event_id of any event the message produced, and optionally appended
+to a JSONL file.
+"""
+
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from fastapi import Request
+
+from config import TRACE_CAPACITY, TRACE_EXPORT_PATH, TRACE_SAMPLE_RATE
+
+logger = logging.getLogger("cofly.trace")
+
+
+class MessageTrace:
+    __slots__ = ("message_id", "chat_id", "sender_id", "started_at", "_t0", "marks", "event_ids", "users")
+
+    def __init__(self, t0: float):
+        self._t0 = t0
+        # Wall clock of `received`, for correlating with logs
+        self.started_at = time.time() - (time.perf_counter() - t0)
+        self.message_id = self.chat_id = self.sender_id = ""
+        self.marks: List[tuple] = []
+        self.event_ids: List[str] = []
+        self.users = set()
+        self.mark("received")
+
+    def mark(self, stage: str, **attrs):
+        self.marks.append((round((time.perf_counter() - self._t0) * 1000, 3), stage, attrs))
+
+    def to_dict(self) -> dict:
+        return {
+            "message_id": self.message_id,
+            "chat_id": self.chat_id,
+            "sender_id": self.sender_id,
+            "started_at": round(self.started_at, 6),
+            "event_ids": self.event_ids,
+            "marks": [{"ms": ms, "stage": stage, **attrs} for ms, stage, attrs in self.marks],
+        }
+
+
+class Tracer:
+    def __init__(self, sample_rate: float, capacity: int, export_path: str = ""):
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.export_path = export_path
+        self._traces: "OrderedDict[str, MessageTrace]" = OrderedDict()
+        self._by_event: Dict[str, str] = {}
+        self._export = None
+
+    def start(self, request: Request) -> Optional[MessageTrace]:
+        """A new trace for this send request if it is sampled, else None."""
+        forced = request.headers.get("x-cofly-trace") == "1"
+        if not forced and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            return None
+        return MessageTrace(getattr(request.state, "received_at", None) or time.perf_counter())
+
+    def bind(self, trace: MessageTrace, message_id: str, chat_id: str, sender_id: str):
+        """Store a trace once its message exists."""
+        trace.message_id, trace.chat_id, trace.sender_id = message_id, chat_id, sender_id
+        trace.users.add(sender_id)
+        self._traces[message_id] = trace
+        if len(self._traces) > self.capacity:
+            _, old = self._traces.popitem(last=False)
+            for event_id in old.event_ids:
+                self._by_event.pop(event_id, None)
+
+    def add_event(self, trace: MessageTrace, event_json: dict):
+        event_id = event_json["header"]["event_id"]
+        trace.event_ids.append(event_id)
+        # An evicted trace's event ids were dropped with it; don't index new ones
+        if self._traces.get(trace.message_id) is trace:
+            self._by_event[event_id] = trace.message_id
+
+    def finish(self, trace: MessageTrace):
+        if not self.export_path:
+            return
+        try:
+            if self._export is None:
+                self._export = open(self.export_path, "a", buffering=1)
+            self._export.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error("trace export to %s failed: %s", self.export_path, e)
+
+    def get(self, message_id: str = "", event_id: str = "") -> Optional[MessageTrace]:
+        if event_id:
+            message_id = self._by_event.get(event_id, "")
+        return self._traces.get(message_id)
+
+    def recent(self, user_id: str, limit: int) -> List[MessageTrace]:
+        """Newest traces the user took part in (as sender or recipient)."""
+        found = []
+        for trace in reversed(self._traces.values()):
+            if user_id in trace.users:
+                found.append(trace)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def clear(self):
+        self._traces.clear()
+        self._by_event.clear()
+
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_CAPACITY, TRACE_EXPORT_PATH)
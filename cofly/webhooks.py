@@ -0,0 +1,276 @@
+"""Webhook delivery for users that receive events by HTTP POST instead of a WS.
+
+An event for a user with a registered webhook and no open connection is
+handed to the dispatcher instead of the offline queue. Each user has a buffer
+and at most one POST in flight, so events stay in order; whatever piles up
+while a POST is in flight goes out in the next one, up to WEBHOOK_BATCH_MAX
+events per POST as {"events": [...]}. All users share one pooled keep-alive
+client, with at most WEBHOOK_CONCURRENCY POSTs in flight overall.
+
+A failed POST (transport error or non-2xx) is retried with exponential
+backoff; after WEBHOOK_RETRIES retries the user's buffered events are moved
+to the offline queue (the fallback), to be flushed when the user connects or
+polls.
+
+Any user can register a URL, so a webhook host must resolve only to public
+addresses, checked at registration and again for every connection (DNS may
+have changed since); WEBHOOK_ALLOWED_HOSTS lists internal hosts that are
+allowed. The connection goes to the address that was checked, not to a second
+lookup, so a host can't pass with a public address and then rebind to an
+internal one.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import random
+import socket
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpcore
+import httpx
+
+from config import (
+    WEBHOOK_ALLOWED_HOSTS, WEBHOOK_BACKOFF_MAX_S, WEBHOOK_BACKOFF_S, WEBHOOK_BATCH_MAX, WEBHOOK_CONCURRENCY,
+    WEBHOOK_RETRIES, WEBHOOK_TIMEOUT_S,
+)
+from metrics import WEBHOOK_EVENTS, WEBHOOK_POST_SECONDS, WEBHOOK_POSTS
+
+logger = logging.getLogger("cofly.webhooks")
+
+_POST_OK = WEBHOOK_POSTS.labels("ok")
+_POST_FAILED = WEBHOOK_POSTS.labels("failed")
+_EVENTS_DELIVERED = WEBHOOK_EVENTS.labels("delivered")
+_EVENTS_FALLBACK = WEBHOOK_EVENTS.labels("fallback")
+
+
+def sign(secret: str, body: bytes) -> str:
+    """X-Cofly-Signature value: hex HMAC-SHA256 of the request body."""
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _host_port(url: str) -> Tuple[str, int]:
+    parsed = urlparse(url)
+    return (parsed.hostname or ""), parsed.port or (443 if parsed.scheme == "https" else 80)
+
+
+async def _resolve_public(host: str, port: int) -> str:
+    """One address of host, if every address it resolves to is public."""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as e:
+        raise httpcore.ConnectError(f"{host} does not resolve: {e}") from e
+    if not infos or not all(_public(info[4][0]) for info in infos):
+        raise httpcore.ConnectError(f"{host} does not resolve to a public address")
+    return infos[0][4][0]
+
+
+class _PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Connects to the address it vetted. TLS still uses the URL's hostname
+    for SNI and certificate checks, and the Host header is unchanged."""
+
+    def __init__(self, allowed: Callable[[str], bool]):
+        self.allowed = allowed
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        address = host if self.allowed(host) else await _resolve_public(host, port)
+        return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("webhooks are posted over TCP only")
+
+    async def sleep(self, seconds: float):
+        await self._backend.sleep(seconds)
+
+
+class _PublicAddressTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits: httpx.Limits, allowed: Callable[[str], bool]):
+        super().__init__(limits=limits)
+        # httpx has no network_backend option: the same pool it would build, on our backend
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_PublicAddressBackend(allowed),
+        )
+
+
+class WebhookDispatcher:
+    def __init__(self, concurrency: int, batch_max: int, timeout: float, retries: int,
+                 backoff: float, backoff_max: float, allowed_hosts: str = ""):
+        self.concurrency = concurrency
+        self.batch_max = batch_max
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.allowed_hosts = {h.strip().lower() for h in allowed_hosts.split(",") if h.strip()}
+        # user_id -> (url, secret)
+        self.targets: Dict[str, Tuple[str, str]] = {}
+        # Takes (user_id, events) that could not be delivered; set by ws_manager
+        self.fallback: Optional[Callable[[str, List[dict]], None]] = None
+        self._buffers: Dict[str, deque] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = None
+
+    def load(self, db):
+        from models import Webhook
+        self.targets = {w.user_id: (w.url, w.secret or "") for w in db.query(Webhook).all()}
+
+    def register(self, user_id: str, url: str, secret: str = ""):
+        self.targets[user_id] = (url, secret)
+
+    def unregister(self, user_id: str):
+        """Stop delivering to the user's webhook; a POST in flight still completes
+        (or falls back), the rest of the buffer goes to the offline queue now."""
+        self.targets.pop(user_id, None)
+        buffer = self._buffers.pop(user_id, None)
+        if buffer:
+            events = list(buffer)
+            buffer.clear()
+            self._fall_back(user_id, events)
+
+    def url_error(self, url: str) -> Optional[str]:
+        """Why url can't be registered as a webhook, or None. Resolves the host (blocking)."""
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            return "url must be http(s)"
+        host, port = _host_port(url)
+        if self._allowed(host):
+            return None
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except (OSError, ValueError):
+            return "url host does not resolve"
+        if not all(_public(info[4][0]) for info in infos):
+            return "url must resolve to a public address"
+        return None
+
+    def _allowed(self, host: str) -> bool:
+        return host.lower() in self.allowed_hosts
+
+    def accepts(self, user_id: str) -> bool:
+        return user_id in self.targets
+
+    def submit(self, user_id: str, event_json: dict):
+        self._buffers.setdefault(user_id, deque()).append(event_json)
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.ensure_future(self._run(user_id))
+
+    def buffered(self) -> int:
+        return sum(len(b) for b in self._buffers.values())
+
+    def _http(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._loop = loop
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self._client = httpx.AsyncClient(timeout=self.timeout,
+                                             transport=_PublicAddressTransport(limits, self._allowed))
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._client
+
+    async def _post(self, url: str, secret: str, events: List[dict]) -> bool:
+        body = json.dumps({"events": events}).encode()
+        headers = {"Content-Type": "application/json"}
+        if secret:
+            headers["X-Cofly-Signature"] = sign(secret, body)
+        client = self._http()
+        start = time.perf_counter()
+        try:
+            async with self._slots:
+                r = await client.post(url, content=body, headers=headers)
+            ok = 200 <= r.status_code < 300
+            if not ok:
+                logger.warning("webhook: %s returned %d", url, r.status_code)
+        except httpx.HTTPError as e:
+            logger.warning("webhook: POST to %s failed: %s", url, e)
+            ok = False
+        WEBHOOK_POST_SECONDS.observe(time.perf_counter() - start)
+        (_POST_OK if ok else _POST_FAILED).inc()
+        return ok
+
+    async def _run(self, user_id: str):
+        buffer = self._buffers[user_id]
+        batch: List[dict] = []
+        try:
+            while buffer and user_id in self.targets:
+                batch = [buffer.popleft() for _ in range(min(self.batch_max, len(buffer)))]
+                url, secret = self.targets[user_id]
+                for attempt in range(self.retries + 1):
+                    if attempt:
+                        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+                        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                    if await self._post(url, secret, batch):
+                        _EVENTS_DELIVERED.inc(len(batch))
+                        break
+                else:
+                    logger.error("webhook: giving up on %s for user_id=%s, %d events to the offline queue",
+                                 url, user_id, len(batch) + len(buffer))
+                    batch.extend(buffer)
+                    buffer.clear()
+                    self._fall_back(user_id, batch)
+                batch = []
+        except asyncio.CancelledError:
+            # drain() timed out: the batch in flight and the rest fall back
+            batch.extend(buffer)
+            buffer.clear()
+            self._fall_back(user_id, batch)
+            raise
+        finally:
+            if self._workers.get(user_id) is asyncio.current_task():
+                del self._workers[user_id]
+            if not buffer and self._buffers.get(user_id) is buffer:
+                del self._buffers[user_id]
+            # Unregistered and registered again while this worker ran: events went
+            # to a new buffer, and submit() saw this worker and started none
+            if self._buffers.get(user_id) and user_id not in self._workers:
+                self._workers[user_id] = asyncio.ensure_future(self._run(user_id))
+
+    def _fall_back(self, user_id: str, events: List[dict]):
+        if events and self.fallback is not None:
+            _EVENTS_FALLBACK.inc(len(events))
+            self.fallback(user_id, events)
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Wait for every buffered event to be delivered or fall back (tests, shutdown).
+        After timeout seconds the workers are cancelled and their events fall back."""
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            for task in list(self._workers.values()):
+                task.cancel()
+            await self._drain()
+
+    async def _drain(self):
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+webhooks = WebhookDispatcher(
+    WEBHOOK_CONCURRENCY, WEBHOOK_BATCH_MAX, WEBHOOK_TIMEOUT_S, WEBHOOK_RETRIES, WEBHOOK_BACKOFF_S,
+    WEBHOOK_BACKOFF_MAX_S, WEBHOOK_ALLOWED_HOSTS,
+)
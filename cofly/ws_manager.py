@@ -1,84 +1,798 @@
 import asyncio
+import heapq
+import itertools
 import json
 import logging
 import time
 import uuid
-from typing import Dict, List
+import zlib
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
 
 from fastapi import WebSocket
 
-from proto import parse_frame, get_header, make_pong_frame, make_event_frame
+from admission import admission
+from config import WS_IDLE_PINGS, WS_REAP_INTERVAL_S, WS_SHARDS, WS_UPDATE_LANE_MAX
+from metrics import (
+    FRAME_ENCODE_SECONDS, LANE_DEPTH, LANE_FRAMES, LANE_WAIT_SECONDS, PENDING_COMPACTED, PUSH_OUTCOMES,
+    PUSH_SECONDS, WS_REAPED,
+)
+from proto import parse_frame, get_header, make_pong_frame, make_event_frame, make_payload_frame
+from webhooks import webhooks
 
 logger = logging.getLogger("cofly.ws")
 
+# Per delta-capable connection, how many messages' versions are remembered
+DELTA_TRACKED_MESSAGES = 256
+# Events that establish (or advance) a message version on the receiving side
+_VERSIONED_EVENTS = {"im.message.receive_v1", "cofly.message.sync_v1", "im.message.update_v1"}
+_PUSH_DELIVERED = PUSH_OUTCOMES.labels("delivered")
+_PUSH_QUEUED = PUSH_OUTCOMES.labels("queued")
+_PUSH_FAILED = PUSH_OUTCOMES.labels("failed")
+_ENCODE_SHARED = FRAME_ENCODE_SECONDS.labels("shared_body")
+_PUSH_TIME = PUSH_SECONDS.labels()
+
+# Outbound lanes, highest priority first. A connection writes one frame at a
+# time; frames pushed while a write is in flight wait in their lane, and the
+# writer always takes from the highest non-empty lane, so pongs and acks never
+# queue behind a storm of updates.
+CONTROL, MESSAGE, UPDATE = 0, 1, 2
+LANES = ("control", "message", "update")
+# Events that may be dropped under pressure; edits are also coalesced per message (latest wins)
+_UPDATE_EVENTS = {"im.message.update_v1", "cofly.message.delta_v1", "cofly.message.sync_v1"}
+_EDIT_EVENTS = {"im.message.update_v1", "cofly.message.delta_v1"}
+_CONTROL_EVENTS = {"cofly.message.ack"}
+_LANE_QUEUED = [LANE_FRAMES.labels(lane, "queued") for lane in LANES]
+_LANE_COALESCED = LANE_FRAMES.labels("update", "coalesced")
+_LANE_DROPPED = LANE_FRAMES.labels("update", "dropped")
+_LANE_WAIT = [LANE_WAIT_SECONDS.labels(lane) for lane in LANES]
+_LANE_DEPTH = [LANE_DEPTH.labels(lane) for lane in LANES]
+
+
+def lane_for(event_type: str) -> int:
+    if event_type in _CONTROL_EVENTS:
+        return CONTROL
+    if event_type in _UPDATE_EVENTS:
+        return UPDATE
+    return MESSAGE
+
+
+def _record_push(start: float, any_sent: bool):
+    _PUSH_TIME.observe(time.perf_counter() - start)
+    (_PUSH_DELIVERED if any_sent else _PUSH_FAILED).inc()
+
+
+# Stand-in app_id while a SharedEvent body is encoded
+_APP_ID_SLOT = "\x00app_id\x00"
+
+
+class SharedEvent:
+    """An event delivered to many recipients that differ only in header.app_id.
+
+    The JSON body is encoded once; each recipient's payload is the shared
+    prefix and suffix around its own app_id. The header is encoded before the
+    event body, so the first slot occurrence is always header.app_id, whatever
+    the message content contains.
+    """
+
+    def __init__(self, build: Callable[..., dict], **kwargs):
+        self.event_json = build(receiver_username=_APP_ID_SLOT, **kwargs)
+        start = time.perf_counter()
+        prefix, suffix = json.dumps(self.event_json).split(json.dumps(_APP_ID_SLOT), 1)
+        _ENCODE_SHARED.observe(time.perf_counter() - start)
+        self._prefix = prefix.encode()
+        self._suffix = suffix.encode()
+        self.message_id = self.event_json["event"].get("message", {}).get("message_id", "")
+
+    def payload_for(self, username: str) -> bytes:
+        return self._prefix + json.dumps(username).encode() + self._suffix
+
+    def event_for(self, username: str) -> dict:
+        """The recipient's event as a dict, for the offline queue."""
+        return {**self.event_json, "header": {**self.event_json["header"], "app_id": username}}
+
+
+async def _close_quietly(ws: WebSocket, code: int, reason: str):
+    # A half-open peer never acknowledges the close; don't wait on it
+    try:
+        await asyncio.wait_for(ws.close(code=code, reason=reason), timeout=1)
+    except Exception:
+        pass
+
+
+class Connection:
+    """One WebSocket, registered under its user and device."""
+
+    __slots__ = ("user_id", "device_id", "service_id", "ws", "last_seen", "delta_versions", "active",
+                 "writing", "lanes", "resync")
+
+    def __init__(self, user_id: str, device_id: str, service_id: str, ws: WebSocket,
+                 delta_updates: bool = False):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.service_id = service_id
+        self.ws = ws
+        # Monotonic time of the last frame received
+        self.last_seen = time.monotonic()
+        # For connections that opted into delta updates: {message_id: last version sent}
+        self.delta_versions: Optional[OrderedDict] = OrderedDict() if delta_updates else None
+        self.active = True
+        # True while a frame is being written; other frames then wait in lanes of
+        # (queued_at, frame, message_id, trace). Edits in the update lane are keyed
+        # by message_id so a newer edit replaces a queued one.
+        self.writing = False
+        self.lanes = None
+        # {message_id: receiver app_id} of updates dropped from a full update lane;
+        # one resync event naming them is written ahead of the remaining updates
+        self.resync: Optional[Dict[str, str]] = None
+
+    def queued_edit(self, message_id: str) -> bool:
+        return self.lanes is not None and message_id in self.lanes[UPDATE]
+
+    def queue(self, lane: int, frame: bytes, message_id: Optional[str] = None, coalesce: bool = False,
+              trace=None):
+        """Queue a frame behind the one being written. Past WS_UPDATE_LANE_MAX
+        queued updates, the oldest are dropped; edits are already coalesced per
+        message, so a dropped one may be the client's only copy of that content,
+        and its message_id is kept for a resync event instead."""
+        if self.lanes is None:
+            self.lanes = (deque(), deque(), OrderedDict())
+        if lane != UPDATE:
+            self.lanes[lane].append((time.monotonic(), frame, message_id, trace))
+            _LANE_QUEUED[lane].inc()
+            _LANE_DEPTH[lane].inc()
+            return
+        updates = self.lanes[UPDATE]
+        key = message_id if coalesce else object()
+        if key in updates:
+            # Keeps the older entry's place in line
+            updates[key] = (updates[key][0], frame, message_id, trace)
+            _LANE_COALESCED.inc()
+            return
+        updates[key] = (time.monotonic(), frame, message_id, trace)
+        _LANE_QUEUED[UPDATE].inc()
+        _LANE_DEPTH[UPDATE].inc()
+        dropped = 0
+        while len(updates) > WS_UPDATE_LANE_MAX > 0:
+            _, (_, dropped_frame, dropped_id, _) = updates.popitem(last=False)
+            if dropped_id:
+                if self.resync is None:
+                    self.resync = {}
+                self.resync[dropped_id] = json.loads(parse_frame(dropped_frame).payload)["header"]["app_id"]
+            if self.delta_versions is not None:
+                # The client missed this version: its next update must be a full one
+                self.delta_versions.pop(dropped_id, None)
+            dropped += 1
+        if dropped:
+            _LANE_DROPPED.inc(dropped)
+            _LANE_DEPTH[UPDATE].dec(dropped)
+
+    def next_frame(self) -> Optional[tuple]:
+        """(frame, trace) of the next frame to write, or None when all lanes are empty."""
+        if self.lanes is None:
+            return None
+        for lane, frames in enumerate(self.lanes):
+            if lane == UPDATE and self.resync:
+                resync, self.resync = self.resync, None
+                app_id = next(iter(resync.values()))
+                return make_event_frame(build_message_resync_event(list(resync), app_id)), None
+            if frames:
+                entry = frames.popleft() if lane != UPDATE else frames.popitem(last=False)[1]
+                _LANE_WAIT[lane].observe(time.monotonic() - entry[0])
+                _LANE_DEPTH[lane].dec()
+                return entry[1], entry[3]
+        return None
+
+    def discard(self):
+        """Drop whatever is still queued (the connection is gone)."""
+        if self.lanes is not None:
+            for lane, frames in enumerate(self.lanes):
+                _LANE_DEPTH[lane].dec(len(frames))
+            self.lanes = None
+        self.resync = None
+
+
+_BASE_EVENTS = {"im.message.receive_v1", "cofly.message.sync_v1"}
+_UPDATE_EVENT = "im.message.update_v1"
+_COMPACT_REPLACED = PENDING_COMPACTED.labels("replaced")
+_COMPACT_MERGED = PENDING_COMPACTED.labels("merged")
+# Event cursors, increasing across all users and delivery modes
+next_cursor = itertools.count(1).__next__
+
+
+class OfflineQueue:
+    """Events queued for one offline user, compacted per message as they arrive.
+
+    A message streamed with hundreds of edits would otherwise replay every
+    full-content update on reconnect. Only the latest update per message is
+    kept (in the place of the first), and while the message's own receive or
+    sync event is still queued, updates are merged into it instead.
+
+    Each entry carries a cursor (see next_cursor) for the HTTP delivery modes:
+    take() hands out events past the client's cursor and drops the ones at or
+    before it, which the client has acknowledged by sending that cursor.
+    """
+
+    __slots__ = ("events", "cursors", "received", "_folded", "_by_message", "_waiters")
+
+    def __init__(self):
+        self.events: list = []
+        self.cursors: List[int] = []
+        # Events appended, before compaction
+        self.received = 0
+        # Per entry, how many events it stands for
+        self._folded: List[int] = []
+        # message_id -> index in events of its receive/sync or latest update,
+        # for entries not yet handed out
+        self._by_message: Dict[str, int] = {}
+        self._waiters: List[asyncio.Future] = []
+
+    def append(self, event_json: dict, cursor: Optional[int] = None):
+        """Queue an event under a new cursor, or under the one it was first
+        handed out with (an event put back after a stream failed to write it)."""
+        self.received += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        event_type = event_json.get("header", {}).get("event_type")
+        message_id = event_json.get("event", {}).get("message", {}).get("message_id")
+        if message_id and event_type == _UPDATE_EVENT:
+            i = self._by_message.get(message_id)
+            if i is not None:
+                queued = self.events[i]
+                if queued["header"]["event_type"] == _UPDATE_EVENT:
+                    self.events[i] = event_json
+                    _COMPACT_REPLACED.inc()
+                else:
+                    self.events[i] = _merge_update(queued, event_json)
+                    _COMPACT_MERGED.inc()
+                self._folded[i] += 1
+                return
+        self._index(len(self.events), event_json)
+        self.events.append(event_json)
+        self.cursors.append(next_cursor() if cursor is None else cursor)
+        self._folded.append(1)
+
+    def _index(self, i: int, event_json: dict):
+        event_type = event_json.get("header", {}).get("event_type")
+        if event_type in _BASE_EVENTS or event_type == _UPDATE_EVENT:
+            message_id = event_json["event"].get("message", {}).get("message_id")
+            if message_id:
+                self._by_message[message_id] = i
+
+    def take(self, cursor: int, limit: int) -> List[Tuple[int, dict]]:
+        """Drop the events at or before cursor; return up to limit (cursor, event)
+        pairs after it. Events handed out are no longer rewritten by compaction,
+        so a later edit is queued behind them with a cursor of its own."""
+        acked = 0
+        while acked < len(self.cursors) and self.cursors[acked] <= cursor:
+            acked += 1
+        if acked:
+            self.received -= sum(self._folded[:acked])
+            del self.events[:acked], self.cursors[:acked], self._folded[:acked]
+        batch = list(zip(self.cursors[:limit], self.events[:limit]))
+        self._by_message = {}
+        for i in range(len(batch), len(self.events)):
+            self._index(i, self.events[i])
+        return batch
+
+    def pop_all(self) -> list:
+        """Hand every queued event over for delivery and empty the queue; the
+        queue itself, and any long-poll waiting on it, stays in place."""
+        events = self.events
+        self.events, self.cursors, self._folded, self._by_message = [], [], [], {}
+        self.received = 0
+        return events
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait up to timeout for the next append; False on timeout."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.remove(waiter)
+
+    def idle(self) -> bool:
+        """Nothing queued and nobody waiting on it."""
+        return not self.events and not self._waiters
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+
+def _merge_update(event_json: dict, update: dict) -> dict:
+    """event_json (a receive or sync event) carrying update's content. Copied,
+    since queued events may share their body with other recipients."""
+    edited = update["event"]["message"]
+    message = {**event_json["event"]["message"],
+               "message_type": edited["message_type"], "content": edited["content"]}
+    if "version" in edited:
+        message["version"] = edited["version"]
+    return {**event_json, "event": {**event_json["event"], "message": message}}
+
+
+class ConnectionRegistry:
+    """user_id -> device_id -> Connection, with O(1) add/remove and a running total.
+
+    A device holds at most one connection: a new one from the same device
+    replaces the old (which is usually a socket the client already gave up on).
+    Connections without a device_id each get a key of their own.
+    """
 
-class WSManager:
     def __init__(self):
-        # user_id -> list of WebSocket connections (supports multi-device)
-        self.connections: Dict[str, List[WebSocket]] = {}
+        self._users: Dict[str, Dict[str, Connection]] = {}
+        self.total = 0
+        self._anonymous = itertools.count()
+
+    def add(self, conn: Connection) -> Optional[Connection]:
+        """Register conn; returns the connection it replaced, if any."""
+        if not conn.device_id:
+            conn.device_id = f"~{next(self._anonymous)}"
+        devices = self._users.setdefault(conn.user_id, {})
+        replaced = devices.get(conn.device_id)
+        if replaced is not None:
+            replaced.active = False
+        else:
+            self.total += 1
+        devices[conn.device_id] = conn
+        return replaced
+
+    def remove(self, conn: Connection) -> bool:
+        """Unregister conn; False if it was already removed or replaced."""
+        devices = self._users.get(conn.user_id)
+        if devices is None or devices.get(conn.device_id) is not conn:
+            return False
+        del devices[conn.device_id]
+        if not devices:
+            del self._users[conn.user_id]
+        conn.active = False
+        self.total -= 1
+        return True
+
+    def get(self, user_id: str) -> List[Connection]:
+        """A snapshot of the user's connections (safe to iterate while sending)."""
+        devices = self._users.get(user_id)
+        return list(devices.values()) if devices else []
+
+    def pop_user(self, user_id: str) -> List[Connection]:
+        conns = list(self._users.pop(user_id, {}).values())
+        for conn in conns:
+            conn.active = False
+        self.total -= len(conns)
+        return conns
+
+    def users(self):
+        return self._users.keys()
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def clear(self):
+        self._users.clear()
+        self.total = 0
+
+
+def idle_timeout() -> float:
+    """Seconds without any frame (clients ping every PingInterval) before a
+    connection is presumed half-open."""
+    return admission.ping_interval * WS_IDLE_PINGS
+
+
+class WSShard:
+    """The connections, offline queues and idle heap of the users hashed to one shard."""
+
+    def __init__(self, index: int):
+        self.index = index
+        # user_id -> device_id -> Connection (supports multi-device)
+        self.connections = ConnectionRegistry()
         self._seq_counter = 0
-        # user_id -> list of pending events (delivered when user connects)
-        self._pending: Dict[str, list] = {}
+        # user_id -> pending events (delivered when user connects)
+        self._pending: Dict[str, OfflineQueue] = {}
+        # (deadline, tiebreak, Connection) min-heap of idle deadlines; entries are
+        # lazily re-pushed with a later deadline when the connection was seen since
+        self._idle_heap: List[tuple] = []
+        self._heap_seq = itertools.count()
+
+    def register(self, user_id: str, ws: WebSocket, device_id: str = "", service_id: str = "",
+                 delta_updates: bool = False) -> Connection:
+        """Add an accepted socket to the registry (no pending flush)."""
+        conn = Connection(user_id, device_id, service_id, ws, delta_updates)
+        replaced = self.connections.add(conn)
+        if replaced is not None:
+            logger.info("WS replaced: user_id=%s device_id=%s", user_id, conn.device_id)
+            asyncio.ensure_future(_close_quietly(replaced.ws, 4002, "replaced by a new connection"))
+        heapq.heappush(self._idle_heap, (conn.last_seen + idle_timeout(), next(self._heap_seq), conn))
+        return conn
 
-    async def connect(self, user_id: str, ws: WebSocket):
+    async def connect(self, user_id: str, ws: WebSocket, device_id: str = "", service_id: str = "",
+                      delta_updates: bool = False) -> Connection:
         await ws.accept()
-        self.connections.setdefault(user_id, []).append(ws)
-        total = sum(len(v) for v in self.connections.values())
-        logger.info("WS connected: user_id=%s (total connections: %d)", user_id, total)
+        conn = self.register(user_id, ws, device_id, service_id, delta_updates)
+        logger.info("WS connected: user_id=%s device_id=%s (shard %d: %d connections)",
+                    user_id, conn.device_id, self.index, self.connections.total)
         # Flush any pending events
-        pending = self._pending.pop(user_id, [])
+        queue = self._pending.get(user_id)
+        pending = queue.pop_all() if queue is not None else ()
+        if queue is not None:
+            self._drop_if_empty(user_id, queue)
         for event_json in pending:
             await self.push_event(user_id, event_json)
+        return conn
 
-    def disconnect(self, user_id: str, ws: WebSocket = None):
-        if ws is not None:
-            conns = self.connections.get(user_id, [])
-            if ws in conns:
-                conns.remove(ws)
-            if not conns:
-                self.connections.pop(user_id, None)
-        else:
-            self.connections.pop(user_id, None)
-        total = sum(len(v) for v in self.connections.values())
-        logger.info("WS disconnected: user_id=%s (total connections: %d)", user_id, total)
+    def disconnect(self, conn: Connection):
+        """Unregister one connection; a no-op if it was already removed or replaced."""
+        if self.connections.remove(conn):
+            logger.info("WS disconnected: user_id=%s device_id=%s (shard %d: %d connections)",
+                        conn.user_id, conn.device_id, self.index, self.connections.total)
+
+    def disconnect_user(self, user_id: str):
+        conns = self.connections.pop_user(user_id)
+        logger.info("WS disconnected: user_id=%s, %d connections (shard %d: %d connections)",
+                    user_id, len(conns), self.index, self.connections.total)
 
     def is_online(self, user_id: str) -> bool:
-        return bool(self.connections.get(user_id))
+        return user_id in self.connections
 
-    async def handle_frame(self, user_id: str, ws: WebSocket, data: bytes):
-        frame = parse_frame(data)
-        frame_type = get_header(frame, "type")
-        if frame_type == "ping":
-            pong = make_pong_frame(frame)
-            await ws.send_bytes(pong)
+    def _queue(self, user_id: str) -> OfflineQueue:
+        queue = self._pending.get(user_id)
+        if queue is None:
+            queue = self._pending[user_id] = OfflineQueue()
+        return queue
+
+    def _store(self, user_id: str, event_json: dict, cursor: Optional[int] = None):
+        """Hold an event for a user with no connection: POST it to the user's
+        webhook if one is registered, else queue it."""
+        if webhooks.accepts(user_id):
+            webhooks.submit(user_id, event_json)
+        else:
+            self._queue(user_id).append(event_json, cursor)
+
+    def _drop_if_empty(self, user_id: str, queue: OfflineQueue):
+        if queue.idle() and self._pending.get(user_id) is queue:
+            del self._pending[user_id]
+
+    def pending_depth(self) -> int:
+        """Events queued for this shard's offline users."""
+        return sum(len(queue) for queue in self._pending.values())
+
+    def ack(self, user_id: str, cursor: int):
+        """Drop queued events at or before cursor (already seen by the client)."""
+        queue = self._pending.get(user_id)
+        if queue is not None:
+            queue.take(cursor, 0)
+            self._drop_if_empty(user_id, queue)
+
+    async def poll(self, user_id: str, cursor: int, limit: int, timeout: float) -> List[Tuple[int, dict]]:
+        """Long-poll: ack up to cursor, then return queued (cursor, event) pairs,
+        waiting up to timeout for the first one if there are none."""
+        queue = self._queue(user_id)
+        try:
+            batch = queue.take(cursor, limit)
+            if not batch and timeout > 0 and await queue.wait(timeout):
+                batch = queue.take(cursor, limit)
+            return batch
+        finally:
+            self._drop_if_empty(user_id, queue)
+
+    async def reap_idle(self, now: Optional[float] = None) -> int:
+        """Disconnect connections past their idle deadline; returns how many.
+        Only heap entries that are due are looked at."""
+        if WS_IDLE_PINGS <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        timeout = idle_timeout()
+        reaped = []
+        while self._idle_heap and self._idle_heap[0][0] <= now:
+            _, _, conn = heapq.heappop(self._idle_heap)
+            if not conn.active:
+                continue  # already disconnected or replaced
+            if conn.last_seen + timeout > now:
+                heapq.heappush(self._idle_heap, (conn.last_seen + timeout, next(self._heap_seq), conn))
+                continue
+            logger.warning("reaping idle connection: user_id=%s, silent for %.0fs",
+                           conn.user_id, now - conn.last_seen)
+            self.disconnect(conn)
+            reaped.append(conn)
+        if reaped:
+            WS_REAPED.inc(len(reaped))
+            await asyncio.gather(*(_close_quietly(c.ws, 1001, "heartbeat timeout") for c in reaped))
+        return len(reaped)
 
-    async def push_event(self, target_user_id: str, event_json: dict) -> bool:
-        """Push event to target user (all connections). Returns True if delivered to at least one."""
-        conns = self.connections.get(target_user_id, [])
+    async def send(self, conn: Connection, frame: bytes, lane: int = MESSAGE,
+                   message_id: Optional[str] = None, coalesce: bool = False, trace=None) -> bool:
+        """Write frame now if the connection is idle (True), else queue it in its
+        lane for the connection's writer (False), which marks `trace` written once
+        it goes out. Raises if the write fails."""
+        if conn.writing:
+            conn.queue(lane, frame, message_id, coalesce, trace)
+            return False
+        conn.writing = True
+        try:
+            await conn.ws.send_bytes(frame)
+        except Exception:
+            conn.writing = False
+            conn.discard()
+            raise
+        if conn.lanes is not None and any(conn.lanes):
+            asyncio.ensure_future(self._drain(conn))
+        else:
+            conn.writing = False
+        return True
+
+    async def _drain(self, conn: Connection):
+        """Write the frames queued while the connection was busy, by lane priority."""
+        trace = None
+        try:
+            while conn.active:
+                entry = conn.next_frame()
+                if entry is None:
+                    break
+                frame, trace = entry
+                await conn.ws.send_bytes(frame)
+                if trace is not None:
+                    trace.mark("written", user_id=conn.user_id)
+        except Exception as e:
+            logger.error("drain: failed for user_id=%s: %s", conn.user_id, e)
+            if trace is not None:
+                trace.mark("write_failed", user_id=conn.user_id, error=str(e))
+            self.disconnect(conn)
+        finally:
+            conn.writing = False
+            if not conn.active:
+                conn.discard()
+
+    @staticmethod
+    def _use_delta(conn: Connection, event_json: dict, delta_event: Optional[dict]) -> bool:
+        """Track versions per delta connection; a delta is only sent when the
+        connection already holds its base version, otherwise the full event resyncs it."""
+        versions = conn.delta_versions
+        if versions is None:
+            return False
+        if delta_event is not None:
+            msg = delta_event["event"]["message"]
+            use_delta = versions.get(msg["message_id"]) == msg["base_version"]
+        elif event_json.get("header", {}).get("event_type") in _VERSIONED_EVENTS:
+            msg = event_json["event"]["message"]
+            use_delta = False
+        else:
+            return False
+        versions[msg["message_id"]] = msg.get("version", 0)
+        versions.move_to_end(msg["message_id"])
+        if len(versions) > DELTA_TRACKED_MESSAGES:
+            versions.popitem(last=False)
+        return use_delta
+
+    async def push_event(self, target_user_id: str, event_json: dict,
+                         delta_event: Optional[dict] = None) -> bool:
+        """Push event to target user (all connections). Returns True if delivered to at least one.
+        delta_event, if given, is sent instead of event_json to connections that opted
+        into delta updates; offline users always get the full event queued."""
+        conns = self.connections.get(target_user_id)
         if not conns:
-            logger.info("push_event: user_id=%s NOT online, queuing. Online: %s",
-                        target_user_id, list(self.connections.keys()))
-            self._pending.setdefault(target_user_id, []).append(event_json)
+            logger.info("push_event: user_id=%s NOT online, queuing", target_user_id)
+            self._store(target_user_id, event_json)
+            _PUSH_QUEUED.inc()
             return False
+        start = time.perf_counter()
         self._seq_counter += 1
-        frame_bytes = make_event_frame(event_json, seq_id=self._seq_counter)
+        frame_bytes = delta_bytes = None
+        event_type = event_json.get("header", {}).get("event_type")
+        lane = lane_for(event_type)
+        message_id = event_json.get("event", {}).get("message", {}).get("message_id")
+        coalesce = event_type in _EDIT_EVENTS
         any_sent = False
         failed = []
-        for ws in conns:
+        for conn in conns:
             try:
-                await ws.send_bytes(frame_bytes)
+                # A queued edit of the same message is about to be replaced, so the
+                # client would never get this delta's base: send the full event
+                delta = None if coalesce and conn.queued_edit(message_id) else delta_event
+                if self._use_delta(conn, event_json, delta):
+                    if delta_bytes is None:
+                        delta_bytes = make_event_frame(delta_event, seq_id=self._seq_counter)
+                    await self.send(conn, delta_bytes, lane, message_id, coalesce)
+                else:
+                    if frame_bytes is None:
+                        frame_bytes = make_event_frame(event_json, seq_id=self._seq_counter)
+                    await self.send(conn, frame_bytes, lane, message_id, coalesce)
                 any_sent = True
             except Exception as e:
                 logger.error("push_event: failed for user_id=%s: %s", target_user_id, e)
-                failed.append(ws)
+                failed.append(conn)
         # Clean up failed connections
-        for ws in failed:
-            self.disconnect(target_user_id, ws)
+        for conn in failed:
+            self.disconnect(conn)
+        _record_push(start, any_sent)
         if any_sent:
             logger.info("push_event: sent to user_id=%s, event_type=%s",
                         target_user_id, event_json.get("header", {}).get("event_type"))
         return any_sent
 
+    def enqueue(self, items: List[Tuple[str, dict]]):
+        """Queue (user_id, event) pairs for offline users in one pass."""
+        for user_id, event_json in items:
+            self._store(user_id, event_json)
+        _PUSH_QUEUED.inc(len(items))
+        if items:
+            logger.info("enqueue: shard %d queued %d events for offline users", self.index, len(items))
+
+    async def push_shared(self, target_user_id: str, username: str, shared: SharedEvent,
+                          trace=None) -> bool:
+        """push_event for one recipient of a SharedEvent: the frame wraps the
+        pre-encoded body instead of re-serializing the event per recipient."""
+        conns = self.connections.get(target_user_id)
+        if not conns:
+            self._store(target_user_id, shared.event_for(username))
+            _PUSH_QUEUED.inc()
+            if trace is not None:
+                trace.mark("enqueued", user_id=target_user_id)
+            return False
+        start = time.perf_counter()
+        self._seq_counter += 1
+        frame_bytes = None
+        any_sent = False
+        failed = []
+        for conn in conns:
+            try:
+                # Records the version on delta connections; receive events are never deltas
+                self._use_delta(conn, shared.event_json, None)
+                if frame_bytes is None:
+                    frame_bytes = make_payload_frame(
+                        shared.payload_for(username), shared.message_id, seq_id=self._seq_counter,
+                    )
+                written = await self.send(conn, frame_bytes, trace=trace)
+                any_sent = True
+                if trace is not None:
+                    trace.mark("written" if written else "lane_queued", user_id=target_user_id)
+            except Exception as e:
+                logger.error("push_shared: failed for user_id=%s: %s", target_user_id, e)
+                failed.append(conn)
+                if trace is not None:
+                    trace.mark("write_failed", user_id=target_user_id, error=str(e))
+        for conn in failed:
+            self.disconnect(conn)
+        _record_push(start, any_sent)
+        return any_sent
+
+
+class WSManager:
+    """Routes every per-user operation to the shard owning that user_id.
+
+    Shards partition the registry, offline queues and idle heaps so each
+    structure stays a fraction of the total size; they all run on the one
+    event loop, so no locking is involved.
+    """
+
+    def __init__(self, shards: int):
+        self.shards = [WSShard(i) for i in range(max(1, shards))]
+
+    def shard_for(self, user_id: str) -> WSShard:
+        # crc32 rather than hash(): stable across processes, so logs and
+        # per-shard metrics mean the same users after a restart
+        return self.shards[zlib.crc32(user_id.encode()) % len(self.shards)]
+
+    def register(self, user_id: str, ws: WebSocket, device_id: str = "", service_id: str = "",
+                 delta_updates: bool = False) -> Connection:
+        return self.shard_for(user_id).register(user_id, ws, device_id, service_id, delta_updates)
+
+    async def connect(self, user_id: str, ws: WebSocket, device_id: str = "", service_id: str = "",
+                      delta_updates: bool = False) -> Connection:
+        return await self.shard_for(user_id).connect(user_id, ws, device_id, service_id, delta_updates)
+
+    def disconnect(self, conn: Connection):
+        self.shard_for(conn.user_id).disconnect(conn)
+
+    def disconnect_user(self, user_id: str):
+        self.shard_for(user_id).disconnect_user(user_id)
+
+    def is_online(self, user_id: str) -> bool:
+        return self.shard_for(user_id).is_online(user_id)
+
+    def ack(self, user_id: str, cursor: int):
+        self.shard_for(user_id).ack(user_id, cursor)
+
+    def queue_offline(self, user_id: str, events: List[dict]):
+        """Add events to the user's offline queue (webhook fallback)."""
+        queue = self.shard_for(user_id)._queue(user_id)
+        for event_json in events:
+            queue.append(event_json)
+
+    async def poll(self, user_id: str, cursor: int, limit: int, timeout: float) -> List[Tuple[int, dict]]:
+        return await self.shard_for(user_id).poll(user_id, cursor, limit, timeout)
+
+    def connections_of(self, user_id: str) -> List[Connection]:
+        return self.shard_for(user_id).connections.get(user_id)
+
+    def pending(self, user_id: str) -> list:
+        """Events queued for an offline user (read-only view)."""
+        queue = self.shard_for(user_id)._pending.get(user_id)
+        return queue.events if queue is not None else []
+
+    def connection_count(self) -> int:
+        return sum(shard.connections.total for shard in self.shards)
+
+    def online_users(self) -> int:
+        return sum(len(shard.connections) for shard in self.shards)
+
+    def clear_pending(self):
+        """Drop every offline queue."""
+        for shard in self.shards:
+            shard._pending.clear()
+
+    def pending_queues(self):
+        """Every offline queue, across shards."""
+        for shard in self.shards:
+            yield from shard._pending.values()
+
+    def group_by_shard(self, user_ids) -> Dict[WSShard, list]:
+        groups: Dict[WSShard, list] = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return groups
+
+    async def push_event(self, target_user_id: str, event_json: dict,
+                         delta_event: Optional[dict] = None) -> bool:
+        return await self.shard_for(target_user_id).push_event(target_user_id, event_json, delta_event)
+
+    async def push_shared(self, target_user_id: str, username: str, shared: SharedEvent,
+                          trace=None) -> bool:
+        return await self.shard_for(target_user_id).push_shared(target_user_id, username, shared, trace)
+
+    def requeue(self, user_id: str, records: List[Tuple[int, dict]]):
+        """Put back (cursor, event) pairs taken for delivery but never written,
+        keeping their cursors so a client resuming from the last one it saw gets them."""
+        shard = self.shard_for(user_id)
+        for cursor, event_json in records:
+            shard._store(user_id, event_json, cursor)
+        _PUSH_QUEUED.inc(len(records))
+
+    def enqueue(self, items: List[Tuple[str, dict]]):
+        groups: Dict[WSShard, list] = {}
+        for item in items:
+            groups.setdefault(self.shard_for(item[0]), []).append(item)
+        for shard, shard_items in groups.items():
+            shard.enqueue(shard_items)
+
+    async def handle_frame(self, conn: Connection, data: bytes):
+        conn.last_seen = time.monotonic()
+        frame = parse_frame(data)
+        frame_type = get_header(frame, "type")
+        if frame_type == "ping":
+            pong = make_pong_frame(frame, admission.client_config(self.connection_count()))
+            await self.shard_for(conn.user_id).send(conn, pong, CONTROL)
+
+    def idle_timeout(self) -> float:
+        return idle_timeout()
+
+    async def reap_idle(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        return sum([await shard.reap_idle(now) for shard in self.shards])
+
+    async def run_reaper(self):
+        while True:
+            await asyncio.sleep(WS_REAP_INTERVAL_S)
+            try:
+                await self.reap_idle()
+            except Exception as e:
+                logger.error("reaper: error: %s", e)
+
+    def reset(self):
+        """Drop all connections and queued events (tests, benchmarks)."""
+        for shard in self.shards:
+            shard.connections.clear()
+            shard._idle_heap.clear()
+        self.clear_pending()
+
 
 def _build_message_event_base(
     event_type: str,
@@ -91,8 +805,22 @@ def _build_message_event_base(
     content: str,
     root_id: str = "",
     parent_id: str = "",
+    seq: Optional[int] = None,
 ) -> dict:
     now_ms = str(int(time.time() * 1000))
+    message = {
+        "message_id": message_id,
+        "root_id": root_id,
+        "parent_id": parent_id,
+        "chat_id": chat_id,
+        "chat_type": chat_type,
+        "message_type": message_type,
+        "content": content,
+        "mentions": [],
+    }
+    if seq is not None:
+        # Position in the chat: a client that sees a jump re-fetches with since_seq
+        message["seq"] = seq
     return {
         "schema": "2.0",
         "header": {
@@ -113,16 +841,7 @@ def _build_message_event_base(
                 "sender_type": "user",
                 "tenant_key": "cofly",
             },
-            "message": {
-                "message_id": message_id,
-                "root_id": root_id,
-                "parent_id": parent_id,
-                "chat_id": chat_id,
-                "chat_type": chat_type,
-                "message_type": message_type,
-                "content": content,
-                "mentions": [],
-            },
+            "message": message,
         },
     }
 
@@ -137,11 +856,12 @@ def build_message_event(
     content: str,
     root_id: str = "",
     parent_id: str = "",
+    seq: Optional[int] = None,
 ) -> dict:
     return _build_message_event_base(
         "im.message.receive_v1",
         sender_id, receiver_username, message_id, chat_id, chat_type,
-        message_type, content, root_id, parent_id,
+        message_type, content, root_id, parent_id, seq,
     )
 
 
@@ -155,13 +875,14 @@ def build_message_sync_event(
     content: str,
     root_id: str = "",
     parent_id: str = "",
+    seq: Optional[int] = None,
 ) -> dict:
     """Same payload as build_message_event but with event_type=cofly.message.sync_v1.
     Lark SDK bots ignore unknown event types, so the sender won't process its own messages."""
     return _build_message_event_base(
         "cofly.message.sync_v1",
         sender_id, receiver_username, message_id, chat_id, chat_type,
-        message_type, content, root_id, parent_id,
+        message_type, content, root_id, parent_id, seq,
     )
 
 
@@ -173,8 +894,18 @@ def build_message_update_event(
     chat_type: str,
     message_type: str,
     content: str,
+    version: Optional[int] = None,
 ) -> dict:
     now_ms = str(int(time.time() * 1000))
+    message = {
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "chat_type": chat_type,
+        "message_type": message_type,
+        "content": content,
+    }
+    if version is not None:
+        message["version"] = version
     return {
         "schema": "2.0",
         "header": {
@@ -185,6 +916,46 @@ def build_message_update_event(
             "app_id": receiver_username,
             "tenant_key": "cofly",
         },
+        "event": {
+            "sender": {
+                "sender_id": {
+                    "open_id": sender_id,
+                    "user_id": sender_id,
+                    "union_id": sender_id,
+                },
+                "sender_type": "user",
+                "tenant_key": "cofly",
+            },
+            "message": message,
+        },
+    }
+
+
+def build_message_delta_event(
+    sender_id: str,
+    receiver_username: str,
+    message_id: str,
+    chat_id: str,
+    chat_type: str,
+    message_type: str,
+    base_version: int,
+    version: int,
+    ops: list,
+) -> dict:
+    """Compact alternative to im.message.update_v1 for clients connected with
+    update_mode=delta: ops (see deltas.py) turn base_version's content into version's.
+    A client whose local version differs from base_version re-fetches the message."""
+    now_ms = str(int(time.time() * 1000))
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": str(uuid.uuid4()),
+            "event_type": "cofly.message.delta_v1",
+            "create_time": now_ms,
+            "token": "",
+            "app_id": receiver_username,
+            "tenant_key": "cofly",
+        },
         "event": {
             "sender": {
                 "sender_id": {
@@ -200,7 +971,9 @@ def build_message_update_event(
                 "chat_id": chat_id,
                 "chat_type": chat_type,
                 "message_type": message_type,
-                "content": content,
+                "base_version": base_version,
+                "version": version,
+                "ops": ops,
             },
         },
     }
@@ -231,4 +1004,26 @@ def build_ack_event(
     }
 
 
-ws_manager = WSManager()
+def build_message_resync_event(message_ids: List[str], receiver_username: str) -> dict:
+    """Names messages whose queued updates were dropped while the connection was
+    backed up; the client re-fetches them (GET /open-apis/im/v1/messages/{id})
+    rather than keep stale content."""
+    now_ms = str(int(time.time() * 1000))
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": str(uuid.uuid4()),
+            "event_type": "cofly.message.resync_v1",
+            "create_time": now_ms,
+            "token": "",
+            "app_id": receiver_username,
+            "tenant_key": "cofly",
+        },
+        "event": {
+            "message_ids": message_ids,
+        },
+    }
+
+
+ws_manager = WSManager(WS_SHARDS)
+webhooks.fallback = ws_manager.queue_offline
@@ -493,9 +493,12 @@ class ChatProvider with ChangeNotifier {
         return;
       }
 
+      // 已记录会话序号时按 sinceSeq 拉取增量；否则退回时间戳
+      int? sinceSeq = _storage.getLastSeq(_currentChatId);
+
       // 取本地最新消息的时间戳 +1ms 作为 startTime
       int? startTime;
-      if (_messages.isNotEmpty) {
+      if (sinceSeq == null && _messages.isNotEmpty) {
         final latest = _messages
             .map((m) => m.createdAt.millisecondsSinceEpoch)
             .reduce((a, b) => a > b ? a : b);
@@ -504,20 +507,32 @@ class ChatProvider with ChangeNotifier {
 
       // 如果本地无消息但存在清空时间戳，用它作为 startTime，
       // 避免全量拉取已被用户清空的旧消息
-      if (startTime == null) {
+      if (sinceSeq == null && startTime == null) {
         final clearTs = _storage.getClearTimestamp(_currentChatId);
         if (clearTs != null) {
           startTime = clearTs + 1;
         }
       }
 
-      debugPrint('[Chat] _syncFromServer: serverChatId=$_serverChatId, startTime=$startTime');
-      final response = await _api.getMessages(
-        chatId: _serverChatId!,
-        startTime: startTime,
-      );
+      debugPrint('[Chat] _syncFromServer: serverChatId=$_serverChatId, sinceSeq=$sinceSeq, startTime=$startTime');
+      final items = <Map<String, dynamic>>[];
+      while (true) {
+        final response = await _api.getMessages(
+          chatId: _serverChatId!,
+          startTime: startTime,
+          sinceSeq: sinceSeq,
+        );
+        items.addAll(response.items);
+        final lastSeq = response.items.isEmpty ? null : response.items.last['seq'] as int?;
+        if (lastSeq != null) {
+          sinceSeq = lastSeq;
+          await _storage.setLastSeq(_currentChatId, lastSeq);
+        }
+        // 只有序号模式能无缝翻页
+        if (!response.hasMore || lastSeq == null) break;
+      }
 
-      if (response.items.isEmpty) {
+      if (items.isEmpty) {
         debugPrint('[Chat] _syncFromServer: no new messages');
         return;
       }
@@ -526,7 +541,7 @@ class ChatProvider with ChangeNotifier {
       final existingIds = _messages.map((m) => m.id).toSet();
       int added = 0;
 
-      for (final item in response.items) {
+      for (final item in items) {
         final message = Message.fromServerItem(
           item,
           localChatId: _currentChatId,
@@ -384,13 +384,17 @@ class ApiService {
     required String chatId,
     int pageSize = 200,
     int? startTime,
+    int? sinceSeq,
   }) async {
     try {
       final queryParams = <String, dynamic>{
         'page_size': pageSize,
       };
 
-      if (startTime != null) {
+      // sinceSeq 优先：按会话序号精确拉取增量，无重复、无遗漏
+      if (sinceSeq != null) {
+        queryParams['since_seq'] = sinceSeq;
+      } else if (startTime != null) {
         queryParams['start_time'] = startTime;
       }
 
@@ -327,6 +327,18 @@ class StorageService {
     await _configBox.put('clear_ts_${username}_$chatId', timestamp);
   }
 
+  /// 获取已同步到的服务器消息序号
+  int? getLastSeq(String chatId) {
+    final username = getUsername() ?? 'anonymous';
+    return _configBox.get('last_seq_${username}_$chatId') as int?;
+  }
+
+  /// 设置已同步到的服务器消息序号
+  Future<void> setLastSeq(String chatId, int seq) async {
+    final username = getUsername() ?? 'anonymous';
+    await _configBox.put('last_seq_${username}_$chatId', seq);
+  }
+
   /// 清除所有聊天记录
   Future<void> clearAllMessages() async {
     await _messagesBox.clear();